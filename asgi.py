@@ -0,0 +1,215 @@
+"""
+asgi.py
+ASGI serving mode for main.py - the Datastore-bound read endpoints are offloaded to a
+thread pool from one event loop.
+
+Description:
+   The Flask views of main.py are synchronous, so every request in flight holds a server
+   thread, also while it only waits for a free thread.  This module serves the same
+   routes as an ASGI application on one event loop:
+
+      GET /taskdata                      (datasetlist_ep)  EXECUTOR
+      GET /taskdata/<datasetid>          (dataset_ep)      EXECUTOR
+      GET /taskdata/<datasetid>/<taskid> (task_ep)         EXECUTOR
+      GET /taskdur/<datasetid>           (taskdur_ep)      EXECUTOR
+      GET /tasktop/<datasetid>           (tasktop_ep)      EXECUTOR
+      GET /taskbatch?datasetids=<id>,... (taskbatch_ep)    EXECUTOR
+      everything else                    main.app on WSGI_EXECUTOR
+
+   This is thread offload, not async I/O:  the Datastore and Storage clients block, so
+   each request still holds a thread while it talks to Datastore.  The read routes run
+   main.py's read handlers (main.READ_HANDLERS - the same code as the Resource get
+   methods) on EXECUTOR, ASYNC_MAX_WORKERS threads (default 64), and at most that many
+   of them run at once per process.  What the event loop adds is that requests waiting
+   for a thread - and idle keep-alive connections - cost no thread, so a burst queues
+   instead of being refused; cap the queue with uvicorn's --limit-concurrency.
+
+   All other routes (writes, /bucket, /profile, /metrics, /_ah/warmup) run the whole
+   Flask app on WSGI_EXECUTOR, a second pool of ASGI_WSGI_WORKERS threads (default 32).
+
+   Both run in a real request of main.app built from the ASGI scope (see build_environ):
+   the client headers, remote address and body are the ones the client sent.
+
+   The read routes are instrumented like instrument.py does it (<METHOD>_<endpoint> clock,
+   trace and status / response_bytes counters); the sampler thread tags and RECORD_FILE
+   cover the routes served by the Flask app only.  Unhandled errors are logged with their
+   traceback by main.app.logger and answered with a 500.
+
+   Example:
+      uvicorn asgi:app --host 0.0.0.0 --port 8080 --limit-concurrency 500
+      TASK_BACKEND=local python asgi.py
+
+"""
+import io
+import os
+import sys
+import json
+import asyncio
+import contextvars
+import concurrent.futures
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+import profile
+import main
+
+ASYNC_MAX_WORKERS = int(os.environ.get("ASYNC_MAX_WORKERS", "64"))
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=ASYNC_MAX_WORKERS, thread_name_prefix="asgi-datastore")
+WSGI_MAX_WORKERS = int(os.environ.get("ASGI_WSGI_WORKERS", "32"))
+WSGI_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=WSGI_MAX_WORKERS, thread_name_prefix="asgi-wsgi")
+
+URL_MAP = main.app.url_map.bind("localhost")
+
+# Run a blocking call on an executor - in a copy of the context, so the request context
+# is visible to it and its clocks become spans of the request trace.
+async def offload(executor, func, *args):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, context.run, func, *args)
+
+def run_handler(handler, kwargs):
+    return handler(main.get_datastore_client(), **kwargs)
+
+#
+# WSGI Requests from the ASGI Scope
+#
+async def read_body(receive):
+    chunks = []
+    while (True):
+        message = await receive()
+        if (message["type"] == "http.disconnect"):
+            break
+        chunks.append(message.get("body", b""))
+        if (not message.get("more_body", False)):
+            break
+    return b"".join(chunks)
+
+# PEP 3333 environ for the request of an ASGI http scope.
+def build_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode('utf8').decode('latin1'),
+        "PATH_INFO": scope["path"].encode('utf8').decode('latin1'),
+        "QUERY_STRING": scope.get("query_string", b"").decode('latin1'),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1] if server[1] is not None else 80),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": str(client[0]),
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False
+    }
+    for name, value in scope["headers"]:
+        name = name.decode('latin1').upper().replace("-", "_")
+        value = value.decode('latin1')
+        if (name == "CONTENT_TYPE" or name == "CONTENT_LENGTH"):
+            key = name
+        else:
+            key = "HTTP_" + name
+        if (key in environ):
+            value = environ[key] + "," + value
+        environ[key] = value
+    return environ
+
+# Runs the whole Flask app for one request - the body is collected, main.py does not stream.
+def run_wsgi(environ):
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(" ", 1)[0]), headers]
+    result = main.app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if (hasattr(result, "close")):
+            result.close()
+    return started[0], started[1], body
+
+async def send_response(send, status, headers, body):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+#
+# ASGI Application
+#
+def match_handler(scope):
+    if (scope["method"] != "GET"):
+        return None, None
+    try:
+        endpoint, kwargs = URL_MAP.match(scope["path"], "GET")
+    except (HTTPException, RequestRedirect):
+        return None, None
+    handler = main.READ_HANDLERS.get(endpoint)
+    if (handler is None):
+        return None, None
+    return (endpoint, handler), kwargs
+
+# The read handler runs in a request context of main.app (reqparse, absolute uris);
+# aborts become their error response, like flask_restful renders them.
+async def handle(environ, send, endpoint, handler, kwargs):
+    with main.app.request_context(environ):
+        try:
+            output, status = await offload(EXECUTOR, run_handler, handler, kwargs)
+        except HTTPException as e:
+            status = e.code
+            output = getattr(e, "data", None) or {"message": e.description}
+        except Exception:
+            main.app.logger.exception("Unhandled error in " + endpoint)
+            status = 500
+            output = {"message": "Internal Server Error"}
+    body = (json.dumps(output) + "\n").encode('utf8')
+    await send_response(send, status, [("Content-Type", "application/json"), ("Content-Length", str(len(body)))], body)
+    return status, len(body)
+
+async def http(scope, receive, send):
+    environ = build_environ(scope, await read_body(receive))
+    match, kwargs = match_handler(scope)
+    if (match is None):
+        status, headers, body = await offload(WSGI_EXECUTOR, run_wsgi, environ)
+        await send_response(send, status, headers, body)
+        return
+    endpoint, handler = match
+    if (not profile.ENABLED):
+        await handle(environ, send, endpoint, handler, kwargs)
+        return
+    name = "GET_" + endpoint
+    profile.trace_begin(name)
+    profile.clock_start(name)
+    status = 500
+    try:
+        status, length = await handle(environ, send, endpoint, handler, kwargs)
+        profile.counter_inc(name + ".response_bytes", length)
+    finally:
+        profile.clock_stop(name)
+        profile.trace_end()
+        profile.counter_inc(name + ".status_" + str(status))
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if (message["type"] == "lifespan.startup"):
+            await send({"type": "lifespan.startup.complete"})
+        elif (message["type"] == "lifespan.shutdown"):
+            EXECUTOR.shutdown(wait=False)
+            WSGI_EXECUTOR.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if (scope["type"] == "http"):
+        await http(scope, receive, send)
+    elif (scope["type"] == "lifespan"):
+        await lifespan(scope, receive, send)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=5000)
@@ -0,0 +1,77 @@
+"""
+backend.py
+Selects the Datastore / Storage implementation used by main.py.
+
+Description:
+   TASK_BACKEND=cloud (default)  google.cloud datastore and storage clients
+   TASK_BACKEND=local            the in-process localstore stand-in - no network or
+                                 credentials, for offline tests and benchmarks
+
+   The cloud libraries are only imported when the cloud backend is used, on first use
+   (timed by startup.py).
+
+   get_datastore_client() / get_storage_client() keep one client per process, shared by
+   all threads (the Datastore client keeps its batch / transaction stack per thread), so
+   the credentials lookup and connection setup of a new client are paid once - by the
+   warmup request (main.py /_ah/warmup) when there is one.  A forked process (e.g. a
+   gunicorn worker) creates its own clients instead of using the parent's.
+
+   Example:
+      TASK_BACKEND=local LOCAL_STORAGE_DIR=/tmp/buckets python main.py
+
+"""
+import os
+import threading
+import startup
+
+BACKENDS = ("cloud", "local")
+BACKEND = os.environ.get("TASK_BACKEND", "cloud")
+if (BACKEND not in BACKENDS):
+    raise ValueError("Unknown TASK_BACKEND {} - use one of {}".format(BACKEND, ", ".join(BACKENDS)))
+
+def is_local():
+    return BACKEND == "local"
+
+def new_datastore_client():
+    if (is_local()):
+        import localstore
+        return localstore.Client()
+    datastore = startup.timed_import("google.cloud.datastore")
+    return datastore.Client()
+
+def new_storage_client():
+    if (is_local()):
+        import localstore
+        return localstore.StorageClient()
+    storage = startup.timed_import("google.cloud.storage")
+    return storage.Client()
+
+def new_entity(key, exclude_from_indexes=()):
+    if (is_local()):
+        import localstore
+        return localstore.Entity(key, exclude_from_indexes=exclude_from_indexes)
+    datastore = startup.timed_import("google.cloud.datastore")
+    return datastore.Entity(key, exclude_from_indexes=exclude_from_indexes)
+
+#
+# Client Cache - one client per process:  {name: (pid, client)}
+#
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+def get_client(name, factory):
+    pid = os.getpid()
+    cached = CLIENTS.get(name)
+    if (cached is None or cached[0] != pid):
+        with CLIENTS_LOCK:
+            cached = CLIENTS.get(name)
+            if (cached is None or cached[0] != pid):
+                cached = (pid, factory())
+                CLIENTS[name] = cached
+    return cached[1]
+
+def get_datastore_client():
+    return get_client("datastore", new_datastore_client)
+
+def get_storage_client():
+    return get_client("storage", new_storage_client)
@@ -0,0 +1,367 @@
+"""
+bench.py
+Load test / benchmark harness for task-api.py, ftask-api.py and main.py.
+
+Description:
+   Starts one of the apps on 127.0.0.1:5000 (or uses a running server with --url), seeds
+   a dataset of --size tasks, then drives it from --concurrency threads with a mix of
+   single-task reads and writes (--read-ratio).  Every request is timed on the client.
+
+   main.py is started with TASK_BACKEND=local (see backend.py), ftask-api.py with a
+   temporary FTASK_DATA_DIR, so runs need no network and start from the same state.
+
+   The report (stdout and --output JSON) has per operation (read, write, all):
+      count, errors, throughput (requests/s), mean / p50 / p90 / p99 / max latency (ms)
+   The measured load is run --repeat times (default 3); each figure is the median of the
+   runs (counts and errors are totals), so one noisy run does not move the result.
+
+   With --baseline, the results are compared to an earlier --output file and the run
+   fails (exit status 1) when a p50 / p99 latency rose or the throughput fell by more
+   than --tolerance percent - use it in CI to catch performance regressions.  Back to
+   back runs of the same tree differ by up to ~15% at p50, so the default is 25%.
+
+   A seeding request that fails aborts the run (exit status 1) - an empty or partial
+   dataset would be benchmarked otherwise.
+
+   Example:
+      python bench.py --app ftask --size 1000 --concurrency 8 --requests 5000 --output ftask.json
+      python bench.py --app ftask --size 1000 --concurrency 8 --requests 5000 --baseline ftask.json
+      python bench.py --app main --url http://127.0.0.1:8080 --read-ratio 0.5
+
+"""
+import os
+import sys
+import json
+import time
+import math
+import random
+import signal
+import argparse
+import tempfile
+import datetime
+import itertools
+import threading
+import subprocess
+import requests
+
+HOST_URL = "http://127.0.0.1:5000"
+DATASETID = "bench"
+READY_TIMEOUT = 20
+SEED_CHUNK = 500
+
+class BenchmarkError(Exception):
+    pass
+
+def check_seed(response):
+    if (response.status_code >= 400):
+        raise BenchmarkError("Seeding failed: " + response.request.method + " " + response.url + " returned " + str(response.status_code) + " " + response.text.strip()[:200])
+
+#
+# Workloads
+#
+# Each workload knows the seed request and the read / write request of one app.
+class TaskWorkload(object):
+    app_file = "task-api.py"
+    ready_path = "/tasks"
+
+    def seed(self, session, base, size):
+        check_seed(session.delete(base + "/tasks"))
+        for i in range(size):
+            check_seed(session.post(base + "/tasks", json={"taskid": task_id(i), "desc": "Task " + str(i), "dur": i}))
+
+    def read(self, session, base, taskid):
+        return session.get(base + "/tasks/" + taskid)
+
+    def write(self, session, base, taskid, dur):
+        return session.put(base + "/tasks/" + taskid, json={"desc": "Task " + taskid, "dur": dur})
+
+class FileTaskWorkload(object):
+    app_file = "ftask-api.py"
+    ready_path = "/tasks"
+
+    def seed(self, session, base, size):
+        for start in range(0, size, SEED_CHUNK):
+            upserts = [{"taskid": task_id(i), "desc": "Task " + str(i), "dur": i} for i in range(start, min(start + SEED_CHUNK, size))]
+            check_seed(session.post(base + "/tasks/" + DATASETID, json={"upserts": upserts}))
+
+    def read(self, session, base, taskid):
+        return session.get(base + "/tasks/" + DATASETID + "/" + taskid)
+
+    def write(self, session, base, taskid, dur):
+        return session.post(base + "/tasks/" + DATASETID + "/" + taskid, json={"desc": "Task " + taskid, "dur": dur})
+
+class DatastoreTaskWorkload(object):
+    app_file = "main.py"
+    ready_path = "/taskdata"
+
+    def seed(self, session, base, size):
+        tasklist = [{"taskid": task_id(i), "desc": "Task " + str(i), "dur": str(i)} for i in range(size)]
+        check_seed(session.put(base + "/taskdata/" + DATASETID, json={"desc": "Benchmark Dataset", "tasklist": tasklist}))
+
+    def read(self, session, base, taskid):
+        return session.get(base + "/taskdata/" + DATASETID + "/" + taskid)
+
+    def write(self, session, base, taskid, dur):
+        return session.put(base + "/taskdata/" + DATASETID + "/" + taskid, json={"desc": "Task " + taskid, "dur": dur})
+
+WORKLOADS = {
+    "task": TaskWorkload(),
+    "ftask": FileTaskWorkload(),
+    "main": DatastoreTaskWorkload()
+}
+
+def task_id(i):
+    return "task" + str(i)
+
+#
+# App Server
+#
+def start_app(workload, workdir):
+    env = dict(os.environ)
+    env["FTASK_DATA_DIR"] = os.path.join(workdir, "data")
+    env["TASK_BACKEND"] = "local"
+    env["LOCAL_STORAGE_DIR"] = os.path.join(workdir, "local-storage")
+    env.pop("TASK_SNAPSHOT_FILE", None)
+    appfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), workload.app_file)
+    logfile = open(os.path.join(workdir, "server.log"), mode='wb')
+    # a new session, so the debug reloader's child is stopped with the group
+    return subprocess.Popen([sys.executable, appfile], cwd=workdir, env=env, stdout=logfile, stderr=subprocess.STDOUT, start_new_session=True)
+
+def stop_app(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        os.killpg(process.pid, signal.SIGKILL)
+
+def wait_ready(base, path):
+    deadline = time.time() + READY_TIMEOUT
+    while (time.time() < deadline):
+        try:
+            requests.get(base + path, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise BenchmarkError("Server at " + base + " did not start within " + str(READY_TIMEOUT) + "s")
+
+#
+# Load Generation
+#
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {"read": [], "write": []}
+        self.errors = {"read": 0, "write": 0}
+
+    def record(self, op, seconds, ok):
+        with self.lock:
+            self.latencies[op].append(seconds)
+            if (not ok):
+                self.errors[op] += 1
+
+def run_worker(workload, base, config, numbers, deadline, recorder, worker):
+    rnd = random.Random(config["seed"] * 1000 + worker)
+    session = requests.Session()
+    for n in numbers:
+        if (deadline is not None and time.time() >= deadline):
+            break
+        taskid = task_id(rnd.randrange(config["size"]))
+        op = "read" if rnd.random() < config["read_ratio"] else "write"
+        start = time.perf_counter()
+        try:
+            if (op == "read"):
+                response = workload.read(session, base, taskid)
+            else:
+                response = workload.write(session, base, taskid, rnd.randrange(1000))
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        if (recorder is not None):
+            recorder.record(op, time.perf_counter() - start, ok)
+
+def run_load(workload, base, config, total, duration, recorder):
+    if (duration is not None):
+        numbers = itertools.count()
+        deadline = time.time() + duration
+    else:
+        numbers = iter(range(total))
+        deadline = None
+    # one shared iterator behind a lock hands out each request number once
+    lock = threading.Lock()
+    def next_numbers():
+        while (True):
+            with lock:
+                n = next(numbers, None)
+            if (n is None):
+                return
+            yield n
+    threads = [threading.Thread(target=run_worker, args=(workload, base, config, next_numbers(), deadline, recorder, worker)) for worker in range(config["concurrency"])]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+#
+# Report
+#
+def percentile(ordered, percent):
+    if (not ordered):
+        return 0.0
+    index = max(0, int(math.ceil(percent / 100.0 * len(ordered))) - 1)
+    return ordered[index]
+
+def get_stats(latencies, errors, elapsed):
+    ordered = sorted(latencies)
+    count = len(ordered)
+    millis = 1000.0
+    return {
+        "count": count,
+        "errors": errors,
+        "throughput": round(count / elapsed, 1) if elapsed > 0 else 0.0,
+        "mean_ms": round(sum(ordered) / count * millis, 3) if count else 0.0,
+        "p50_ms": round(percentile(ordered, 50) * millis, 3),
+        "p90_ms": round(percentile(ordered, 90) * millis, 3),
+        "p99_ms": round(percentile(ordered, 99) * millis, 3),
+        "max_ms": round(ordered[-1] * millis, 3) if count else 0.0
+    }
+
+def get_results(recorder, elapsed):
+    results = {}
+    for op in ("read", "write"):
+        results[op] = get_stats(recorder.latencies[op], recorder.errors[op], elapsed)
+    results["all"] = get_stats(recorder.latencies["read"] + recorder.latencies["write"], recorder.errors["read"] + recorder.errors["write"], elapsed)
+    return results
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if (len(ordered) % 2):
+        return ordered[middle]
+    return round((ordered[middle - 1] + ordered[middle]) / 2.0, 3)
+
+# Per op, the median of each figure over the runs - count and errors are summed.
+def get_median_results(runs):
+    results = {}
+    for op in runs[0]:
+        stats = {}
+        for metric in runs[0][op]:
+            values = [run[op][metric] for run in runs]
+            if (metric in ("count", "errors")):
+                stats[metric] = sum(values)
+            else:
+                stats[metric] = median(values)
+        results[op] = stats
+    return results
+
+def print_results(results):
+    print("{:<6} {:>8} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9}".format("op", "count", "errors", "req/s", "mean ms", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for op, stats in results.items():
+        print("{:<6} {:>8} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9}".format(op, stats["count"], stats["errors"], stats["throughput"], stats["mean_ms"], stats["p50_ms"], stats["p90_ms"], stats["p99_ms"], stats["max_ms"]))
+
+# (metric, True when higher is better)
+COMPARED_METRICS = [("throughput", True), ("p50_ms", False), ("p99_ms", False)]
+
+# Print the change against the baseline and return the regressions beyond tolerance percent.
+def compare_results(baseline, results, tolerance):
+    regressions = []
+    print("\nBaseline comparison (tolerance " + str(tolerance) + "%):")
+    for op, stats in results.items():
+        base_stats = baseline.get("results", {}).get(op)
+        if (not base_stats or stats["count"] == 0):
+            continue
+        for metric, higher_is_better in COMPARED_METRICS:
+            before = base_stats.get(metric)
+            after = stats[metric]
+            if (not before):
+                continue
+            change = (after - before) / before * 100.0
+            worse = -change if higher_is_better else change
+            flag = ""
+            if (worse > tolerance):
+                flag = "  REGRESSION"
+                regressions.append(op + " " + metric)
+            print("   {:<6} {:<10} {:>10} -> {:>10}  {:+.1f}%{}".format(op, metric, before, after, change, flag))
+    return regressions
+
+def main():
+    argparser = argparse.ArgumentParser(description="Load test task-api.py, ftask-api.py or main.py")
+    argparser.add_argument("--app", choices=sorted(WORKLOADS), default="task", help="app to benchmark")
+    argparser.add_argument("--url", help="use a running server instead of starting the app, e.g. " + HOST_URL)
+    argparser.add_argument("--size", type=int, default=1000, help="tasks in the seeded dataset")
+    argparser.add_argument("--concurrency", type=int, default=4, help="client threads")
+    argparser.add_argument("--requests", type=int, default=2000, help="measured requests")
+    argparser.add_argument("--duration", type=float, help="run for this many seconds instead of --requests")
+    argparser.add_argument("--warmup", type=int, default=200, help="requests before measuring")
+    argparser.add_argument("--read-ratio", type=float, default=0.9, help="share of reads, the rest are writes")
+    argparser.add_argument("--seed", type=int, default=1, help="random seed for the request mix")
+    argparser.add_argument("--output", help="write the results to this JSON file")
+    argparser.add_argument("--baseline", help="compare with the results in this JSON file")
+    argparser.add_argument("--repeat", type=int, default=3, help="measured runs - the report has the median of each figure")
+    argparser.add_argument("--tolerance", type=float, default=25.0, help="allowed regression in percent")
+    args = argparser.parse_args()
+
+    workload = WORKLOADS[args.app]
+    config = {
+        "app": args.app,
+        "size": args.size,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "duration": args.duration,
+        "warmup": args.warmup,
+        "read_ratio": args.read_ratio,
+        "seed": args.seed,
+        "repeat": args.repeat
+    }
+    process = None
+    workdir = tempfile.TemporaryDirectory(prefix="bench-")
+    try:
+        base = args.url
+        if (base is None):
+            base = HOST_URL
+            process = start_app(workload, workdir.name)
+        wait_ready(base, workload.ready_path)
+        workload.seed(requests.Session(), base, args.size)
+        run_load(workload, base, config, args.warmup, None, None)
+        runs = []
+        elapsed = 0.0
+        for run in range(max(args.repeat, 1)):
+            recorder = Recorder()
+            run_elapsed = run_load(workload, base, config, args.requests, args.duration, recorder)
+            runs.append(get_results(recorder, run_elapsed))
+            elapsed += run_elapsed
+    except BenchmarkError as e:
+        print("Benchmark aborted: " + str(e))
+        return 1
+    finally:
+        if (process is not None):
+            stop_app(process)
+        workdir.cleanup()
+
+    results = get_median_results(runs)
+    print("Benchmark " + args.app + ":  " + json.dumps(config))
+    print_results(results)
+    output = {
+        "config": config,
+        "url": base,
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "elapsed": round(elapsed, 3),
+        "results": results,
+        "runs": runs
+    }
+    if (args.output):
+        with open(args.output, mode='wt') as outfile:
+            json.dump(output, outfile, indent=4)
+    if (args.baseline):
+        with open(args.baseline, mode='rt') as basefile:
+            baseline = json.load(basefile)
+        regressions = compare_results(baseline, results, args.tolerance)
+        if (regressions):
+            print("Regressions: " + ", ".join(regressions))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
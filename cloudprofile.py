@@ -0,0 +1,243 @@
+"""
+cloudprofile.py
+Instrumented wrappers for the datastore and storage clients used by main.py (google.cloud
+or the localstore stand-in, see backend.py).
+
+Description:
+   The wrappers delegate every call to the real client and record each RPC into the
+   profile module, so the time a request spends in Datastore / Storage can be told
+   apart from the time spent in our python code.
+
+   For each operation type (op = get, get_multi, put, put_multi, delete, delete_multi,
+   query, commit for Datastore - get_bucket, lookup_bucket, get_blob, download for Storage):
+      Clock:    ds.<op> / gcs.<op>                      RPC latency
+      Counter:  ds.<op>.rpcs / .entities / .bytes       RPCs, entities and bytes
+
+   Each RPC is also attributed to the enclosing request (see instrument.py):
+      Counter:  <METHOD>_<endpoint>.ds_rpcs / .ds_entities / .gcs_rpcs / .gcs_bytes
+
+   Dividing <request>.ds_rpcs by the request count (its clock start number) shows
+   the RPCs per request - N+1 patterns such as one put per task stand out at once.
+   Puts and deletes made inside a batch are not RPCs; they are counted on the commit.
+
+   The client libraries do not expose the size of an RPC, so Datastore bytes are measured
+   by serializing each entity again - a cost comparable to the RPC encoding itself.  They
+   are off (0) unless PROFILE_ENTITY_BYTES=1; Storage bytes are always counted.
+
+   Example:
+      client = cloudprofile.InstrumentedDatastoreClient(datastore.Client())
+      entity = client.get(key)
+
+"""
+import os
+import backend
+import profile
+import instrument
+import startup
+
+DATASTORE_PREFIX = "ds"
+STORAGE_PREFIX = "gcs"
+ENTITY_BYTES = os.environ.get("PROFILE_ENTITY_BYTES", "0") != "0"
+
+# Serialized size of an entity - the bytes sent to or received from Datastore.
+# localstore entities are not serialized and count as 0 bytes.  The datastore helpers
+# are imported on first use, so importing this module does not load the cloud libraries.
+def entity_bytes(entity):
+    if (not ENTITY_BYTES or not profile.ENABLED or entity is None or backend.is_local()):
+        return 0
+    helpers = startup.timed_import("google.cloud.datastore.helpers")
+    try:
+        pb = helpers.entity_to_protobuf(entity)
+        return type(pb).pb(pb).ByteSize()
+    except (TypeError, ValueError, AttributeError):
+        return 0
+
+def record_rpc(prefix, op, entities, nbytes):
+    if (not profile.ENABLED):
+        return
+    name = prefix + "." + op
+    profile.counter_inc(name + ".rpcs")
+    profile.counter_inc(name + ".entities", entities)
+    profile.counter_inc(name + ".bytes", nbytes)
+    request_name = instrument.get_current_request_name()
+    if (request_name is not None):
+        profile.counter_inc(request_name + "." + prefix + "_rpcs")
+        profile.counter_inc(request_name + "." + prefix + "_entities", entities)
+        profile.counter_inc(request_name + "." + prefix + "_bytes", nbytes)
+
+#
+# Datastore
+#
+class InstrumentedDatastoreClient(object):
+    def __init__(self, client):
+        self.client = client
+
+    # key(), current_batch, etc. are local - delegate them unchanged.
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def in_batch(self):
+        return self.client.current_batch is not None
+
+    def get(self, key, **kwargs):
+        with profile.clock(DATASTORE_PREFIX + ".get"):
+            entity = self.client.get(key, **kwargs)
+        record_rpc(DATASTORE_PREFIX, "get", 0 if entity is None else 1, entity_bytes(entity))
+        return entity
+
+    def get_multi(self, keys, **kwargs):
+        with profile.clock(DATASTORE_PREFIX + ".get_multi"):
+            entities = self.client.get_multi(keys, **kwargs)
+        record_rpc(DATASTORE_PREFIX, "get_multi", len(entities), sum(entity_bytes(entity) for entity in entities))
+        return entities
+
+    def put(self, entity, **kwargs):
+        if (self.in_batch()):
+            return self.client.put(entity, **kwargs)
+        with profile.clock(DATASTORE_PREFIX + ".put"):
+            result = self.client.put(entity, **kwargs)
+        record_rpc(DATASTORE_PREFIX, "put", 1, entity_bytes(entity))
+        return result
+
+    def put_multi(self, entities, **kwargs):
+        if (self.in_batch()):
+            return self.client.put_multi(entities, **kwargs)
+        entities = list(entities)
+        with profile.clock(DATASTORE_PREFIX + ".put_multi"):
+            result = self.client.put_multi(entities, **kwargs)
+        record_rpc(DATASTORE_PREFIX, "put_multi", len(entities), sum(entity_bytes(entity) for entity in entities))
+        return result
+
+    def delete(self, key, **kwargs):
+        if (self.in_batch()):
+            return self.client.delete(key, **kwargs)
+        with profile.clock(DATASTORE_PREFIX + ".delete"):
+            result = self.client.delete(key, **kwargs)
+        record_rpc(DATASTORE_PREFIX, "delete", 1, 0)
+        return result
+
+    def delete_multi(self, keys, **kwargs):
+        if (self.in_batch()):
+            return self.client.delete_multi(keys, **kwargs)
+        keys = list(keys)
+        with profile.clock(DATASTORE_PREFIX + ".delete_multi"):
+            result = self.client.delete_multi(keys, **kwargs)
+        record_rpc(DATASTORE_PREFIX, "delete_multi", len(keys), 0)
+        return result
+
+    def query(self, **kwargs):
+        return InstrumentedQuery(self.client.query(**kwargs))
+
+    def batch(self, **kwargs):
+        return InstrumentedBatch(self.client.batch(**kwargs))
+
+# Query filters and order are set on the wrapped query; fetch() times each page RPC.
+class InstrumentedQuery(object):
+    def __init__(self, query):
+        object.__setattr__(self, "query", query)
+
+    def __getattr__(self, name):
+        return getattr(self.query, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.query, name, value)
+
+    def fetch(self, *args, **kwargs):
+        iterator = self.query.fetch(*args, **kwargs)
+        pages = iter(iterator.pages)
+        while (True):
+            with profile.clock(DATASTORE_PREFIX + ".query"):
+                page = next(pages, None)
+                entities = [] if page is None else list(page)
+            if (page is None):
+                return
+            record_rpc(DATASTORE_PREFIX, "query", len(entities), sum(entity_bytes(entity) for entity in entities))
+            for entity in entities:
+                yield entity
+
+class InstrumentedBatch(object):
+    def __init__(self, batch):
+        self.batch = batch
+
+    def __getattr__(self, name):
+        return getattr(self.batch, name)
+
+    def commit(self, **kwargs):
+        mutations = len(self.batch.mutations)
+        with profile.clock(DATASTORE_PREFIX + ".commit"):
+            result = self.batch.commit(**kwargs)
+        record_rpc(DATASTORE_PREFIX, "commit", mutations, 0)
+        return result
+
+    def __enter__(self):
+        self.batch.__enter__()
+        return self
+
+    # A clean exit commits - do it through the instrumented commit, the real
+    # __exit__ then only pops the batch (or rolls back when the commit raised).
+    def __exit__(self, exc_type, exc_value, traceback):
+        if (exc_type is None and self.batch._status == self.batch._IN_PROGRESS):
+            try:
+                self.commit()
+            except Exception as exc:
+                self.batch.__exit__(type(exc), exc, exc.__traceback__)
+                raise
+        return self.batch.__exit__(exc_type, exc_value, traceback)
+
+#
+# Storage
+#
+class InstrumentedStorageClient(object):
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def get_bucket(self, bucket_or_name, **kwargs):
+        with profile.clock(STORAGE_PREFIX + ".get_bucket"):
+            bucket = self.client.get_bucket(bucket_or_name, **kwargs)
+        record_rpc(STORAGE_PREFIX, "get_bucket", 1, 0)
+        return InstrumentedBucket(bucket)
+
+    def lookup_bucket(self, bucket_name, **kwargs):
+        with profile.clock(STORAGE_PREFIX + ".lookup_bucket"):
+            bucket = self.client.lookup_bucket(bucket_name, **kwargs)
+        record_rpc(STORAGE_PREFIX, "lookup_bucket", 0 if bucket is None else 1, 0)
+        if (bucket is None):
+            return None
+        return InstrumentedBucket(bucket)
+
+class InstrumentedBucket(object):
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def __getattr__(self, name):
+        return getattr(self.bucket, name)
+
+    def get_blob(self, blob_name, **kwargs):
+        with profile.clock(STORAGE_PREFIX + ".get_blob"):
+            blob = self.bucket.get_blob(blob_name, **kwargs)
+        record_rpc(STORAGE_PREFIX, "get_blob", 0 if blob is None else 1, 0)
+        if (blob is None):
+            return None
+        return InstrumentedBlob(blob)
+
+class InstrumentedBlob(object):
+    def __init__(self, blob):
+        self.blob = blob
+
+    def __getattr__(self, name):
+        return getattr(self.blob, name)
+
+    def download_as_string(self, **kwargs):
+        with profile.clock(STORAGE_PREFIX + ".download"):
+            data = self.blob.download_as_string(**kwargs)
+        record_rpc(STORAGE_PREFIX, "download", 1, len(data))
+        return data
+
+    def download_as_bytes(self, **kwargs):
+        with profile.clock(STORAGE_PREFIX + ".download"):
+            data = self.blob.download_as_bytes(**kwargs)
+        record_rpc(STORAGE_PREFIX, "download", 1, len(data))
+        return data
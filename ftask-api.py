@@ -21,14 +21,46 @@ curl http://127.0.0.1:5000/tasks/t1/task4 -X DELETE
 // Add or Update a task
 curl http://127.0.0.1:5000/tasks/t1/task4 -X POST -v -H "Content-type: application/json" -d "{\"desc\": \"Task Number 4\", \"dur\": \"77\"}"
 
+// Tasks in a dataset with a duration between 30 and 90 (ascending) / the 5 longest tasks
+curl "http://127.0.0.1:5000/taskdur/t1?min=30&max=90" -X GET
+curl "http://127.0.0.1:5000/tasktop/t1?n=5" -X GET
+
+// Profile clocks / counters of all profiles in Prometheus text format
+curl http://127.0.0.1:5000/metrics -X GET
+
+// Bulk load - Add or Update many tasks and Delete tasks in one file rewrite (creates the dataset if needed)
+curl http://127.0.0.1:5000/tasks/t1 -X POST -v -H "Content-type: application/json" -d "{\"upserts\": [{\"taskid\": \"task5\", \"desc\": \"Task 5\", \"dur\": \"50\"}], \"deletes\": [\"task4\"]}"
+
+// Bulk load - NDJSON body, one task per line.  A line with "delete": true deletes the task.
+curl http://127.0.0.1:5000/tasks/t1 -X POST -v -H "Content-type: application/x-ndjson" --data-binary @tasks.ndjson
+
+// Data Directory
+Dataset files are stored below the data root (FTASK_DATA_DIR, defaults to the
+current working directory) in hash-sharded subdirectories, e.g. <root>/3f/a2/t1.ta,
+so no single directory grows with the number of datasets.
+
+// Migrate an existing flat layout (*.ta files in one directory) into the sharded data root
+python ftask-api.py --migrate /path/to/old/flat/dir
+Flat *.ta files directly in the data root are migrated automatically when the app starts.
+
 """
-from flask import Flask
+from flask import Flask, request
 from flask_restful import reqparse, abort, Api, Resource, fields, marshal
 import json
 import os
+import hashlib
+import glob
+import shutil
+import argparse
+import bisect
+import collections
+import threading
+import tempfile
+import instrument
 
 app = Flask(__name__)
 api = Api(app)
+instrument.instrument_app(app)
 
 MESSAGE_SUCCESS = {"message": "success"}
 
@@ -73,6 +105,14 @@ def task_exists(id, taskdict):
     else:
         return False
 
+# Task durations are stored as integer strings - returns the canonical form of dur, or None
+# when it is not an integer.
+def get_dur_field(dur):
+    try:
+        return str(int(str(dur)))
+    except ValueError:
+        return None
+
 def create_new_task(taskdict, did, tid, tdesc, tdur):
     if tid in taskdict:
         abort(400, message="Task {} already exists".format(id))
@@ -80,6 +120,67 @@ def create_new_task(taskdict, did, tid, tdesc, tdur):
     taskdict[ta.taskid] = ta
     return ta
 
+# Bulk operations from a JSON body:  {"upserts": [{"taskid", "desc", "dur"}, ...], "deletes": [taskid, ...]}
+# or an NDJSON body with one task object per line ("delete": true marks a delete).
+# Returns two lists:  upserts (task dicts) and deletes (taskids).
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonlines')
+
+def parse_bulk_body(content_type, body):
+    upserts = []
+    deletes = []
+    if (content_type in NDJSON_CONTENT_TYPES):
+        for line in body.splitlines():
+            if (not line.strip()):
+                continue
+            tdict = json.loads(line)
+            if (tdict.get('delete')):
+                deletes.append(tdict['taskid'])
+            else:
+                upserts.append(tdict)
+    else:
+        bdict = json.loads(body)
+        upserts = bdict.get('upserts', [])
+        deletes = bdict.get('deletes', [])
+    return upserts, deletes
+
+# Checks all bulk operations before anything is applied - returns an error message or None.
+# Task fields are written as delimited lines, so they must not contain FDELIMITER or NEWLINE.
+def check_bulk(upserts, deletes):
+    if (not isinstance(upserts, list) or not isinstance(deletes, list)):
+        return "upserts and deletes must be lists"
+    for tdict in upserts:
+        if (not isinstance(tdict, dict) or 'taskid' not in tdict or 'desc' not in tdict or 'dur' not in tdict):
+            return "Each upserted task requires taskid, desc and dur"
+        taskid = tdict['taskid']
+        if (not isinstance(taskid, str) or not taskid):
+            return "taskid must be a non-empty string:  {}".format(json.dumps(taskid))
+        for value in (taskid, str(tdict['desc'])):
+            if (FDELIMITER in value or NEWLINE in value):
+                return "Task {} fields must not contain '{}' or newlines".format(taskid, FDELIMITER)
+        if (get_dur_field(tdict['dur']) is None):
+            return "Task {} duration is not an integer:  {}".format(taskid, json.dumps(tdict['dur']))
+    for taskid in deletes:
+        if (not isinstance(taskid, str) or not taskid):
+            return "Deleted taskids must be non-empty strings:  {}".format(json.dumps(taskid))
+    return None
+
+# Applies the bulk operations to the in-memory taskdict.  Deletes of missing tasks are ignored.
+def apply_bulk(taskdict, datasetid, upserts, deletes):
+    for tdict in upserts:
+        taskid = tdict['taskid']
+        if (task_exists(taskid, taskdict)):
+            task = get_task(taskid, taskdict)
+            task.desc = str(tdict['desc'])
+            task.dur = get_dur_field(tdict['dur'])
+        else:
+            create_new_task(taskdict, datasetid, taskid, str(tdict['desc']), get_dur_field(tdict['dur']))
+    deleted = 0
+    for taskid in deletes:
+        if (task_exists(taskid, taskdict)):
+            remove_task(get_task(taskid, taskdict), taskdict)
+            deleted += 1
+    return deleted
+
 #
 # FILE MODULE
 #
@@ -88,22 +189,41 @@ FEXTENSION = ".ta"
 FDELIMITER = ","
 NEWLINE = "\n"
 
+# Data root and shard layout:  <DATA_DIR>/<hh>/<hh>/<datasetid>.ta
+# The shard names come from an md5 of the datasetid, so resolving a dataset path is O(1).
+DATA_DIR = os.environ.get("FTASK_DATA_DIR", os.getcwd())
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
 file_fields = {
     'dataset': fields.String
 }
 
+def get_shard_dirs(datasetid):
+    digest = hashlib.md5(datasetid.encode('utf8')).hexdigest()
+    dirs = []
+    for level in range(SHARD_LEVELS):
+        dirs.append(digest[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH])
+    return dirs
+
+def get_task_filename(datasetid):
+    return os.path.join(DATA_DIR, *get_shard_dirs(datasetid), datasetid + FEXTENSION)
+
+def make_task_file_dirs(filename):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
 def file_exists(filename):
     if (os.path.isfile(filename)):
         return True
     else:
         return False
 
+# Globs the shard directories - only used for the dataset listing.
 def get_task_filenames():
     nlist = []
-    cdir = os.getcwd()
-    for fname in os.listdir(cdir):
-        if fname.endswith(FEXTENSION):
-            nlist.append(fname)
+    pattern = os.path.join(DATA_DIR, *(["?" * SHARD_WIDTH] * SHARD_LEVELS), "*" + FEXTENSION)
+    for fname in glob.glob(pattern):
+        nlist.append(os.path.basename(fname))
     return nlist
 
 def get_file_list():
@@ -115,9 +235,47 @@ def get_file_list():
         fList.append(filedict)
     return fList
 
+# Moves flat *.ta files from srcdir into the sharded layout below DATA_DIR.
+# Returns the number of migrated files and the files skipped because their sharded
+# file exists - existing sharded files are never overwritten.
+def migrate_flat_files(srcdir):
+    migrated = 0
+    skipped = []
+    for fname in os.listdir(srcdir):
+        srcname = os.path.join(srcdir, fname)
+        if (not fname.endswith(FEXTENSION) or not os.path.isfile(srcname)):
+            continue
+        datasetid = fname[:-len(FEXTENSION)]
+        dstname = get_task_filename(datasetid)
+        if (file_exists(dstname)):
+            skipped.append(srcname)
+            continue
+        make_task_file_dirs(dstname)
+        try:
+            shutil.move(srcname, dstname)
+        except FileNotFoundError:
+            # moved meanwhile by another worker process starting up
+            continue
+        migrated += 1
+    return migrated, skipped
+
+def print_migration(migrated, skipped):
+    print("Migrated " + str(migrated) + " dataset files into " + DATA_DIR)
+    for srcname in skipped:
+        print("Skipped (already migrated): " + srcname)
+
+# Flat datasets left directly in DATA_DIR (the layout before sharding) are migrated when
+# the app starts, so they never drop out of the endpoints.
+def migrate_data_dir():
+    if (not os.path.isdir(DATA_DIR)):
+        return
+    migrated, skipped = migrate_flat_files(DATA_DIR)
+    if (migrated or skipped):
+        print_migration(migrated, skipped)
+
 # Assumes each line represents a task in this form:  taskid, taskdesc, taskduration
 def load_task_file(datasetid, taskdict):
-    filename = datasetid + FEXTENSION
+    filename = get_task_filename(datasetid)
     if (os.path.isfile(filename)):
         with open(filename, mode='rt') as filestream:
             for line in filestream:
@@ -125,16 +283,115 @@ def load_task_file(datasetid, taskdict):
                 larray = lstr.split(FDELIMITER)
                 create_new_task(taskdict, datasetid, larray[0], larray[1], larray[2])
 
+# mkstemp creates files readable by the owner only - dataset files get the usual
+# permissions of a new file instead (0666 less the umask).
+UMASK = os.umask(0)
+os.umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK
+
+# Write count per dataset file in this process - part of the duration index stamp, since
+# mtime and size alone can miss a rewrite on filesystems with coarse timestamps.
+FILE_VERSIONS = {}
+FILE_VERSIONS_LOCK = threading.Lock()
+
+def get_file_version(filename):
+    with FILE_VERSIONS_LOCK:
+        return FILE_VERSIONS.get(filename, 0)
+
+def bump_file_version(filename):
+    with FILE_VERSIONS_LOCK:
+        FILE_VERSIONS[filename] = FILE_VERSIONS.get(filename, 0) + 1
+
 # Writes out task lines in this form:  taskid, taskdesc, taskduration
+# The lines go to a temporary file that then replaces the dataset file, so a failed write
+# never leaves a truncated dataset behind.
 def write_task_file(filename, taskdict):
-    with open(filename, mode='wt') as filestream:
-        for task in taskdict.values():
-            filestream.write(task.taskid)
-            filestream.write(FDELIMITER)
-            filestream.write(task.desc)
-            filestream.write(FDELIMITER)
-            filestream.write(task.dur)
-            filestream.write(NEWLINE)
+    fd, tmpname = tempfile.mkstemp(prefix=os.path.basename(filename) + ".", suffix=".tmp", dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(fd, mode='wt') as filestream:
+            for task in taskdict.values():
+                filestream.write(task.taskid)
+                filestream.write(FDELIMITER)
+                filestream.write(task.desc)
+                filestream.write(FDELIMITER)
+                filestream.write(task.dur)
+                filestream.write(NEWLINE)
+        os.chmod(tmpname, FILE_MODE)
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.remove(tmpname)
+        raise
+    finally:
+        bump_file_version(filename)
+
+#
+# DURATION INDEX MODULE
+#
+# Per-dataset index of tasks sorted by duration, cached in memory and rebuilt only when the
+# dataset file changes (write count in this process, inode/mtime/size for other writers).
+# Range and top-N queries are then bisects plus a slice, O(log n + k), instead of a file scan.
+# Writes reject durs that are not integers (get_dur_field); lines of older or hand-edited
+# files whose dur is not an integer are left out of the index.
+DUR_INDEX_MAX_DATASETS = 64
+DUR_INDEX_CACHE = collections.OrderedDict()
+DUR_INDEX_LOCK = threading.Lock()
+
+durparser = reqparse.RequestParser()
+durparser.add_argument('min', type=int, location='args')
+durparser.add_argument('max', type=int, location='args')
+durparser.add_argument('n', type=int, location='args', default=10)
+
+def get_int_dur(task):
+    try:
+        return int(task.dur)
+    except (TypeError, ValueError):
+        return None
+
+class DurationIndex(object):
+    def __init__(self, stamp, tasks):
+        self.stamp = stamp
+        pairs = []
+        for task in tasks:
+            dur = get_int_dur(task)
+            if (dur is not None):
+                pairs.append((dur, task))
+        pairs.sort(key=lambda pair: pair[0])
+        self.durs = [pair[0] for pair in pairs]
+        self.tasks = [pair[1] for pair in pairs]
+
+    # Tasks with mindur <= dur <= maxdur in ascending duration order.  None means unbounded.
+    def range(self, mindur, maxdur):
+        lo = 0 if mindur is None else bisect.bisect_left(self.durs, mindur)
+        hi = len(self.durs) if maxdur is None else bisect.bisect_right(self.durs, maxdur)
+        return self.tasks[lo:hi]
+
+    # The n longest tasks, longest first.
+    def top(self, n):
+        if (n <= 0):
+            return []
+        return self.tasks[:-n - 1:-1]
+
+def get_file_stamp(filename):
+    version = get_file_version(filename)
+    fstat = os.stat(filename)
+    return (version, fstat.st_ino, fstat.st_mtime_ns, fstat.st_size)
+
+def get_dur_index(datasetid):
+    stamp = get_file_stamp(get_task_filename(datasetid))
+    with DUR_INDEX_LOCK:
+        index = DUR_INDEX_CACHE.get(datasetid)
+        if (index is not None and index.stamp == stamp):
+            DUR_INDEX_CACHE.move_to_end(datasetid)
+            return index
+    taskdict = {}
+    load_task_file(datasetid, taskdict)
+    index = DurationIndex(stamp, taskdict.values())
+    with DUR_INDEX_LOCK:
+        DUR_INDEX_CACHE[datasetid] = index
+        DUR_INDEX_CACHE.move_to_end(datasetid)
+        while (len(DUR_INDEX_CACHE) > DUR_INDEX_MAX_DATASETS):
+            DUR_INDEX_CACHE.popitem(last=False)
+    return index
 
 #
 # REST MODULES
@@ -149,9 +406,9 @@ class TaskApi(Resource):
         # get values and check for dataset existence
         datasetid = kwargs["datasetid"]
         taskid = kwargs["taskid"]
-        fname = datasetid + FEXTENSION
+        fname = get_task_filename(datasetid)
         if (not file_exists(fname)):
-            abort(404, message="Tasks Dataset {} does not exist".format(fname))
+            abort(404, message="Tasks Dataset {} does not exist".format(datasetid + FEXTENSION))
 
         # Get Task data and check for task existence
         taskdict = {}
@@ -168,9 +425,9 @@ class TaskApi(Resource):
         # get values and check for dataset existence
         datasetid = kwargs["datasetid"]
         taskid = kwargs["taskid"]
-        fname = datasetid + FEXTENSION
+        fname = get_task_filename(datasetid)
         if (not file_exists(fname)):
-            abort(404, message="Tasks Dataset {} does not exist".format(fname))
+            abort(404, message="Tasks Dataset {} does not exist".format(datasetid + FEXTENSION))
 
         # Get Task data and check for task existence
         taskdict = {}
@@ -189,12 +446,14 @@ class TaskApi(Resource):
         # get values and check for dataset existence
         args = parser.parse_args()
         taskdesc = args['desc']
-        taskdur = args['dur']
+        taskdur = get_dur_field(args['dur'])
         datasetid = kwargs["datasetid"]
         taskid = kwargs["taskid"]
-        fname = datasetid + FEXTENSION
+        if (taskdur is None):
+            abort(400, message="Task duration {} is not an integer".format(args['dur']))
+        fname = get_task_filename(datasetid)
         if (not file_exists(fname)):
-            abort(404, message="Tasks Dataset {} does not exist".format(fname))
+            abort(404, message="Tasks Dataset {} does not exist".format(datasetid + FEXTENSION))
 
         # Get Task data
         taskdict = {}
@@ -214,27 +473,81 @@ class TaskApi(Resource):
         return MESSAGE_SUCCESS, 200
 
 # TaskListApi
-# GET - Get all tasks by dataset
+# GET  - Get all tasks by dataset
+# POST - Bulk Add/Update/Delete tasks (JSON or NDJSON body)
 class TaskListApi(Resource):
     def get(self, **kwargs):
         datasetid = kwargs["datasetid"]
-        fname = datasetid + FEXTENSION
+        fname = get_task_filename(datasetid)
         if (not file_exists(fname)):
-            abort(404, message="Tasks Dataset {} does not exist".format(fname))
+            abort(404, message="Tasks Dataset {} does not exist".format(datasetid + FEXTENSION))
         taskdict = {}
         load_task_file(datasetid, taskdict)
         tasklist = get_dict_values_as_list(taskdict)
         return marshal(tasklist, task_fields), 200
 
+    # Bulk Add/Update/Delete - a single load / modify / write cycle for the whole request.
+    def post(self, **kwargs):
+        datasetid = kwargs["datasetid"]
+        try:
+            upserts, deletes = parse_bulk_body(request.mimetype, request.get_data(as_text=True))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            abort(400, message="Invalid bulk request body")
+        message = check_bulk(upserts, deletes)
+        if (message):
+            abort(400, message=message)
+
+        fname = get_task_filename(datasetid)
+        taskdict = {}
+        load_task_file(datasetid, taskdict)
+        deleted = apply_bulk(taskdict, datasetid, upserts, deletes)
+
+        make_task_file_dirs(fname)
+        write_task_file(fname, taskdict)
+        return {"message": "success", "upserted": len(upserts), "deleted": deleted}, 200
+
 # GET - List the task dataset names
 class TaskDatasetsApi(Resource):
     def get(self, **kwargs):
         return marshal(get_file_list(), file_fields), 200
 
+# GET - Tasks in a dataset with min <= dur <= max, shortest first (either bound may be omitted)
+class TaskDurationApi(Resource):
+    def get(self, **kwargs):
+        datasetid = kwargs["datasetid"]
+        if (not file_exists(get_task_filename(datasetid))):
+            abort(404, message="Tasks Dataset {} does not exist".format(datasetid + FEXTENSION))
+        args = durparser.parse_args()
+        tasklist = get_dur_index(datasetid).range(args['min'], args['max'])
+        return marshal(tasklist, task_fields), 200
+
+# GET - The n longest tasks in a dataset, longest first
+class TaskTopApi(Resource):
+    def get(self, **kwargs):
+        datasetid = kwargs["datasetid"]
+        if (not file_exists(get_task_filename(datasetid))):
+            abort(404, message="Tasks Dataset {} does not exist".format(datasetid + FEXTENSION))
+        args = durparser.parse_args()
+        tasklist = get_dur_index(datasetid).top(args['n'])
+        return marshal(tasklist, task_fields), 200
+
 ## Api resource routing
 api.add_resource(TaskDatasetsApi, '/tasks', endpoint='tasks_ep')
 api.add_resource(TaskListApi, '/tasks/<datasetid>', endpoint='tasklist_ep')
 api.add_resource(TaskApi, '/tasks/<datasetid>/<taskid>', endpoint='task_ep')
+api.add_resource(TaskDurationApi, '/taskdur/<datasetid>', endpoint='taskdur_ep')
+api.add_resource(TaskTopApi, '/tasktop/<datasetid>', endpoint='tasktop_ep')
+
+## Move flat datasets of the data root into their shards (served by a WSGI server)
+if (__name__ != '__main__'):
+    migrate_data_dir()
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--migrate', metavar='FLATDIR', help='move flat *.ta files from FLATDIR into the sharded data root and exit')
+    cmdargs = argparser.parse_args()
+    if (cmdargs.migrate):
+        print_migration(*migrate_flat_files(cmdargs.migrate))
+    else:
+        migrate_data_dir()
+        app.run(debug=True)
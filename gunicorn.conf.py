@@ -0,0 +1,64 @@
+"""
+gunicorn.conf.py
+gunicorn settings for the task apps (see wsgi.py) - every setting can be overridden
+from the environment.
+
+Description:
+   bind                 0.0.0.0:$PORT (App Engine and Cloud Run set PORT, default 8080)
+   workers              WEB_CONCURRENCY, default 2 * CPUs + 1 for main.py and 1 for the
+                        in-memory / file backed apps and TASK_BACKEND=local, whose state
+                        is per process
+   threads              GUNICORN_THREADS (default 8) per worker - gthread workers, so a
+                        request waiting for Datastore only holds one thread
+   keepalive            GUNICORN_KEEPALIVE seconds (default 75) - longer than the idle
+                        timeout of the load balancer in front, so it can reuse connections
+   preload_app          the app is imported once in the master, before the fork
+   timeout              GUNICORN_TIMEOUT (default 60) seconds before a stuck worker is killed
+   graceful_timeout     GUNICORN_GRACEFUL_TIMEOUT (default 30) - on SIGTERM workers finish
+                        their requests in flight for up to this long before they are killed
+
+   Each worker calls wsgi.start_worker() after the fork, which starts task-api.py's
+   snapshot load and writer when TASK_SNAPSHOT_FILE is set.  A snapshot file belongs to
+   one process, so it requires a single worker.
+
+   With several workers, set PROFILE_SHARED_DIR so /profile and /metrics cover all of
+   them (see profileshare.py).
+
+   Example:
+      gunicorn -c gunicorn.conf.py wsgi:app
+      WEB_CONCURRENCY=4 GUNICORN_THREADS=16 gunicorn -c gunicorn.conf.py wsgi:app
+
+"""
+import os
+import multiprocessing
+
+# Apps that keep their tasks in the process - more workers would each see other tasks.
+PER_PROCESS_APPS = ("task-api.py", "d-task-api.py", "ftask-api.py")
+
+def get_default_workers():
+    if (os.environ.get("APP_MODULE", "main.py") in PER_PROCESS_APPS or os.environ.get("TASK_BACKEND") == "local"):
+        return 1
+    return multiprocessing.cpu_count() * 2 + 1
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "8080")
+workers = int(os.environ.get("WEB_CONCURRENCY", get_default_workers()))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "75"))
+preload_app = True
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+accesslog = "-"
+
+if (os.environ.get("TASK_SNAPSHOT_FILE") and workers != 1):
+    raise ValueError("TASK_SNAPSHOT_FILE requires a single worker - set WEB_CONCURRENCY=1")
+
+# Starts the app's per-process background work (task-api.py snapshots) in the worker.
+def post_fork(server, worker):
+    import wsgi
+    wsgi.start_worker()
+
+# Workers write their last profile dump before they exit (no-op without PROFILE_SHARED_DIR).
+def worker_exit(server, worker):
+    import profileshare
+    profileshare.write_final_dump()
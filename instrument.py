@@ -0,0 +1,201 @@
+"""
+instrument.py
+Automatic per-endpoint request instrumentation for the Flask apps in this repository
+(main.py, task-api.py, ftask-api.py).
+
+Description:
+   instrument_app(app) hooks the request lifecycle of a Flask app and records every
+   request into the profile module - no hand-written clock names are needed.
+
+   For each request, with name = <METHOD>_<endpoint> (e.g. GET_task_ep):
+      Clock:    name                          latency (with histogram / percentiles)
+      Counter:  name.status_<code>            responses by status code
+      Counter:  name.request_bytes            request body bytes
+      Counter:  name.response_bytes           response body bytes (when the length is known)
+
+   Requests that match no route are recorded as <METHOD>_unmatched.
+
+   Each request is also recorded as a trace of its nested clock spans (see the TRACE API
+   in profile.py) - the request clock is the root span.
+
+   While the sampling profiler runs (see sampler.py), each request thread is tagged with
+   its name so the sampled stacks are grouped per endpoint.
+
+   instrument_app also registers GET /metrics (see metrics.py), which is not itself
+   instrumented so scrapes do not show up in the profile.
+
+   With RECORD_FILE set, every request is also appended to that file as one JSON line
+   for replay.py (the /metrics scrapes are not recorded):
+      {"time": <epoch seconds>, "name": "<METHOD>_<endpoint>", "method": "PUT",
+       "path": "/tasks/t1/task4?x=1", "content_type": "application/json", "body": "...",
+       "status": 200, "elapsed_ms": 3.1}
+   Requests are recorded when they end, so the ones that raised are recorded too (status
+   500).  Bodies longer than RECORD_MAX_BODY bytes (default 65536, 0 = no bodies) are not
+   read nor recorded (body is null).  RECORD_REDACT=password,token replaces the values of
+   those fields - in JSON bodies, at any depth, and in the query string - with "REDACTED";
+   a body that is not JSON is then not recorded.
+
+   Example:
+      app = Flask(__name__)
+      instrument.instrument_app(app)
+
+"""
+from flask import g, request, has_request_context
+import os
+import json
+import time
+import threading
+from urllib.parse import urlencode
+import profile
+import metrics
+import sampler
+import profileshare
+
+UNMATCHED_ENDPOINT = "unmatched"
+RECORD_FILE = os.environ.get("RECORD_FILE")
+RECORD_MAX_BODY = int(os.environ.get("RECORD_MAX_BODY", "65536"))
+RECORD_REDACT = frozenset(field for field in os.environ.get("RECORD_REDACT", "").split(",") if field)
+REDACTED = "REDACTED"
+
+def get_request_name():
+    endpoint = request.endpoint
+    if (endpoint is None):
+        endpoint = UNMATCHED_ENDPOINT
+    return request.method + "_" + endpoint
+
+# Name of the instrumented request being served, None outside of a request.
+def get_current_request_name():
+    if (not has_request_context()):
+        return None
+    return g.get('profile_request_name')
+
+#
+# Request Hooks
+#
+class RequestInstrumentation(object):
+    def __init__(self, profile_id=None, exclude_endpoints=()):
+        self.profile_id = profile_id
+        self.exclude_endpoints = frozenset(exclude_endpoints)
+
+    def before_request(self):
+        if (request.endpoint in self.exclude_endpoints):
+            return
+        if (sampler.RUNNING):
+            sampler.tag_thread(get_request_name())
+        if (not profile.ENABLED):
+            return
+        name = get_request_name()
+        g.profile_request_name = name
+        g.profile_request_status = None
+        profile.trace_begin(name, self.profile_id)
+        profile.clock_start(name, self.profile_id)
+        profile.counter_inc(name + ".request_bytes", request.content_length or 0, self.profile_id)
+
+    def after_request(self, response):
+        name = g.get('profile_request_name')
+        if (name is not None):
+            g.profile_request_status = response.status_code
+            length = response.calculate_content_length()
+            if (length is not None):
+                profile.counter_inc(name + ".response_bytes", length, self.profile_id)
+        return response
+
+    # Runs for every request, also when the view raised - unhandled errors count as 500.
+    # Spans and chain links still open in the thread are dropped (see profile.reset_context).
+    def teardown_request(self, exc):
+        sampler.untag_thread()
+        name = g.get('profile_request_name')
+        if (name is not None):
+            profile.clock_stop(name, self.profile_id)
+            profile.trace_end()
+            status = g.get('profile_request_status')
+            if (status is None):
+                status = 500
+            profile.counter_inc(name + ".status_" + str(status), 1, self.profile_id)
+            g.profile_request_name = None
+        profile.reset_context()
+
+#
+# Request Recorder
+#
+# Appends one JSON line per request - the lock keeps lines from concurrent requests whole.
+class RequestRecorder(object):
+    def __init__(self, filename, exclude_endpoints=(), max_body=RECORD_MAX_BODY, redact=RECORD_REDACT):
+        self.exclude_endpoints = frozenset(exclude_endpoints)
+        self.max_body = max_body
+        self.redact = frozenset(redact)
+        self.lock = threading.Lock()
+        self.recordfile = open(filename, mode='at', buffering=1)
+
+    def before_request(self):
+        g.record_start = time.perf_counter()
+        g.record_status = None
+
+    def after_request(self, response):
+        g.record_status = response.status_code
+        return response
+
+    def redact_value(self, value):
+        if (isinstance(value, dict)):
+            return {key: REDACTED if key in self.redact else self.redact_value(item) for key, item in value.items()}
+        if (isinstance(value, list)):
+            return [self.redact_value(item) for item in value]
+        return value
+
+    def redact_path(self):
+        if (not self.redact.intersection(request.args.keys())):
+            return request.full_path.rstrip("?")
+        args = [(key, REDACTED if key in self.redact else value) for key, value in request.args.items(multi=True)]
+        return request.path + "?" + urlencode(args)
+
+    # The request body as recorded - None when it is too long, or not JSON while redacting.
+    def get_body(self):
+        if ((request.content_length or 0) > self.max_body):
+            return None
+        body = request.get_data(cache=True, as_text=True)
+        if (len(body) > self.max_body):
+            return None
+        if (not self.redact or not body):
+            return body
+        try:
+            return json.dumps(self.redact_value(json.loads(body)))
+        except ValueError:
+            return None
+
+    # Runs for every request, also when the view raised - unhandled errors count as 500.
+    def teardown_request(self, exc):
+        start = g.get('record_start')
+        if (start is None or request.endpoint in self.exclude_endpoints):
+            return
+        elapsed_ms = round((time.perf_counter() - start) * 1000.0, 3)
+        status = g.get('record_status')
+        if (status is None):
+            status = 500
+        record = {
+            "time": time.time(),
+            "name": get_request_name(),
+            "method": request.method,
+            "path": self.redact_path(),
+            "content_type": request.content_type,
+            "body": self.get_body(),
+            "status": status,
+            "elapsed_ms": elapsed_ms
+        }
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.recordfile.write(line)
+
+def instrument_app(app, profile_id=None, exclude_endpoints=()):
+    profileshare.start()
+    metrics.register_metrics(app)
+    exclude_endpoints = tuple(exclude_endpoints) + (metrics.METRICS_ENDPOINT,)
+    hooks = RequestInstrumentation(profile_id, exclude_endpoints)
+    app.before_request(hooks.before_request)
+    app.after_request(hooks.after_request)
+    app.teardown_request(hooks.teardown_request)
+    if (RECORD_FILE):
+        recorder = RequestRecorder(RECORD_FILE, exclude_endpoints)
+        app.before_request(recorder.before_request)
+        app.after_request(recorder.after_request)
+        app.teardown_request(recorder.teardown_request)
+    return hooks
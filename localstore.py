@@ -0,0 +1,524 @@
+"""
+localstore.py
+In-process stand-in for the google.cloud datastore and storage clients used by main.py.
+
+Description:
+   Selected with TASK_BACKEND=local (see backend.py), so main.py can be run, tested and
+   benchmarked with no network and no credentials.  Only the subset of the client APIs
+   that main.py uses is implemented, with the same semantics:
+
+   Datastore (Client):
+      key(kind, id_or_name, ..., parent=None)      complete and partial keys
+      get / get_multi / put / put_multi / delete / delete_multi
+      query(kind=, ancestor=)                      add_filter(property, op, value), order, fetch(limit, offset)
+      batch()                                      begin / put / delete / commit / rollback, with-block
+      current_batch                                puts and deletes inside "with client.batch()" are batched
+
+   Entities are copied on put and get, so - as with Datastore - an entity changed after
+   put is not changed in the store.  Properties in exclude_from_indexes cannot be
+   filtered or ordered on, and entities without a property do not match a query on it.
+   Queries without an order return entities in key order.
+
+   Storage (StorageClient):  buckets are sub-directories of LOCAL_STORAGE_DIR (default
+   ./local-storage) and blobs are files in them.
+      get_bucket / lookup_bucket / create_bucket, bucket.get_blob / blob
+      blob.size, download_as_bytes(start, end) / download_as_string (end is inclusive),
+      upload_from_string
+
+   Bucket and blob names are single path components - names with a path separator, "."
+   and ".." are rejected with ValueError, so no name resolves outside LOCAL_STORAGE_DIR.
+
+   The datastore state is shared by all clients of a process and lost when it exits.
+
+   Example:
+      client = localstore.Client()
+      entity = localstore.Entity(client.key('Dataset', 't1'), exclude_from_indexes=['desc'])
+      entity.update({'desc': 'Test'})
+      client.put(entity)
+
+"""
+import os
+import threading
+import itertools
+import datetime
+
+#
+# Keys and Entities
+#
+class Key(object):
+    def __init__(self, *path_args, parent=None, project=None, namespace=None):
+        path = list(path_args)
+        if (parent is not None):
+            path = list(parent.flat_path) + path
+            project = parent.project
+            namespace = parent.namespace
+        if (len(path) == 0):
+            raise ValueError("A key needs at least one kind")
+        for index in range(0, len(path) - 1, 2):
+            if (not isinstance(path[index], str)):
+                raise ValueError("Key kind must be a string: " + repr(path[index]))
+        self.flat_path = tuple(path)
+        self.project = project
+        self.namespace = namespace
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and self.flat_path == other.flat_path and self.namespace == other.namespace
+
+    def __hash__(self):
+        return hash((self.flat_path, self.namespace))
+
+    def __repr__(self):
+        return "<Key " + repr(list(self.flat_path)) + ">"
+
+    @property
+    def is_partial(self):
+        return len(self.flat_path) % 2 == 1
+
+    @property
+    def kind(self):
+        if (self.is_partial):
+            return self.flat_path[-1]
+        return self.flat_path[-2]
+
+    @property
+    def id_or_name(self):
+        if (self.is_partial):
+            return None
+        return self.flat_path[-1]
+
+    @property
+    def id(self):
+        value = self.id_or_name
+        return value if isinstance(value, int) else None
+
+    @property
+    def name(self):
+        value = self.id_or_name
+        return value if isinstance(value, str) else None
+
+    @property
+    def parent(self):
+        size = len(self.flat_path) - (1 if self.is_partial else 2)
+        if (size <= 0):
+            return None
+        return Key(*self.flat_path[:size], project=self.project, namespace=self.namespace)
+
+    @property
+    def path(self):
+        path = []
+        for index in range(0, len(self.flat_path), 2):
+            element = {'kind': self.flat_path[index]}
+            if (index + 1 < len(self.flat_path)):
+                value = self.flat_path[index + 1]
+                element['id' if isinstance(value, int) else 'name'] = value
+            path.append(element)
+        return path
+
+    def completed_key(self, id_or_name):
+        if (not self.is_partial):
+            raise ValueError("Only a partial key can be completed")
+        return Key(*(self.flat_path + (id_or_name,)), project=self.project, namespace=self.namespace)
+
+class Entity(dict):
+    def __init__(self, key=None, exclude_from_indexes=()):
+        dict.__init__(self)
+        self.key = key
+        self.exclude_from_indexes = set(exclude_from_indexes)
+
+    @property
+    def kind(self):
+        return None if self.key is None else self.key.kind
+
+    def __repr__(self):
+        return "<Entity " + repr(self.key) + " " + dict.__repr__(self) + ">"
+
+def copy_entity(entity, key=None):
+    copy = Entity(key if key is not None else entity.key, entity.exclude_from_indexes)
+    copy.update(entity)
+    return copy
+
+# Datastore orders ids before names - keep ints and strings comparable.
+def key_order(key):
+    return tuple((0, value, "") if isinstance(value, int) else (1, 0, str(value)) for value in key.flat_path)
+
+# Datastore orders values of different types by type.
+TYPE_ORDER = [(type(None), 0), (bool, 1), (int, 2), (float, 2), (datetime.datetime, 3), (bytes, 4), (str, 5)]
+
+def value_order(value):
+    for value_type, rank in TYPE_ORDER:
+        if (isinstance(value, value_type)):
+            if (value_type is datetime.datetime and value.tzinfo is not None):
+                value = value.replace(tzinfo=None) - value.utcoffset()
+            return (rank, value)
+    return (len(TYPE_ORDER), repr(value))
+
+#
+# Datastore State
+#
+# Entities by key path, with a kind index and an ancestor index (every proper prefix of
+# a complete key path) so ancestor queries only read the descendants of the ancestor.
+class Store(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entities = {}
+        self.kinds = {}
+        self.descendants = {}
+        self.ids = itertools.count(1)
+
+    def ancestor_paths(self, path):
+        return [path[:size] for size in range(2, len(path), 2)]
+
+    def get(self, key):
+        entity = self.entities.get(key.flat_path)
+        if (entity is None):
+            return None
+        return copy_entity(entity)
+
+    # Called with the lock held - entity is the batch's private copy.
+    def put(self, entity):
+        path = entity.key.flat_path
+        if (path not in self.entities):
+            self.kinds.setdefault(entity.key.kind, set()).add(path)
+            for ancestor in self.ancestor_paths(path):
+                self.descendants.setdefault(ancestor, set()).add(path)
+        self.entities[path] = entity
+
+    # Called with the lock held.
+    def delete(self, key):
+        path = key.flat_path
+        if (self.entities.pop(path, None) is None):
+            return
+        self.kinds[key.kind].discard(path)
+        for ancestor in self.ancestor_paths(path):
+            self.descendants[ancestor].discard(path)
+
+    def apply(self, mutations):
+        with self.lock:
+            for operation, value in mutations:
+                if (operation == "put"):
+                    self.put(value)
+                else:
+                    self.delete(value)
+
+    def allocate_id(self):
+        return next(self.ids)
+
+    def candidates(self, kind, ancestor):
+        with self.lock:
+            if (ancestor is not None):
+                paths = set(self.descendants.get(ancestor.flat_path, ()))
+                paths.add(ancestor.flat_path)
+                if (kind is not None):
+                    paths = [path for path in paths if path[-2] == kind]
+            elif (kind is not None):
+                paths = list(self.kinds.get(kind, ()))
+            else:
+                paths = list(self.entities)
+            return [self.entities[path] for path in paths if path in self.entities]
+
+    def clear(self):
+        with self.lock:
+            self.entities = {}
+            self.kinds = {}
+            self.descendants = {}
+
+STORE = Store()
+
+#
+# Datastore Client
+#
+class Client(object):
+    def __init__(self, project=None, namespace=None, **kwargs):
+        self.project = project or "local"
+        self.namespace = namespace
+        self.batches = threading.local()
+
+    def key(self, *path_args, **kwargs):
+        kwargs.setdefault('project', self.project)
+        kwargs.setdefault('namespace', self.namespace)
+        return Key(*path_args, **kwargs)
+
+    def get_batch_stack(self):
+        stack = getattr(self.batches, "stack", None)
+        if (stack is None):
+            stack = []
+            self.batches.stack = stack
+        return stack
+
+    @property
+    def current_batch(self):
+        stack = self.get_batch_stack()
+        return stack[-1] if stack else None
+
+    def get(self, key, **kwargs):
+        return STORE.get(key)
+
+    def get_multi(self, keys, missing=None, deferred=None, **kwargs):
+        entities = []
+        for key in keys:
+            entity = STORE.get(key)
+            if (entity is not None):
+                entities.append(entity)
+            elif (missing is not None):
+                missing.append(Entity(key))
+        return entities
+
+    def put(self, entity, **kwargs):
+        self.put_multi([entity])
+
+    def put_multi(self, entities, **kwargs):
+        current = self.current_batch
+        batch = current if current is not None else self.batch()
+        if (current is None):
+            batch.begin()
+        for entity in entities:
+            batch.put(entity)
+        if (current is None):
+            batch.commit()
+
+    def delete(self, key, **kwargs):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys, **kwargs):
+        current = self.current_batch
+        batch = current if current is not None else self.batch()
+        if (current is None):
+            batch.begin()
+        for key in keys:
+            batch.delete(key)
+        if (current is None):
+            batch.commit()
+
+    def query(self, kind=None, ancestor=None, **kwargs):
+        return Query(kind=kind, ancestor=ancestor, **kwargs)
+
+    def batch(self, **kwargs):
+        return Batch(self)
+
+# Mutations are applied atomically on commit, as in a Datastore commit.  The status
+# attributes keep the client's names, so cloudprofile.InstrumentedBatch works on both.
+class Batch(object):
+    _INITIAL = 0
+    _IN_PROGRESS = 1
+    _ABORTED = 2
+    _FINISHED = 3
+
+    def __init__(self, client):
+        self.client = client
+        self._status = Batch._INITIAL
+        self.operations = []
+
+    @property
+    def mutations(self):
+        return list(self.operations)
+
+    def begin(self):
+        if (self._status != Batch._INITIAL):
+            raise ValueError("Batch already started previously.")
+        self._status = Batch._IN_PROGRESS
+
+    def check_in_progress(self):
+        if (self._status != Batch._IN_PROGRESS):
+            raise ValueError("Batch must be in progress to add mutations.")
+
+    def put(self, entity):
+        self.check_in_progress()
+        if (entity.key is None):
+            raise ValueError("Entity must have a key")
+        if (entity.key.is_partial):
+            entity.key = entity.key.completed_key(STORE.allocate_id())
+        self.operations.append(("put", copy_entity(entity)))
+
+    def delete(self, key):
+        self.check_in_progress()
+        if (key.is_partial):
+            raise ValueError("Key must be complete")
+        self.operations.append(("delete", key))
+
+    def commit(self, **kwargs):
+        if (self._status != Batch._IN_PROGRESS):
+            raise ValueError("Batch must be in progress to commit()")
+        try:
+            STORE.apply(self.operations)
+        finally:
+            self._status = Batch._FINISHED
+
+    def rollback(self):
+        if (self._status != Batch._IN_PROGRESS):
+            raise ValueError("Batch must be in progress to rollback()")
+        self._status = Batch._ABORTED
+
+    def __enter__(self):
+        self.begin()
+        self.client.get_batch_stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if (self._status == Batch._IN_PROGRESS):
+                if (exc_type is None):
+                    self.commit()
+                else:
+                    self.rollback()
+        finally:
+            self.client.get_batch_stack().pop()
+
+#
+# Query
+#
+QUERY_PAGE_SIZE = 500
+
+FILTER_OPERATORS = {
+    "=": lambda left, right: left == right,
+    "!=": lambda left, right: left != right,
+    "<": lambda left, right: left < right,
+    "<=": lambda left, right: left <= right,
+    ">": lambda left, right: left > right,
+    ">=": lambda left, right: left >= right
+}
+
+class Query(object):
+    def __init__(self, kind=None, ancestor=None, filters=(), order=(), **kwargs):
+        self.kind = kind
+        self.ancestor = ancestor
+        self.filters = list(filters)
+        self.order = list(order)
+
+    def add_filter(self, property_name, operator, value):
+        if (operator not in FILTER_OPERATORS):
+            raise ValueError("Invalid operator: " + repr(operator))
+        self.filters.append((property_name, operator, value))
+        return self
+
+    def is_indexed(self, entity, property_name):
+        return property_name in entity and property_name not in entity.exclude_from_indexes
+
+    def matches(self, entity):
+        for property_name, operator, value in self.filters:
+            if (not self.is_indexed(entity, property_name)):
+                return False
+            if (not FILTER_OPERATORS[operator](value_order(entity[property_name]), value_order(value))):
+                return False
+        for prop in self.order:
+            if (not self.is_indexed(entity, prop.lstrip("-"))):
+                return False
+        return True
+
+    def run(self):
+        entities = [entity for entity in STORE.candidates(self.kind, self.ancestor) if self.matches(entity)]
+        entities.sort(key=lambda entity: key_order(entity.key))
+        for prop in reversed(self.order):
+            descending = prop.startswith("-")
+            name = prop.lstrip("-")
+            entities.sort(key=lambda entity: value_order(entity[name]), reverse=descending)
+        return entities
+
+    def fetch(self, limit=None, offset=0, **kwargs):
+        entities = self.run()[offset:]
+        if (limit is not None):
+            entities = entities[:limit]
+        return QueryIterator([copy_entity(entity) for entity in entities])
+
+# Results arrive in pages of QUERY_PAGE_SIZE entities, one page per Datastore RPC.
+class QueryIterator(object):
+    def __init__(self, entities):
+        self.entities = entities
+        self.num_results = 0
+
+    @property
+    def pages(self):
+        for start in range(0, len(self.entities), QUERY_PAGE_SIZE):
+            page = self.entities[start:start + QUERY_PAGE_SIZE]
+            self.num_results += len(page)
+            yield iter(page)
+
+    def __iter__(self):
+        for page in self.pages:
+            for entity in page:
+                yield entity
+
+#
+# Storage
+#
+STORAGE_DIR = os.environ.get("LOCAL_STORAGE_DIR", os.path.join(os.getcwd(), "local-storage"))
+
+class NotFound(LookupError):
+    pass
+
+# A name is one path component of LOCAL_STORAGE_DIR - never a path out of it.
+def check_name(kind, name):
+    separators = [sep for sep in ("/", os.sep, os.altsep) if sep]
+    if (not isinstance(name, str) or name in ("", ".", "..") or any(sep in name for sep in separators)):
+        raise ValueError("Invalid " + kind + " name: " + repr(name))
+    return name
+
+class StorageClient(object):
+    def __init__(self, project=None, **kwargs):
+        self.project = project or "local"
+
+    def lookup_bucket(self, bucket_name, **kwargs):
+        path = os.path.join(STORAGE_DIR, check_name("bucket", bucket_name))
+        if (not os.path.isdir(path)):
+            return None
+        return Bucket(bucket_name, path)
+
+    def get_bucket(self, bucket_or_name, **kwargs):
+        bucket = self.lookup_bucket(bucket_or_name, **kwargs)
+        if (bucket is None):
+            raise NotFound("Bucket " + bucket_or_name + " does not exist")
+        return bucket
+
+    def create_bucket(self, bucket_name, **kwargs):
+        path = os.path.join(STORAGE_DIR, check_name("bucket", bucket_name))
+        os.makedirs(path, exist_ok=True)
+        return Bucket(bucket_name, path)
+
+class Bucket(object):
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+
+    def blob(self, blob_name, **kwargs):
+        return Blob(blob_name, self)
+
+    def get_blob(self, blob_name, **kwargs):
+        blob = Blob(blob_name, self)
+        if (not os.path.isfile(blob.path)):
+            return None
+        return blob
+
+class Blob(object):
+    def __init__(self, name, bucket):
+        self.name = name
+        self.bucket = bucket
+        self.path = os.path.join(bucket.path, check_name("blob", name))
+
+    @property
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return None
+
+    # start and end are byte offsets - end is inclusive, as in the storage client.
+    def download_as_bytes(self, start=None, end=None, **kwargs):
+        try:
+            with open(self.path, mode='rb') as blobfile:
+                if (start is not None):
+                    blobfile.seek(start)
+                if (end is None):
+                    return blobfile.read()
+                return blobfile.read(max(end + 1 - (start or 0), 0))
+        except FileNotFoundError:
+            raise NotFound("Blob " + self.name + " does not exist")
+
+    def download_as_string(self, start=None, end=None, **kwargs):
+        return self.download_as_bytes(start=start, end=end, **kwargs)
+
+    def upload_from_string(self, data, **kwargs):
+        if (isinstance(data, str)):
+            data = data.encode('utf8')
+        tmpname = self.path + ".tmp"
+        with open(tmpname, mode='wb') as blobfile:
+            blobfile.write(data)
+        os.replace(tmpname, self.path)
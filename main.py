@@ -12,7 +12,17 @@ Reference:
 curl https://tidal-nectar-222020.appspot.com/profile/enable -X GET
 curl https://tidal-nectar-222020.appspot.com/profile/disable -X GET
 curl https://tidal-nectar-222020.appspot.com/profile/clear -X GET
-curl https://tidal-nectar-222020.appspot.com/profile/report -X GET
+curl https://tidal-nectar-222020.appspot.com/profile/report -X GET       // with PROFILE_SHARED_DIR set:  report, counters, enable, disable and clear cover all worker processes
+curl https://tidal-nectar-222020.appspot.com/profile/unit_us -X GET      // report unit:  unit_ns, unit_us, unit_ms, unit_s
+curl https://tidal-nectar-222020.appspot.com/profile/counters -X GET     // includes ds.<op> / gcs.<op> RPC counts and per-request ds_rpcs
+curl https://tidal-nectar-222020.appspot.com/profile/chains -X GET
+curl https://tidal-nectar-222020.appspot.com/profile/memory_on -X GET    // tracemalloc allocation deltas in chains (memory_off)
+curl https://tidal-nectar-222020.appspot.com/metrics -X GET               // all profiles in Prometheus text format
+curl "https://tidal-nectar-222020.appspot.com/profile/traces?n=10" -X GET          // slowest request traces with nested spans (traces_clear)
+curl "https://tidal-nectar-222020.appspot.com/profile/trace_threshold?ms=500" -X GET  // slow request threshold - slower requests are kept and logged
+curl "https://tidal-nectar-222020.appspot.com/profile/sample_start?hz=200" -X GET   // sampling profiler (sample_stop, sample_clear)
+curl https://tidal-nectar-222020.appspot.com/profile/startup -X GET      // cold start:  import times per module, lazy imports, first request
+curl https://tidal-nectar-222020.appspot.com/profile/sample_report -X GET > stacks.txt   // collapsed stacks per endpoint:  flamegraph.pl stacks.txt > flame.svg
 
 
 // Load (Create) Dataset from Bucket:  bucket/<bucketname>/<filename>/<datasetid>
@@ -36,6 +46,9 @@ curl https://tidal-nectar-222020.appspot.com/taskdata/Test20190101 -X DELETE
 curl https://tidal-nectar-222020.appspot.com/taskdata/Task20190107 -X DELETE
 
 
+// Get the tasks of several datasets in one request - null for datasets that do not exist
+curl "https://tidal-nectar-222020.appspot.com/taskbatch?datasetids=Task20190102,Task20190107" -X GET
+
 // Get a task
 curl https://tidal-nectar-222020.appspot.com/taskdata/Task20190102/task1 -X GET
 
@@ -45,6 +58,22 @@ curl https://tidal-nectar-222020.appspot.com/taskdata/Task20190102/task11 -X PUT
 // Delete a task
 curl https://tidal-nectar-222020.appspot.com/taskdata/Task20190102/task1 -X DELETE
 
+// Get tasks with a duration between 10 and 30 (ascending) / the 5 longest tasks
+// Both queries use the composite Task indexes in index.yaml:  gcloud datastore indexes create index.yaml
+curl "https://tidal-nectar-222020.appspot.com/taskdur/Task20190102?min=10&max=30" -X GET
+curl "https://tidal-nectar-222020.appspot.com/tasktop/Task20190102?n=5" -X GET
+
+// Run offline against the in-process Datastore / Storage stand-in (see backend.py, localstore.py)
+// buckets are directories of LOCAL_STORAGE_DIR:  local-storage/<bucketname>/<filename>.csv
+TASK_BACKEND=local python main.py
+DSTASK_HOST_URL=http://127.0.0.1:5000 python test-dstask-api.py
+
+// Production serving with gunicorn (see wsgi.py and gunicorn.conf.py - also the app.yaml entrypoint)
+gunicorn -c gunicorn.conf.py wsgi:app
+
+// Async serving mode - the Datastore-bound GET endpoints as async handlers (see asgi.py)
+uvicorn asgi:app --host 0.0.0.0 --port 8080 --limit-concurrency 500
+
 
 Object Terminology:
    "entity" - An object in Datastore - Equivalent to a database row.
@@ -53,16 +82,32 @@ Object Terminology:
    "delete" - References deleting an Entity from Datastore.
 """
 
-from flask import Flask
+import startup
+from flask import Flask, Response
+startup.mark("flask")
+# flask_restful and the parsers below stay eager:  every route is a Resource subclass and
+# must be registered before the first request; the import costs a few ms of the startup
+# report ("flask_restful") and the parsers microseconds.  Only the cloud SDKs are lazy.
 from flask_restful import reqparse, abort, Api, Resource, fields, marshal
+startup.mark("flask_restful")
 import json
 import os
 import datetime
-from google.cloud import datastore, storage
+import contextvars
+import concurrent.futures
+startup.mark("stdlib")
+import backend
 import profile
+import instrument
+import cloudprofile
+import sampler
+import profileshare
+startup.mark("profile modules")
 
 app = Flask(__name__)
 api = Api(app)
+instrument.instrument_app(app)
+startup.register(app)
 
 MESSAGE_SUCCESS = {"message": "success"}
 
@@ -71,12 +116,28 @@ parser.add_argument('desc')
 parser.add_argument('dur')
 parser.add_argument('tasklist', action='append')
 
+durparser = reqparse.RequestParser()
+durparser.add_argument('min', type=int, location='args')
+durparser.add_argument('max', type=int, location='args')
+durparser.add_argument('n', type=int, location='args', default=10)
+
+sampleparser = reqparse.RequestParser()
+sampleparser.add_argument('hz', type=int, location='args', default=sampler.DEFAULT_HZ)
+
+batchparser = reqparse.RequestParser()
+BATCH_DATASETIDS_HELP = "Comma separated datasetids are required:  taskbatch?datasetids=<id>,<id>"
+batchparser.add_argument('datasetids', location='args', required=True, help=BATCH_DATASETIDS_HELP)
+
+traceparser = reqparse.RequestParser()
+traceparser.add_argument('n', type=int, location='args', default=10)
+traceparser.add_argument('ms', type=int, location='args')
+
 
 def get_storage_client():
-    return storage.Client()
+    return cloudprofile.InstrumentedStorageClient(backend.get_storage_client())
 
 def get_datastore_client():
-    return datastore.Client()
+    return cloudprofile.InstrumentedDatastoreClient(backend.get_datastore_client())
 
 def get_dataset_key(client, datasetid):
     key = client.key('Dataset', datasetid)
@@ -96,22 +157,113 @@ clock_fields = {
     'clock_id': fields.String,
     'elapsed_time': fields.Integer,
     'start_num': fields.Integer,
-    'stop_num': fields.Integer
+    'stop_num': fields.Integer,
+    'min': fields.Integer,
+    'mean': fields.Integer,
+    'max': fields.Integer,
+    'p50': fields.Integer,
+    'p90': fields.Integer,
+    'p99': fields.Integer,
+    'p999': fields.Integer
 }
 
 class ClockOutput(object):
-    def __init__(self, profile_id, clock_id, elapsed_time, start_num, stop_num):
+    def __init__(self, profile_id, clock_id, elapsed_time, start_num, stop_num, stats):
         self.profile_id = profile_id
         self.clock_id = clock_id
         self.elapsed_time = elapsed_time
         self.start_num = start_num
         self.stop_num = stop_num
+        self.min = stats['min']
+        self.mean = stats['mean']
+        self.max = stats['max']
+        self.p50 = stats['p50']
+        self.p90 = stats['p90']
+        self.p99 = stats['p99']
+        self.p999 = stats['p999']
+
+counter_fields = {
+    'profile_id': fields.String,
+    'counter_id': fields.String,
+    'value': fields.Integer
+}
+
+# elapsed_time and the deltas are relative to the previous link (null for the first link)
+link_fields = {
+    'link_id': fields.String,
+    'elapsed_time': fields.Integer,
+    'rss': fields.Integer,
+    'rss_delta': fields.Integer,
+    'alloc_delta': fields.Integer
+}
+
+chain_fields = {
+    'profile_id': fields.String,
+    'chain_id': fields.String,
+    'links': fields.List(fields.Nested(link_fields))
+}
+
+class LinkOutput(object):
+    def __init__(self, plink):
+        self.link_id = plink.link_id
+        self.elapsed_time = None
+        if (plink.elapsed_nanos is not None):
+            self.elapsed_time = profile.to_unit(plink.elapsed_nanos)
+        self.rss = plink.rss
+        self.rss_delta = plink.rss_delta
+        self.alloc_delta = plink.traced_delta
+
+class ChainOutput(object):
+    def __init__(self, pchain):
+        self.profile_id = pchain.profile_id
+        self.chain_id = pchain.chain_id
+        self.links = [LinkOutput(plink) for plink in pchain.get_links()]
+
+def get_chains():
+    return [ChainOutput(pchain) for pchain in profile.get_chains()]
+
+# offset is the span start relative to the start of the request
+span_fields = {
+    'clock_id': fields.String,
+    'depth': fields.Integer,
+    'offset': fields.Integer,
+    'elapsed_time': fields.Integer
+}
+
+trace_fields = {
+    'profile_id': fields.String,
+    'name': fields.String,
+    'time': fields.DateTime(dt_format='iso8601'),
+    'elapsed_time': fields.Integer,
+    'dropped': fields.Integer,
+    'spans': fields.List(fields.Nested(span_fields))
+}
+
+class SpanOutput(object):
+    def __init__(self, ptrace, pspan):
+        clock_id, parent, depth, start, stop = pspan
+        self.clock_id = clock_id
+        self.depth = depth
+        self.offset = profile.to_unit(start - ptrace.start)
+        self.elapsed_time = profile.to_unit(stop - start)
+
+class TraceOutput(object):
+    def __init__(self, ptrace):
+        self.profile_id = ptrace.profile_id
+        self.name = ptrace.name
+        self.time = datetime.datetime.fromtimestamp(ptrace.time, datetime.timezone.utc)
+        self.elapsed_time = profile.to_unit(ptrace.elapsed_nanos)
+        self.dropped = ptrace.dropped
+        self.spans = [SpanOutput(ptrace, pspan) for pspan in ptrace.spans]
+
+def get_traces(n):
+    return [TraceOutput(ptrace) for ptrace in profile.get_traces(n)]
 
 def get_clocks():
     outlist = []
-    clist = profile.get_clocks()
+    clist = profileshare.get_clocks()
     for pclock in clist:
-        clockout = ClockOutput(profile_id=pclock.profile_id, clock_id=pclock.clock_id, elapsed_time=pclock.elapsed_time, start_num=pclock.start_num, stop_num=pclock.stop_num)
+        clockout = ClockOutput(profile_id=pclock.profile_id, clock_id=pclock.clock_id, elapsed_time=pclock.elapsed_time, start_num=pclock.start_num, stop_num=pclock.stop_num, stats=pclock.get_stats())
         outlist.append(clockout)
     return outlist
 
@@ -127,53 +279,55 @@ FILE_EXTENSION = ".csv"
 # For large files we need to implement readline.
 def create_dataset_from_bucket(datastore_client, dataset_key, datasetid, bucket, filename):
     # get dataset rows from the bucket file
-    profile.clock_start("b_blobstr")
-    filename = filename + FILE_EXTENSION
-    blob = bucket.get_blob(filename)
-    blobbytes = blob.download_as_string()
-    blobstr = blobbytes.decode('utf8')
-    profile.clock_stop("b_blobstr")
+    profile.chain_add_link("b_load", "begin")
+    with profile.clock("b_blobstr"):
+        filename = filename + FILE_EXTENSION
+        blob = bucket.get_blob(filename)
+        blobbytes = blob.download_as_string()
+        blobstr = blobbytes.decode('utf8')
+    profile.chain_add_link("b_load", "blobstr")
+
+    # Check every row before anything is written - a bad dur fails the load with 400
+    rows = []
+    for line in blobstr.split(NEWLINE):
+        values = line.split(DELIMITER)
+        if (len(values) > 2):
+            rows.append((values[0], values[1], get_int_dur(values[2])))
 
     # First create the dataset ancestor
-    profile.clock_start("b_ancestor")
-    desc = "Dataset Loaded from Bucket"
-    entity = datastore.Entity(dataset_key, exclude_from_indexes=['datasetid', 'desc'])
-    entity.update({
-        'created': datetime.datetime.utcnow(),
-        'datasetid': datasetid,
-        'desc': desc
-    })
-    datastore_client.put(entity)
-    profile.clock_stop("b_ancestor")
+    with profile.clock("b_ancestor"):
+        desc = "Dataset Loaded from Bucket"
+        entity = backend.new_entity(dataset_key, exclude_from_indexes=['datasetid', 'desc'])
+        entity.update({
+            'created': datetime.datetime.utcnow(),
+            'datasetid': datasetid,
+            'desc': desc
+        })
+        datastore_client.put(entity)
+    profile.chain_add_link("b_load", "ancestor")
 
     # Next create new tasks - Commit every N rows.
-    profile.clock_start("b_tasks")
-    lines = blobstr.split(NEWLINE)
-    lines_processed = 0
-    batch = None
-    for line in lines:
-        # batch start
-        if (lines_processed == 0):
-            batch = datastore_client.batch()
-            batch.begin()
-        # process the line
-        values = line.split(DELIMITER)
-        if (len(values) > 2):
-            taskid = values[0]
-            taskdesc = values[1]
-            taskdur = values[2]
+    with profile.clock("b_tasks"):
+        lines_processed = 0
+        batch = None
+        for taskid, taskdesc, taskdur in rows:
+            # batch start
+            if (lines_processed == 0):
+                batch = datastore_client.batch()
+                batch.begin()
+            # process the row
             tkey = get_task_key(datastore_client, datasetid, taskid)
             create_task(datastore_client, tkey, datasetid, taskid, taskdesc, taskdur)
-        lines_processed += 1
-        # batch end / commit
-        if (lines_processed >= BATCH_SIZE and batch is not None):
+            lines_processed += 1
+            # batch end / commit
+            if (lines_processed >= BATCH_SIZE and batch is not None):
+                batch.commit()
+                lines_processed = 0
+
+        # Finish batch processing (after loop processing)
+        if (lines_processed > 0 and batch is not None):
             batch.commit()
-            lines_processed = 0
-
-    # Finish batch processing (after loop processing)
-    if (lines_processed > 0 and batch is not None):
-        batch.commit()
-    profile.clock_stop("b_tasks")
+    profile.chain_add_link("b_load", "tasks")
 
 #
 # DATASET
@@ -196,7 +350,7 @@ def new_dataset(datasetid, desc):
 
 def create_dataset(client, key, datasetid, desc, tasklist):
     # First create the dataset ancestor
-    entity = datastore.Entity(key, exclude_from_indexes=['datasetid', 'desc'])
+    entity = backend.new_entity(key, exclude_from_indexes=['datasetid', 'desc'])
     entity.update({
         'created': datetime.datetime.utcnow(),
         'datasetid': datasetid,
@@ -267,13 +421,23 @@ def new_task(datasetid, taskid, desc, dur):
     ta = Task(datasetid=datasetid, taskid=taskid, desc=desc, dur=dur)
     return ta
 
+# dur is indexed (see index.yaml) and stored as an integer so it sorts numerically -
+# a dur that is not an integer is rejected with 400 (a task without dur is not indexed).
+def get_int_dur(dur):
+    if (dur is None):
+        return None
+    try:
+        return int(dur)
+    except (TypeError, ValueError):
+        abort(400, message="Task duration {} is not an integer".format(dur))
+
 def create_task(client, key, datasetid, taskid, desc, dur):
-    entity = datastore.Entity(key, exclude_from_indexes=['taskid', 'desc', 'dur'])
+    entity = backend.new_entity(key, exclude_from_indexes=['taskid', 'desc'])
     entity.update({
         'created': datetime.datetime.utcnow(),
         'taskid': taskid,
         'desc': desc,
-        'dur': dur
+        'dur': get_int_dur(dur)
     })
     client.put(entity)
     return entity.key
@@ -281,7 +445,7 @@ def create_task(client, key, datasetid, taskid, desc, dur):
 def update_task(client, key, desc, dur):
     entity = client.get(key)
     entity['desc'] = desc
-    entity['dur'] = dur
+    entity['dur'] = get_int_dur(dur)
     client.put(entity)
 
 def delete_task(client, key):
@@ -295,6 +459,144 @@ def get_tasks(client, key, datasetid):
         tlist.append(task)
     return tlist
 
+# Ancestor query on the (ancestor, dur) composite index - mindur/maxdur of None are unbounded.
+def get_tasks_by_dur(client, key, datasetid, mindur, maxdur):
+    tlist = []
+    query = client.query(kind='Task', ancestor=key)
+    if (mindur is not None):
+        query.add_filter('dur', '>=', mindur)
+    if (maxdur is not None):
+        query.add_filter('dur', '<=', maxdur)
+    query.order = ['dur']
+    for entity in query.fetch():
+        task = new_task(datasetid, entity['taskid'], entity['desc'], entity['dur'])
+        tlist.append(task)
+    return tlist
+
+# Ancestor query on the (ancestor, dur desc) composite index - only n entities are read.
+def get_top_tasks(client, key, datasetid, n):
+    tlist = []
+    if (n <= 0):
+        return tlist
+    query = client.query(kind='Task', ancestor=key)
+    query.order = ['-dur']
+    for entity in query.fetch(limit=n):
+        task = new_task(datasetid, entity['taskid'], entity['desc'], entity['dur'])
+        tlist.append(task)
+    return tlist
+
+# Ancestor queries of a batch read run concurrently on a bounded pool shared by all requests.
+BATCH_MAX_DATASETS = 100
+BATCH_QUERY_WORKERS = int(os.environ.get("BATCH_QUERY_WORKERS", "16"))
+BATCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_QUERY_WORKERS, thread_name_prefix="taskbatch")
+
+# Unique datasetids of a comma separated list, in order.
+def split_datasetids(value):
+    datasetids = []
+    for datasetid in value.split(","):
+        datasetid = datasetid.strip()
+        if (datasetid and datasetid not in datasetids):
+            datasetids.append(datasetid)
+    return datasetids
+
+# Error message for an invalid datasetid list, None when it is valid.
+def check_datasetids(datasetids):
+    if (not datasetids):
+        return BATCH_DATASETIDS_HELP
+    if (len(datasetids) > BATCH_MAX_DATASETS):
+        return "At most {} datasetids can be read at once".format(BATCH_MAX_DATASETS)
+    return None
+
+# Tasks of several datasets:  {datasetid: [Task], ...} - None for datasets that do not exist.
+# The existence checks are one get_multi; each query runs in a copy of the request context,
+# so its clocks and RPC counters are attributed to the request.
+def get_tasks_of_datasets(client, datasetids):
+    keys = [get_dataset_key(client, datasetid) for datasetid in datasetids]
+    existing = set(entity.key.name for entity in client.get_multi(keys))
+    futures = {}
+    for datasetid, key in zip(datasetids, keys):
+        if (datasetid in existing):
+            context = contextvars.copy_context()
+            futures[datasetid] = BATCH_EXECUTOR.submit(context.run, get_tasks, client, key, datasetid)
+    results = {}
+    for datasetid in datasetids:
+        future = futures.get(datasetid)
+        results[datasetid] = None if future is None else future.result()
+    return results
+
+def marshal_task_batch(results):
+    output = {}
+    for datasetid, tasks in results.items():
+        output[datasetid] = None if tasks is None else marshal(tasks, task_fields)
+    return output
+
+#
+# Read Handlers - the GET bodies shared by the Resources below and the async handlers of
+# asgi.py.  Each returns (output, status) or aborts, and needs a request context.
+#
+def get_existing_dataset_key(client, datasetid):
+    # existence check for dataset
+    key = get_dataset_key(client, datasetid)
+    entity = client.get(key)
+    if (not entity):
+        abort(404, message="Dataset {} does not exist".format(datasetid))
+    return key
+
+def read_dataset_list(client):
+    datasets = get_datasets(client)
+    return marshal(datasets, dataset_fields), 200
+
+def read_dataset(client, datasetid):
+    key = get_existing_dataset_key(client, datasetid)
+
+    # get tasks and return
+    tasks = get_tasks(client, key, datasetid)
+    return marshal(tasks, task_fields), 200
+
+def read_task(client, datasetid, taskid):
+    get_existing_dataset_key(client, datasetid)
+
+    # existence check for task
+    key = get_task_key(client, datasetid, taskid)
+    entity = client.get(key)
+    if (not entity):
+        abort(404, message="Task {} does not exist".format(taskid))
+
+    # Return task
+    task = new_task(datasetid, taskid, entity['desc'], entity['dur'])
+    return marshal(task, task_fields), 200
+
+def read_tasks_by_dur(client, datasetid):
+    args = durparser.parse_args()
+    key = get_existing_dataset_key(client, datasetid)
+    tasks = get_tasks_by_dur(client, key, datasetid, args['min'], args['max'])
+    return marshal(tasks, task_fields), 200
+
+def read_top_tasks(client, datasetid):
+    args = durparser.parse_args()
+    key = get_existing_dataset_key(client, datasetid)
+    tasks = get_top_tasks(client, key, datasetid, args['n'])
+    return marshal(tasks, task_fields), 200
+
+def read_task_batch(client):
+    args = batchparser.parse_args()
+    datasetids = split_datasetids(args['datasetids'])
+    message = check_datasetids(datasetids)
+    if (message):
+        abort(400, message=message)
+    results = get_tasks_of_datasets(client, datasetids)
+    return marshal_task_batch(results), 200
+
+# GET endpoints and their read handlers - called with the route arguments as keywords.
+READ_HANDLERS = {
+    "datasetlist_ep": read_dataset_list,
+    "dataset_ep": read_dataset,
+    "task_ep": read_task,
+    "taskdur_ep": read_tasks_by_dur,
+    "tasktop_ep": read_top_tasks,
+    "taskbatch_ep": read_task_batch
+}
+
 #
 # REST API
 #
@@ -302,11 +604,7 @@ def get_tasks(client, key, datasetid):
 # GET - Get task datasets (ancestors)
 class DatasetListApi(Resource):
     def get(self, **kwargs):
-        profile.clock_start("GET_Datasets")
-        client = get_datastore_client()
-        datasets = get_datasets(client)
-        profile.clock_stop("GET_Datasets")
-        return marshal(datasets, dataset_fields), 200
+        return read_dataset_list(get_datastore_client())
 
 # DatasetApi
 # GET - Get dataset details (including tasks)
@@ -314,23 +612,9 @@ class DatasetListApi(Resource):
 # DELETE - Delete dataset (ancestor) and all tasks (Descendants)
 class DatasetApi(Resource):
     def get(self, **kwargs):
-        profile.clock_start("GET_Dataset")
-        # existence check for dataset
-        datasetid = kwargs["datasetid"]
-        client = get_datastore_client()
-        key = get_dataset_key(client, datasetid)
-        entity = client.get(key)
-        if (not entity):
-            profile.clock_stop("GET_Dataset")
-            abort(404, message="Dataset {} does not exist".format(datasetid))
-
-        # get tasks and return
-        tasks = get_tasks(client, key, datasetid)
-        profile.clock_stop("GET_Dataset")
-        return marshal(tasks, task_fields), 200
+        return read_dataset(get_datastore_client(), kwargs["datasetid"])
 
     def put(self, **kwargs):
-        profile.clock_start("PUT_Dataset")
         # get values
         datasetid = kwargs["datasetid"]
         args = parser.parse_args()
@@ -343,7 +627,7 @@ class DatasetApi(Resource):
         if (tasklistarg != None):
             for taskstr in tasklistarg:
                 dict = eval(taskstr)
-                task = new_task(datasetid, dict['taskid'], dict['desc'], dict['dur'])
+                task = new_task(datasetid, dict['taskid'], dict['desc'], get_int_dur(dict['dur']))
                 tasklist.append(task)
 
         # existence check for dataset
@@ -357,29 +641,31 @@ class DatasetApi(Resource):
             # create new dataset
             create_dataset(client, key, datasetid, desc, tasklist)
 
-        profile.clock_stop("PUT_Dataset")
         return MESSAGE_SUCCESS, 200
 
     def delete(self, **kwargs):
-        profile.clock_start("DELETE_Dataset")
         # existence check for dataset
         datasetid = kwargs["datasetid"]
         client = get_datastore_client()
         key = get_dataset_key(client, datasetid)
         entity = client.get(key)
         if (not entity):
-            profile.clock_stop("DELETE_Dataset")
             abort(404, message="Dataset {} does not exist".format(datasetid))
 
         delete_dataset(client, key)
-        profile.clock_stop("DELETE_Dataset")
         return MESSAGE_SUCCESS, 200
 
+# TaskBatchApi
+# GET - Get the tasks of several datasets:  /taskbatch?datasetids=<id>,<id>
+#       Returns {datasetid: [tasks], ...} - null for datasets that do not exist.
+class TaskBatchApi(Resource):
+    def get(self, **kwargs):
+        return read_task_batch(get_datastore_client())
+
 # BucketApi
 # GET    - Load data from a bucket file into Datastore:  /bucket/<bucketname>/<filename>/<datasetid>
 class BucketApi(Resource):
     def get(self, **kwargs):
-        profile.clock_start("GET_Bucket")
         # get values
         bucketname = kwargs["bucketname"]
         filename = kwargs["filename"]
@@ -390,7 +676,6 @@ class BucketApi(Resource):
         dataset_key = get_dataset_key(datastore_client, datasetid)
         entity = datastore_client.get(dataset_key)
         if entity:
-            profile.clock_stop("GET_Bucket")
             abort(406, message="Dataset {} already exists".format(datasetid))
 
         # existence check for bucket
@@ -398,13 +683,11 @@ class BucketApi(Resource):
         try:
             bucket = storage_client.get_bucket(bucketname)
         except:
-            profile.clock_stop("GET_Bucket")
             abort(404, message="Bucket {} does not exist".format(bucketname))
 
         # process bucket/file
         create_dataset_from_bucket(datastore_client, dataset_key, datasetid, bucket, filename)
 
-        profile.clock_stop("GET_Bucket")
         return MESSAGE_SUCCESS, 200
 
 # TaskApi
@@ -413,37 +696,13 @@ class BucketApi(Resource):
 # DELETE - Delete a task
 class TaskApi(Resource):
     def get(self, **kwargs):
-        profile.clock_start("GET_Task")
-        # get values
-        datasetid = kwargs["datasetid"]
-        taskid = kwargs["taskid"]
-
-        # existence check for dataset
-        client = get_datastore_client()
-        key = get_dataset_key(client, datasetid)
-        entity = client.get(key)
-        if (not entity):
-            profile.clock_stop("GET_Task")
-            abort(404, message="Dataset {} does not exist".format(datasetid))
-
-        # existence check for task
-        key = get_task_key(client, datasetid, taskid)
-        entity = client.get(key)
-        if (not entity):
-            profile.clock_stop("GET_Task")
-            abort(404, message="Task {} does not exist".format(taskid))
-
-        # Return task
-        task = new_task(datasetid, taskid, entity['desc'], entity['dur'])
-        profile.clock_stop("GET_Task")
-        return marshal(task, task_fields), 200
+        return read_task(get_datastore_client(), kwargs["datasetid"], kwargs["taskid"])
 
     def put(self, **kwargs):
-        profile.clock_start("PUT_Task")
         # get values
         args = parser.parse_args()
         desc = args['desc']
-        dur = args['dur']
+        dur = get_int_dur(args['dur'])
         datasetid = kwargs["datasetid"]
         taskid = kwargs["taskid"]
 
@@ -452,7 +711,6 @@ class TaskApi(Resource):
         key = get_dataset_key(client, datasetid)
         entity = client.get(key)
         if (not entity):
-            profile.clock_stop("PUT_Task")
             abort(404, message="Dataset {} does not exist".format(datasetid))
 
         # Update if the task exists, otherwise create a new task
@@ -465,11 +723,9 @@ class TaskApi(Resource):
             # Create new task
             create_task(client, key, datasetid, taskid, desc, dur)
 
-        profile.clock_stop("PUT_Task")
         return MESSAGE_SUCCESS, 200
 
     def delete(self, **kwargs):
-        profile.clock_start("DELETE_Task")
         # get values
         datasetid = kwargs["datasetid"]
         taskid = kwargs["taskid"]
@@ -479,19 +735,39 @@ class TaskApi(Resource):
         key = get_dataset_key(client, datasetid)
         entity = client.get(key)
         if (not entity):
-            profile.clock_stop("DELETE_Task")
             abort(404, message="Dataset {} does not exist".format(datasetid))
 
         # existence check for task
         key = get_task_key(client, datasetid, taskid)
         entity = client.get(key)
         if (not entity):
-            profile.clock_stop("DELETE_Task")
             abort(404, message="Task {} does not exist".format(taskid))
 
         # Delete task and return
         delete_task(client, key)
-        profile.clock_stop("DELETE_Task")
+        return MESSAGE_SUCCESS, 200
+
+# TaskDurationApi
+# GET - Get the tasks of a dataset with min <= dur <= max, shortest first
+class TaskDurationApi(Resource):
+    def get(self, **kwargs):
+        return read_tasks_by_dur(get_datastore_client(), kwargs["datasetid"])
+
+# TaskTopApi
+# GET - Get the n longest tasks of a dataset, longest first
+class TaskTopApi(Resource):
+    def get(self, **kwargs):
+        return read_top_tasks(get_datastore_client(), kwargs["datasetid"])
+
+# WarmupApi
+# GET - App Engine warmup request (inbound_services: warmup in app.yaml) - imports the
+#       client libraries and creates the clients before the instance gets traffic.
+class WarmupApi(Resource):
+    def get(self, **kwargs):
+        get_datastore_client()
+        get_storage_client()
+        if (not backend.is_local()):
+            startup.timed_import("google.cloud.datastore.helpers")
         return MESSAGE_SUCCESS, 200
 
 # GET - General purpose get for Profile object testing - TESTING ONLY!
@@ -500,13 +776,53 @@ class ProfileApi(Resource):
         operation = kwargs["operation"]
         if (operation == "report"):
             return marshal(get_clocks(), clock_fields), 200
+        elif (operation == "counters"):
+            return marshal(profileshare.get_counters(), counter_fields), 200
+        elif (operation == "chains"):
+            return marshal(get_chains(), chain_fields), 200
+        elif (operation == "traces"):
+            args = traceparser.parse_args()
+            return marshal(get_traces(args['n']), trace_fields), 200
+        elif (operation == "startup"):
+            return startup.get_report(), 200
+        elif (operation == "sample_report"):
+            return Response(sampler.get_collapsed(), mimetype="text/plain")
         else:
             if (operation == "enable"):
-                profile.enable()
+                profileshare.enable()
             elif (operation == "disable"):
-                profile.disable()
+                profileshare.disable()
             elif (operation == "clear"):
-                profile.clear()
+                profileshare.clear()
+            elif (operation == "memory_on"):
+                profile.memory_tracing(True)
+            elif (operation == "memory_off"):
+                profile.memory_tracing(False)
+            elif (operation == "sample_start"):
+                args = sampleparser.parse_args()
+                try:
+                    sampler.start(args['hz'])
+                except ValueError as e:
+                    abort(400, message=str(e))
+            elif (operation == "traces_clear"):
+                profile.clear_traces()
+            elif (operation == "trace_threshold"):
+                args = traceparser.parse_args()
+                if (args['ms'] is None):
+                    abort(400, message="The slow trace threshold is required:  trace_threshold?ms=<millis>")
+                try:
+                    profile.set_trace_threshold(args['ms'])
+                except ValueError as e:
+                    abort(400, message=str(e))
+            elif (operation == "sample_stop"):
+                sampler.stop()
+            elif (operation == "sample_clear"):
+                sampler.clear()
+            elif (operation.startswith("unit_")):
+                try:
+                    profile.set_unit(operation[len("unit_"):])
+                except ValueError as e:
+                    abort(400, message=str(e))
             return MESSAGE_SUCCESS, 200
 
 
@@ -514,8 +830,14 @@ class ProfileApi(Resource):
 api.add_resource(DatasetListApi, '/taskdata', endpoint='datasetlist_ep')
 api.add_resource(DatasetApi, '/taskdata/<datasetid>', endpoint='dataset_ep')
 api.add_resource(TaskApi, '/taskdata/<datasetid>/<taskid>', endpoint='task_ep')
+api.add_resource(TaskDurationApi, '/taskdur/<datasetid>', endpoint='taskdur_ep')
+api.add_resource(TaskTopApi, '/tasktop/<datasetid>', endpoint='tasktop_ep')
+api.add_resource(TaskBatchApi, '/taskbatch', endpoint='taskbatch_ep')
 api.add_resource(BucketApi, '/bucket/<bucketname>/<filename>/<datasetid>', endpoint='bucket_ep')
 api.add_resource(ProfileApi, '/profile/<operation>', endpoint='profile_ep')
+api.add_resource(WarmupApi, '/_ah/warmup', endpoint='warmup_ep')
+startup.mark("app")
+startup.report()
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,127 @@
+"""
+metrics.py
+Prometheus text exposition of all profiles (clocks, counters and latency histograms).
+
+Description:
+   instrument.instrument_app(app) registers GET /metrics, which renders every
+   profile - not only DEFAULT_PROFILE_ID - in the text exposition format:
+
+      profile_clock_seconds         histogram  clock spans (bucket / sum / count)
+      profile_clock_starts_total    counter    clock starts (includes spans still running)
+      profile_counter               untyped    counter values (counter_set can lower them)
+
+   Every sample carries the labels profile="<profile_id>" and clock="<clock_id>" or
+   counter="<counter_id>".
+
+   Scrapes are cheap:  the label string of a clock / counter is built once and kept on
+   the object, the bucket boundaries are fixed powers of two (the histogram's own
+   power-of-two groups, so no estimation is needed) rendered from pre-built strings,
+   and a clock is read under its lock into a handful of ints - no Clock copies.
+   With PROFILE_SHARED_DIR set, the host-wide merge of all worker processes is rendered
+   instead (see profileshare.py) - merged at most once per PROFILE_SHARE_INTERVAL.
+
+   Example:
+      curl http://127.0.0.1:5000/metrics
+
+"""
+from flask import Response
+import profile
+import profileshare
+
+METRICS_PATH = "/metrics"
+METRICS_ENDPOINT = "metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Bucket upper bounds are 2^e nanoseconds for e in [MIN_EXPONENT, MAX_EXPONENT]:
+# about 1us up to 68.7s, plus +Inf.
+MIN_EXPONENT = 10
+MAX_EXPONENT = 36
+
+def format_seconds(nanos):
+    return repr(nanos / 1e9)
+
+BUCKET_LABELS = [',le="' + format_seconds(1 << e) + '"} ' for e in range(MIN_EXPONENT, MAX_EXPONENT + 1)]
+INF_BUCKET_LABEL = ',le="+Inf"} '
+
+HEADER = (
+    "# HELP profile_clock_seconds Profile clock spans.\n"
+    "# TYPE profile_clock_seconds histogram\n"
+)
+STARTS_HEADER = (
+    "# HELP profile_clock_starts_total Profile clock starts.\n"
+    "# TYPE profile_clock_starts_total counter\n"
+)
+COUNTER_HEADER = (
+    "# HELP profile_counter Profile counter values.\n"
+    "# TYPE profile_counter untyped\n"
+)
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def build_labels(profile_id, name, object_id):
+    return 'profile="' + escape_label(profile_id) + '",' + name + '="' + escape_label(object_id) + '"'
+
+# Index of the power-of-two group holding a histogram bucket:  values of group g are
+# below 2^(g + 1) nanoseconds.
+def bucket_group(index):
+    if (index < profile.HISTOGRAM_SUB_COUNT):
+        return max(index.bit_length() - 1, 0)
+    return index // profile.HISTOGRAM_SUB_COUNT + profile.HISTOGRAM_SUB_BITS - 1
+
+# Read a clock under its lock:  (start_num, count, total nanos, counts per bucket bound).
+def read_clock(clock):
+    bounds = [0] * len(BUCKET_LABELS)
+    with clock.lock:
+        start_num = clock.start_num
+        histogram = clock.histogram
+        count = histogram.count
+        total = histogram.total
+        for index, num in histogram.buckets.items():
+            bound = bucket_group(index) + 1 - MIN_EXPONENT
+            if (bound < 0):
+                bound = 0
+            if (bound < len(bounds)):
+                bounds[bound] += num
+    return start_num, count, total, bounds
+
+def render_clocks(out, starts, clocks):
+    for clock in clocks:
+        labels = clock.metric_labels
+        if (labels is None):
+            labels = build_labels(clock.profile_id, "clock", clock.clock_id)
+            clock.metric_labels = labels
+        start_num, count, total, bounds = read_clock(clock)
+        bucket_prefix = "profile_clock_seconds_bucket{" + labels
+        cumulative = 0
+        for i in range(len(bounds)):
+            cumulative += bounds[i]
+            out.append(bucket_prefix + BUCKET_LABELS[i] + str(cumulative) + "\n")
+        out.append(bucket_prefix + INF_BUCKET_LABEL + str(count) + "\n")
+        out.append("profile_clock_seconds_sum{" + labels + "} " + format_seconds(total) + "\n")
+        out.append("profile_clock_seconds_count{" + labels + "} " + str(count) + "\n")
+        starts.append("profile_clock_starts_total{" + labels + "} " + str(start_num) + "\n")
+
+def render_counters(out, counters):
+    for counter in counters:
+        labels = counter.metric_labels
+        if (labels is None):
+            labels = build_labels(counter.profile_id, "counter", counter.counter_id)
+            counter.metric_labels = labels
+        out.append("profile_counter{" + labels + "} " + str(counter.value) + "\n")
+
+def render():
+    profiles = list(profileshare.get_profiles().values())
+    clocks = [HEADER]
+    starts = [STARTS_HEADER]
+    counters = [COUNTER_HEADER]
+    for prof in profiles:
+        render_clocks(clocks, starts, prof.get_clocks())
+        render_counters(counters, prof.get_counters())
+    return "".join(clocks) + "".join(starts) + "".join(counters)
+
+def metrics_view():
+    return Response(render(), mimetype=None, content_type=CONTENT_TYPE)
+
+def register_metrics(app):
+    app.add_url_rule(METRICS_PATH, METRICS_ENDPOINT, metrics_view, methods=["GET"])
@@ -0,0 +1,218 @@
+"""
+microbench.py
+timeit microbenchmarks for the pure-python hot functions of the task apps.
+
+Description:
+   Measures, at several input sizes (--sizes, tasks per dataset):
+      bucket_load        main.create_dataset_from_bucket - blob split / parse and task puts
+                         (TASK_BACKEND=local, so only our python code and localstore are timed)
+      ftask_load         ftask-api.load_task_file - parse a dataset file into Task objects
+      ftask_write        ftask-api.write_task_file - write a dataset file
+      marshal_tasks      flask_restful marshal(tasks, task_fields) of a task list (main.py)
+   and the per-call overhead of the profile module:
+      clock_start_stop   profile.clock_start + clock_stop
+      clock_with         with profile.clock(...)
+      clock_start_stop_disabled   clock_start + clock_stop while profiling is disabled
+      clock_with_disabled         with profile.clock(...) while profiling is disabled (NULL_SPAN)
+      counter_inc        profile.counter_inc
+
+   Each benchmark is run with timeit (autorange, then the best of --repeat runs) and
+   reported as microseconds per call and nanoseconds per task.  --output writes the
+   results as JSON; --baseline compares with an earlier --output, e.g. from the parent
+   commit, so the cost of a change is visible before and after it is made.
+
+   Example:
+      python microbench.py --output before.json
+      python microbench.py --baseline before.json
+      python microbench.py --only ftask --sizes 1000,100000
+
+"""
+import os
+import sys
+import json
+import timeit
+import shutil
+import atexit
+import argparse
+import tempfile
+import datetime
+import importlib.util
+
+# The apps read their configuration at import time.
+WORKDIR = tempfile.mkdtemp(prefix="microbench-")
+atexit.register(shutil.rmtree, WORKDIR, True)
+os.environ["TASK_BACKEND"] = "local"
+os.environ["LOCAL_STORAGE_DIR"] = os.path.join(WORKDIR, "local-storage")
+os.environ["FTASK_DATA_DIR"] = os.path.join(WORKDIR, "data")
+
+from flask_restful import marshal
+import profile
+import localstore
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = "100,1000,10000"
+BUCKET_NAME = "microbench"
+DATASETID = "microbench"
+
+# The app files have hyphens in their names - import them by path, once.
+APPS = {}
+
+def import_app(name, filename):
+    module = APPS.get(name)
+    if (module is None):
+        spec = importlib.util.spec_from_file_location(name, os.path.join(BASE_DIR, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        APPS[name] = module
+    return module
+
+def task_lines(size):
+    return ["task" + str(i) + ",The Task Number " + str(i) + "," + str(i % 1000) for i in range(size)]
+
+#
+# Benchmarks - each setup returns the function to time
+#
+def setup_bucket_load(size):
+    main = import_app("main", "main.py")
+    bucket = main.get_storage_client().lookup_bucket(BUCKET_NAME)
+    if (bucket is None):
+        localstore.StorageClient().create_bucket(BUCKET_NAME)
+        bucket = main.get_storage_client().get_bucket(BUCKET_NAME)
+    filename = "tasks" + str(size)
+    bucket.blob(filename + main.FILE_EXTENSION).upload_from_string("\n".join(task_lines(size)))
+    client = main.get_datastore_client()
+    key = main.get_dataset_key(client, DATASETID)
+    def run():
+        localstore.STORE.clear()
+        main.create_dataset_from_bucket(client, key, DATASETID, bucket, filename)
+    return run
+
+def setup_ftask_load(size):
+    ftask = import_app("ftask", "ftask-api.py")
+    filename = ftask.get_task_filename(DATASETID)
+    ftask.make_task_file_dirs(filename)
+    with open(filename, mode='wt') as taskfile:
+        taskfile.write("\n".join(task_lines(size)) + "\n")
+    def run():
+        ftask.load_task_file(DATASETID, {})
+    return run
+
+def setup_ftask_write(size):
+    ftask = import_app("ftask", "ftask-api.py")
+    filename = ftask.get_task_filename(DATASETID + "_write")
+    ftask.make_task_file_dirs(filename)
+    taskdict = {}
+    for i in range(size):
+        ftask.create_new_task(taskdict, DATASETID, "task" + str(i), "The Task Number " + str(i), str(i % 1000))
+    def run():
+        ftask.write_task_file(filename, taskdict)
+    return run
+
+def setup_marshal_tasks(size):
+    main = import_app("main", "main.py")
+    tasks = [main.new_task(DATASETID, "task" + str(i), "The Task Number " + str(i), i % 1000) for i in range(size)]
+    def run():
+        with main.app.test_request_context():
+            marshal(tasks, main.task_fields)
+    return run
+
+def setup_clock_start_stop(size):
+    def run():
+        profile.clock_start("microbench")
+        profile.clock_stop("microbench")
+    return run
+
+def setup_clock_with(size):
+    def run():
+        with profile.clock("microbench"):
+            pass
+    return run
+
+def setup_counter_inc(size):
+    def run():
+        profile.counter_inc("microbench")
+    return run
+
+# (name, setup, sized, profile enabled) - the disabled runs reuse the enabled setups
+BENCHMARKS = [
+    ("bucket_load", setup_bucket_load, True, True),
+    ("ftask_load", setup_ftask_load, True, True),
+    ("ftask_write", setup_ftask_write, True, True),
+    ("marshal_tasks", setup_marshal_tasks, True, True),
+    ("clock_start_stop", setup_clock_start_stop, False, True),
+    ("clock_with", setup_clock_with, False, True),
+    ("clock_start_stop_disabled", setup_clock_start_stop, False, False),
+    ("clock_with_disabled", setup_clock_with, False, False),
+    ("counter_inc", setup_counter_inc, False, True)
+]
+
+def time_function(func, repeat):
+    timer = timeit.Timer(func)
+    number, total = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return number, best / number
+
+def run_benchmarks(sizes, repeat, only):
+    results = {}
+    for name, setup, sized, enabled in BENCHMARKS:
+        if (only and not any(pattern in name for pattern in only)):
+            continue
+        for size in (sizes if sized else [1]):
+            if (enabled):
+                profile.enable()
+            else:
+                profile.disable()
+            func = setup(size)
+            number, seconds = time_function(func, repeat)
+            profile.enable()
+            profile.clear()
+            result_name = name + "[" + str(size) + "]" if sized else name
+            results[result_name] = {
+                "size": size,
+                "number": number,
+                "per_call_us": round(seconds * 1e6, 3),
+                "per_item_ns": round(seconds * 1e9 / size, 1)
+            }
+            line = "{:<26} {:>14.3f} us/call".format(result_name, seconds * 1e6)
+            if (sized):
+                line += " {:>12.1f} ns/task".format(seconds * 1e9 / size)
+            print(line, flush=True)
+    return results
+
+def compare_results(baseline, results):
+    print("\nBaseline comparison (us/call):")
+    for name, result in results.items():
+        before = baseline.get("results", {}).get(name)
+        if (before is None or not before["per_call_us"]):
+            continue
+        change = (result["per_call_us"] - before["per_call_us"]) / before["per_call_us"] * 100.0
+        print("   {:<26} {:>14.3f} -> {:>14.3f}  {:+.1f}%".format(name, before["per_call_us"], result["per_call_us"], change))
+
+def main():
+    argparser = argparse.ArgumentParser(description="Microbenchmarks for the task app hot functions")
+    argparser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma separated tasks per dataset")
+    argparser.add_argument("--repeat", type=int, default=5, help="timeit repeats - the best is reported")
+    argparser.add_argument("--only", help="comma separated benchmark name filters")
+    argparser.add_argument("--output", help="write the results to this JSON file")
+    argparser.add_argument("--baseline", help="compare with the results in this JSON file")
+    args = argparser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    only = args.only.split(",") if args.only else []
+    results = run_benchmarks(sizes, args.repeat, only)
+    if (args.output):
+        output = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "sizes": sizes,
+            "results": results
+        }
+        with open(args.output, mode='wt') as outfile:
+            json.dump(output, outfile, indent=4)
+    if (args.baseline):
+        with open(args.baseline, mode='rt') as basefile:
+            compare_results(json.load(basefile), results)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,18 +14,50 @@ Description:
    in-development for debugging and informational purposes.
    Please note this object is NOT a substitute for a real python profiler (product).
 
+The counter, clock and chain APIs below follow Profile.java (its CACHE API is
+not ported).
+
 PROFILE ID:
    Each public API method is associated with a profile_id.  The profile_id can be
    associated explicitely in each API call or implicitely with the default-value.
    When the profile_id is implicit, it is associated by using the constant
    DEFAULT_PROFILE_ID.
 
+COUNTER API
+   A counter manages the number of times that something occurs, or any other
+   value that is set or added to (e.g. bytes written).
+
+   Each counter is uniquely identified by a profile_id and a counter_id.
+
+   Example:
+      profile.counter_inc("counter-1")             # increment counter-1
+      profile.counter_inc("bytes", 512)            # add 512 to bytes
+      val = profile.counter_get("counter-1")       # get counter-1 value
+      profile.counter_reset("counter-1")           # reset counter-1 value
+
 CLOCK API
-   A clock maintains the elapsed time (in milliseconds) between start
-   and stop events. The elapsed time is accumulated between successive
-   start and stops. For example, if a method is called 100 times and has
-   a clock-start at its beginning and a clock-stop at its end, the elapsed
-   time of all 100 calls will be stored by the clock.
+   A clock maintains the elapsed time between start and stop events. The
+   elapsed time is accumulated between successive start and stops. For example,
+   if a method is called 100 times and has a clock-start at its beginning and
+   a clock-stop at its end, the elapsed time of all 100 calls will be stored
+   by the clock.
+
+   Clocks use the monotonic, high-resolution time.perf_counter_ns() and keep
+   nanosecond totals, so sub-millisecond spans are not lost and wall-clock
+   adjustments cannot produce negative times.  Elapsed times are reported in
+   UNIT - milliseconds by default, configurable with set_unit() or the
+   PROFILE_UNIT environment variable ("ns", "us", "ms" or "s").
+
+   Clocks are safe to use from concurrent requests.  The start of a span is kept
+   per thread / asyncio task (contextvars), so overlapping requests never share
+   a start timestamp, and completed spans are added to the clock under one of
+   CLOCK_LOCK_STRIPES striped locks.  Nested starts of the same clock in one
+   context are stacked and stopped innermost first.
+
+   Each clock also keeps a latency histogram of its spans for min/max/mean and
+   percentiles (p50, p90, p99, p999).  The histogram is log-bucketed with
+   2^HISTOGRAM_SUB_BITS sub-buckets per power of two (about 6% relative error),
+   so its memory is bounded no matter how many spans are recorded.
 
    Each clock is uniquely identified by a profile_id and a clock_id.
 
@@ -35,17 +67,114 @@ CLOCK API
       profile.clock_stop("get_datasets")
       print(profile.report())
 
+   The same clock as a context manager or a decorator - the clock is stopped
+   even when the block raises (e.g. a Flask abort):
+      with profile.clock("get_datasets"):
+         ... other code executed here
+
+      @profile.timed("get_datasets")
+      def get_datasets(client):
+         ...
+
+   When profiling is disabled, clock() returns a shared no-op object and timed
+   functions call straight through - no profile lookups and no allocations.
+
+CHAIN API
+   A chain records links - events that capture a timestamp, the process resident
+   set size (RSS) and, when memory tracing is on, the bytes currently allocated by
+   python (tracemalloc).  Each link stores the differences to the previous link of
+   the same chain in the same thread / request, so the memory growth and time of
+   each phase of a request can be read off the chain even under concurrency.
+   A chain keeps the most recent CHAIN_MAX_LINKS links.
+
+   Each chain is uniquely identified by a profile_id and a chain_id.
+
+   Example:
+      profile.memory_tracing(True)                 # optional - tracemalloc deltas
+      profile.chain_add_link("load", "begin")
+      ... other code executed here
+      profile.chain_add_link("load", "parsed")
+      print(profile.report())
+      profile.chain_reset("load")
+
+TRACE API
+   A trace records the nested clock spans of one request (e.g. GET_bucket_ep >
+   b_blobstr > b_tasks) with their offsets and durations, so single slow requests can
+   be inspected instead of only the aggregate clocks.  trace_begin() starts a trace in
+   the current thread / task; every clock started until trace_end() becomes a span.
+   instrument.py begins and ends a trace for every request.
+
+   Finished traces go into a ring buffer of the last TRACE_BUFFER_SIZE traces.  Traces
+   at or above the slow threshold (PROFILE_TRACE_SLOW_MS, default 1000) are also kept
+   among the TRACE_SLOW_MAX slowest and logged with print() as one line.
+
+   Example:
+      profile.trace_begin("load_all")
+      with profile.clock("parse"):
+         ...
+      profile.trace_end()
+      traces = profile.get_traces(10)              # the 10 slowest traces
+
 """
 import time
+import os
+import threading
+import contextvars
+import math
+import functools
+import collections
+import heapq
+import itertools
+import tracemalloc
 
 ENABLED = True
 DEFAULT_PROFILE_ID = "Profile1"
 PROFILES = {}
+PROFILES_LOCK = threading.Lock()
+
+# Completed spans are aggregated under a lock chosen by clock, so unrelated clocks
+# rarely contend.
+CLOCK_LOCK_STRIPES = 64
+CLOCK_LOCKS = [threading.Lock() for i in range(CLOCK_LOCK_STRIPES)]
+
+# In-flight span starts for the current thread / task:  {(profile_id, clock_id): (start, outer)}
+# where outer is the enclosing start of the same clock (or None).  The dict is copied on
+# write, so a context never sees starts made in another context.
+SPANS = contextvars.ContextVar("profile_spans", default=None)
+
+# Last link per chain for the current thread / task:  {(profile_id, chain_id): (nanos, rss, traced)}
+CHAIN_LINKS = contextvars.ContextVar("profile_chain_links", default=None)
+CHAIN_MAX_LINKS = 1000
+
+# Trace of the current request:  (trace, index of the innermost open span or None, depth)
+TRACE = contextvars.ContextVar("profile_trace", default=None)
+TRACING = os.environ.get("PROFILE_TRACING", "1") != "0"
+TRACE_BUFFER_SIZE = 256
+TRACE_SLOW_MAX = 100
+TRACE_MAX_SPANS = 512
+TRACE_SLOW_NANOS = int(os.environ.get("PROFILE_TRACE_SLOW_MS", "1000")) * 1000000
+TRACES_LOCK = threading.Lock()
+RECENT_TRACES = collections.deque(maxlen=TRACE_BUFFER_SIZE)
+SLOW_TRACES = []            # min-heap of (elapsed_nanos, seq, trace) - the slowest are kept
+TRACE_SEQ = itertools.count()
+
+# Reporting unit and the number of nanoseconds per unit.
+UNITS = {"ns": 1, "us": 1000, "ms": 1000000, "s": 1000000000}
+UNIT = os.environ.get("PROFILE_UNIT", "ms")
+UNIT_NANOS = UNITS.get(UNIT, UNITS["ms"])
 
 # Return current milliseconds - round is needed because int performs a floor.
 def cmillis():
    return int(round(time.time() * 1000))
 
+# Return the monotonic clock in nanoseconds - only differences are meaningful.
+def cnanos():
+   return time.perf_counter_ns()
+
+# Convert nanoseconds to the reporting unit.
+def to_unit(nanos):
+   return int(round(nanos / UNIT_NANOS))
+
 #
 # Profile API
 #
@@ -57,6 +186,16 @@ def enable():
     global ENABLED
     ENABLED = True
 
+def set_unit(unit):
+    global UNIT, UNIT_NANOS
+    if (unit not in UNITS):
+        raise ValueError("Unknown profile unit {} - use one of {}".format(unit, ", ".join(UNITS)))
+    UNIT = unit
+    UNIT_NANOS = UNITS[unit]
+
+def get_unit():
+    return UNIT
+
 def clear(profile_id=None):
     if (not ENABLED):
         return
@@ -83,6 +222,55 @@ def get_clocks(profile_id=None):
     clist = profile.get_clocks()
     return clist
 
+def get_counters(profile_id=None):
+    if (not ENABLED):
+        return []
+    if (profile_id is None):
+        profile_id = DEFAULT_PROFILE_ID
+    return get_profile(profile_id).get_counters()
+
+def get_chains(profile_id=None):
+    if (not ENABLED):
+        return []
+    if (profile_id is None):
+        profile_id = DEFAULT_PROFILE_ID
+    return get_profile(profile_id).get_chains()
+
+#
+# Counter API
+#
+def counter_inc(counter_id, amount=1, profile_id=None):
+    if (not ENABLED):
+        return
+    if (profile_id is None):
+        profile_id = DEFAULT_PROFILE_ID
+    counter = get_counter(profile_id, counter_id)
+    counter.add(amount)
+
+def counter_set(counter_id, value, profile_id=None):
+    if (not ENABLED):
+        return
+    if (profile_id is None):
+        profile_id = DEFAULT_PROFILE_ID
+    counter = get_counter(profile_id, counter_id)
+    counter.set(value)
+
+def counter_get(counter_id, profile_id=None):
+    if (not ENABLED):
+        return
+    if (profile_id is None):
+        profile_id = DEFAULT_PROFILE_ID
+    counter = get_counter(profile_id, counter_id)
+    return counter.value
+
+def counter_reset(counter_id, profile_id=None):
+    if (not ENABLED):
+        return
+    if (profile_id is None):
+        profile_id = DEFAULT_PROFILE_ID
+    counter = get_counter(profile_id, counter_id)
+    counter.set(0)
+
 #
 # Clock API
 #
@@ -91,18 +279,45 @@ def clock_start(clock_id, profile_id=None):
         return
     if (profile_id is None):
         profile_id = DEFAULT_PROFILE_ID
-    millis = cmillis()
     clock = get_clock(profile_id, clock_id)
-    clock.update_start(millis)
+    nanos = cnanos()
+    push_span((profile_id, clock_id), nanos)
+    clock.update_start(nanos)
+    if (TRACE.get() is not None):
+        trace_open_span(clock_id, nanos)
 
 def clock_stop(clock_id, profile_id=None):
     if (not ENABLED):
         return
     if (profile_id is None):
         profile_id = DEFAULT_PROFILE_ID
-    millis = cmillis()
+    nanos = cnanos()
+    start = pop_span((profile_id, clock_id))
     clock = get_clock(profile_id, clock_id)
-    clock.update_stop(millis)
+    clock.update_stop(nanos, start)
+    if (TRACE.get() is not None):
+        trace_close_span(clock_id, nanos)
+
+# Context manager form:  with profile.clock("GET_Task"): ...
+def clock(clock_id, profile_id=None):
+    if (not ENABLED):
+        return NULL_SPAN
+    return ClockSpan(clock_id, profile_id)
+
+# Decorator form:  @profile.timed("GET_Task")
+def timed(clock_id, profile_id=None):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if (not ENABLED):
+                return func(*args, **kwargs)
+            clock_start(clock_id, profile_id)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                clock_stop(clock_id, profile_id)
+        return wrapper
+    return decorator
 
 def clock_get_elapsed_time(clock_id, profile_id=None):
     if (not ENABLED):
@@ -112,6 +327,167 @@ def clock_get_elapsed_time(clock_id, profile_id=None):
     clock = get_clock(profile_id, clock_id)
     return clock.elapsed_time
 
+#
+# Chain API
+#
+def chain_add_link(chain_id, link_id, profile_id=None):
+    if (not ENABLED):
+        return
+    if (profile_id is None):
+        profile_id = DEFAULT_PROFILE_ID
+    nanos = cnanos()
+    rss = get_rss()
+    traced = None
+    if (tracemalloc.is_tracing()):
+        traced = tracemalloc.get_traced_memory()[0]
+    previous = swap_chain_link((profile_id, chain_id), (nanos, rss, traced))
+    chain = get_chain(profile_id, chain_id)
+    chain.add_link(Link(link_id, nanos, rss, traced, previous))
+
+def chain_reset(chain_id, profile_id=None):
+    if (not ENABLED):
+        return
+    if (profile_id is None):
+        profile_id = DEFAULT_PROFILE_ID
+    chain = get_chain(profile_id, chain_id)
+    chain.reset()
+
+#
+# Trace API
+#
+def trace_begin(name, profile_id=None):
+    if (not ENABLED or not TRACING):
+        return
+    if (profile_id is None):
+        profile_id = DEFAULT_PROFILE_ID
+    TRACE.set((Trace(name, profile_id, cnanos()), None, 0))
+
+def trace_end():
+    state = TRACE.get()
+    if (state is None):
+        return
+    TRACE.set(None)
+    trace = state[0]
+    trace.finish(cnanos())
+    record_trace(trace)
+
+# The n slowest traces of the ring buffer and the slow-trace store, slowest first.
+def get_traces(n=10):
+    with TRACES_LOCK:
+        traces = set(RECENT_TRACES)
+        traces.update(trace for elapsed, seq, trace in SLOW_TRACES)
+    return heapq.nlargest(n, traces, key=lambda trace: trace.elapsed_nanos)
+
+def clear_traces():
+    with TRACES_LOCK:
+        RECENT_TRACES.clear()
+        del SLOW_TRACES[:]
+
+def set_trace_threshold(millis):
+    global TRACE_SLOW_NANOS
+    if (millis < 0):
+        raise ValueError("The slow trace threshold must not be negative")
+    TRACE_SLOW_NANOS = millis * 1000000
+
+def get_trace_threshold():
+    return TRACE_SLOW_NANOS // 1000000
+
+# Drop the open spans and last chain links of the current thread / task.  Server threads
+# are reused, so call it when a request ends - a span left open by an exception would
+# otherwise nest every later start of that clock, and the next request's first chain
+# delta would be measured against this request's last link.
+def reset_context():
+    if (SPANS.get() is not None):
+        SPANS.set(None)
+    if (CHAIN_LINKS.get() is not None):
+        CHAIN_LINKS.set(None)
+
+# tracemalloc makes allocation deltas exact but slows python allocations - off by default.
+def memory_tracing(enable):
+    if (enable and not tracemalloc.is_tracing()):
+        tracemalloc.start()
+    elif (not enable and tracemalloc.is_tracing()):
+        tracemalloc.stop()
+
+#
+# Span Implementation
+#
+class ClockSpan(object):
+    __slots__ = ('clock_id', 'profile_id')
+
+    def __init__(self, clock_id, profile_id):
+        self.clock_id = clock_id
+        self.profile_id = profile_id
+
+    def __enter__(self):
+        clock_start(self.clock_id, self.profile_id)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        clock_stop(self.clock_id, self.profile_id)
+        return False
+
+class NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def push_span(key, nanos):
+    spans = SPANS.get()
+    if (spans is None):
+        spans = {key: (nanos, None)}
+    else:
+        spans = dict(spans)
+        spans[key] = (nanos, spans.get(key))
+    SPANS.set(spans)
+
+# Return the start of the innermost open span for key, or None.
+def pop_span(key):
+    spans = SPANS.get()
+    if (spans is None or key not in spans):
+        return None
+    start, outer = spans[key]
+    spans = dict(spans)
+    if (outer is None):
+        del spans[key]
+    else:
+        spans[key] = outer
+    SPANS.set(spans)
+    return start
+
+# Set the last link of a chain for this context and return the previous one (or None).
+def swap_chain_link(key, link):
+    links = CHAIN_LINKS.get()
+    if (links is None):
+        links = {}
+    else:
+        links = dict(links)
+    previous = links.get(key)
+    links[key] = link
+    CHAIN_LINKS.set(links)
+    return previous
+
+# Resident set size in bytes - /proc on Linux, otherwise the peak RSS from getrusage.
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def get_rss():
+    try:
+        with open("/proc/self/statm", mode='rt') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, OSError):
+        return 0
+
 #
 # Profile Implementation
 #
@@ -119,79 +495,358 @@ class Profile(object):
     def __init__(self, profile_id):
         self.profile_id = profile_id
         self.clocks = {}
+        self.counters = {}
+        self.chains = {}
 
+    # Swap in empty dicts - objects still held by in-flight requests simply stop being reported.
     def clear(self):
-        for clock_id in self.clocks:
-            clock = self.clocks.get(clock_id)
-            clock.release()
-        self.clocks = {}
+        with PROFILES_LOCK:
+            self.clocks = {}
+            self.counters = {}
+            self.chains = {}
 
     def get_report(self):
         out = "\nProfile: "
         out += self.profile_id
-        for clock_id in self.clocks:
-            clock = self.clocks.get(clock_id)
-            cstr = "\n  Clock: " + clock.clock_id + "  elapsed: " + str(clock.elapsed_time) + "  start/stop: " + str(clock.start_num) + "/" + str(clock.stop_num)
+        for clock in self.get_clocks():
+            cstr = "\n  Clock: " + clock.clock_id + "  elapsed: " + str(clock.elapsed_time) + " " + UNIT + "  start/stop: " + str(clock.start_num) + "/" + str(clock.stop_num)
+            stats = clock.get_stats()
+            cstr += "\n         min/mean/max: " + str(stats['min']) + "/" + str(stats['mean']) + "/" + str(stats['max'])
+            cstr += "  p50/p90/p99/p999: " + str(stats['p50']) + "/" + str(stats['p90']) + "/" + str(stats['p99']) + "/" + str(stats['p999'])
             out += cstr
+        for counter in self.get_counters():
+            out += "\n  Counter: " + counter.counter_id + "  value: " + str(counter.value)
+        for chain in self.get_chains():
+            out += "\n  Chain: " + chain.chain_id
+            for link in chain.get_links():
+                out += "\n     Link: " + link.link_id + "  rss: " + format_bytes(link.rss)
+                if (link.elapsed_nanos is not None):
+                    out += "  elapsed: " + str(to_unit(link.elapsed_nanos)) + " " + UNIT
+                    out += "  rss delta: " + format_bytes(link.rss_delta)
+                if (link.traced_delta is not None):
+                    out += "  alloc delta: " + format_bytes(link.traced_delta)
         return out
 
     def get_clocks(self):
-        clist = []
-        for clock_id in self.clocks:
-            clock = self.clocks.get(clock_id)
-            clist.append(clock)
-        return clist
+        # list() copies the values in one step, safe against concurrent inserts
+        return list(self.clocks.values())
+
+    def get_counters(self):
+        return list(self.counters.values())
 
+    def get_chains(self):
+        return list(self.chains.values())
+
+# Lookups are lock-free; only creation takes PROFILES_LOCK (and re-checks under it).
 def get_profile(profile_id):
-    profile = None
-    if (profile_id in PROFILES):
-        profile = PROFILES[profile_id]
-    else:
-        profile = Profile(profile_id=profile_id)
-        PROFILES[profile_id] = profile
+    profile = PROFILES.get(profile_id)
+    if (profile is None):
+        with PROFILES_LOCK:
+            profile = PROFILES.get(profile_id)
+            if (profile is None):
+                profile = Profile(profile_id=profile_id)
+                PROFILES[profile_id] = profile
     return profile
 
+#
+# Histogram Implementation
+#
+# Values (nanoseconds) below 2^HISTOGRAM_SUB_BITS have exact buckets.  Larger values are
+# bucketed by power of two, each split into 2^HISTOGRAM_SUB_BITS linear sub-buckets, so a
+# 64 bit range needs at most HISTOGRAM_MAX_BUCKETS counters.
+HISTOGRAM_SUB_BITS = 4
+HISTOGRAM_SUB_COUNT = 1 << HISTOGRAM_SUB_BITS
+HISTOGRAM_MAX_BUCKETS = (64 - HISTOGRAM_SUB_BITS + 1) * HISTOGRAM_SUB_COUNT
+PERCENTILES = [("p50", 50.0), ("p90", 90.0), ("p99", 99.0), ("p999", 99.9)]
+
+def bucket_index(value):
+    if (value < HISTOGRAM_SUB_COUNT):
+        return value
+    shift = value.bit_length() - HISTOGRAM_SUB_BITS - 1
+    return (shift + 1) * HISTOGRAM_SUB_COUNT + (value >> shift) - HISTOGRAM_SUB_COUNT
+
+# Return the (lowest, highest) value that falls into a bucket.
+def bucket_bounds(index):
+    if (index < HISTOGRAM_SUB_COUNT):
+        return (index, index)
+    shift = index // HISTOGRAM_SUB_COUNT - 1
+    sub = index % HISTOGRAM_SUB_COUNT + HISTOGRAM_SUB_COUNT
+    return (sub << shift, ((sub + 1) << shift) - 1)
+
+class Histogram(object):
+    def __init__(self):
+        self.buckets = {}       # sparse:  bucket index -> count (at most HISTOGRAM_MAX_BUCKETS)
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def reset(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def record(self, value):
+        if (value < 0):
+            value = 0
+        index = bucket_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        if (self.count == 0 or value < self.min):
+            self.min = value
+        if (value > self.max):
+            self.max = value
+        self.count += 1
+        self.total += value
+
+    def mean(self):
+        if (self.count == 0):
+            return 0
+        return self.total / self.count
+
+    # Midpoint of the bucket holding the percentile, clamped to the observed min/max.
+    def percentile(self, percent):
+        if (self.count == 0):
+            return 0
+        target = max(1, int(math.ceil(percent / 100.0 * self.count)))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if (seen >= target):
+                low, high = bucket_bounds(index)
+                return min(max((low + high) // 2, self.min), self.max)
+        return self.max
+
 #
 # Clock Implementation
 #
+# start/stop are perf_counter_ns() timestamps and elapsed_nanos is the nanosecond total.
+# elapsed_time is derived from the total, so it is always in the current UNIT.
 class Clock(object):
     def __init__(self, profile_id, clock_id):
         self.profile_id = profile_id
         self.clock_id = clock_id
         self.start = -1
         self.stop = -1
-        self.elapsed_time = 0
+        self.elapsed_nanos = 0
         self.start_num = 0
         self.stop_num = 0
+        self.histogram = Histogram()
+        self.lock = CLOCK_LOCKS[hash((profile_id, clock_id)) % CLOCK_LOCK_STRIPES]
+        self.metric_labels = None       # exposition labels, built once by metrics.py
+
+    @property
+    def elapsed_time(self):
+        return to_unit(self.elapsed_nanos)
+
+    # Span statistics in the current UNIT:  min, max, mean, p50, p90, p99, p999.
+    def get_stats(self):
+        with self.lock:
+            stats = {
+                'min': to_unit(self.histogram.min),
+                'max': to_unit(self.histogram.max),
+                'mean': to_unit(self.histogram.mean())
+            }
+            for name, percent in PERCENTILES:
+                stats[name] = to_unit(self.histogram.percentile(percent))
+        return stats
 
     def release(self):
         self.profile_id = None
         self.clock_id = None
 
     def reset(self):
-        self.start = -1
-        self.stop = -1
-        self.elapsed_time = 0
-        self.start_num = 0
-        self.stop_num = 0
+        with self.lock:
+            self.start = -1
+            self.stop = -1
+            self.elapsed_nanos = 0
+            self.start_num = 0
+            self.stop_num = 0
+            self.histogram.reset()
 
-    def update_start(self, millis):
-        self.start = millis
-        self.stop = -1
-        self.start_num += 1
+    # start/stop keep the most recent timestamps (informational only).
+    def update_start(self, nanos):
+        with self.lock:
+            self.start = nanos
+            self.stop = -1
+            self.start_num += 1
+
+    # start is this context's span start - None for a stop without a matching start.
+    def update_stop(self, nanos, start):
+        with self.lock:
+            if (start is not None):
+                self.stop = nanos
+                self.elapsed_nanos += (nanos - start)
+                self.histogram.record(nanos - start)
+            self.stop_num += 1
 
-    def update_stop(self, millis):
-        if (self.start != -1):
-            self.stop = millis
-            self.elapsed_time += (self.stop - self.start)
-        self.stop_num += 1
+#
+# Counter Implementation
+#
+class Counter(object):
+    def __init__(self, profile_id, counter_id):
+        self.profile_id = profile_id
+        self.counter_id = counter_id
+        self.value = 0
+        self.lock = CLOCK_LOCKS[hash((profile_id, counter_id)) % CLOCK_LOCK_STRIPES]
+        self.metric_labels = None
+
+    def add(self, amount):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+def get_counter(profile_id, counter_id):
+    profile = get_profile(profile_id)
+    counter = profile.counters.get(counter_id)
+    if (counter is None):
+        with PROFILES_LOCK:
+            counter = profile.counters.get(counter_id)
+            if (counter is None):
+                counter = Counter(profile_id, counter_id)
+                profile.counters[counter_id] = counter
+    return counter
+
+#
+# Chain Implementation
+#
+# A link stores its absolute values and the deltas to the previous link of the chain
+# in the same context (None for the first link).
+class Link(object):
+    def __init__(self, link_id, nanos, rss, traced, previous):
+        self.link_id = link_id
+        self.nanos = nanos
+        self.rss = rss
+        self.traced = traced
+        self.elapsed_nanos = None
+        self.rss_delta = None
+        self.traced_delta = None
+        if (previous is not None):
+            self.elapsed_nanos = nanos - previous[0]
+            self.rss_delta = rss - previous[1]
+            if (traced is not None and previous[2] is not None):
+                self.traced_delta = traced - previous[2]
+
+class Chain(object):
+    def __init__(self, profile_id, chain_id):
+        self.profile_id = profile_id
+        self.chain_id = chain_id
+        self.links = collections.deque(maxlen=CHAIN_MAX_LINKS)
+
+    def add_link(self, link):
+        # deque.append is atomic
+        self.links.append(link)
+
+    def get_links(self):
+        return list(self.links)
+
+    def reset(self):
+        self.links.clear()
+
+def get_chain(profile_id, chain_id):
+    profile = get_profile(profile_id)
+    chain = profile.chains.get(chain_id)
+    if (chain is None):
+        with PROFILES_LOCK:
+            chain = profile.chains.get(chain_id)
+            if (chain is None):
+                chain = Chain(profile_id, chain_id)
+                profile.chains[chain_id] = chain
+    return chain
+
+#
+# Trace Implementation
+#
+# A span is [clock_id, parent index, depth, start nanos, stop nanos (None while open)].
+# The innermost open span is kept in the TRACE context variable, so threads that run
+# with a copy of the request context nest their spans correctly.
+class Trace(object):
+    def __init__(self, name, profile_id, nanos):
+        self.name = name
+        self.profile_id = profile_id
+        self.time = time.time()
+        self.start = nanos
+        self.elapsed_nanos = None
+        self.spans = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    # Threads of one request (e.g. executor threads running in a copy of its context)
+    # share the trace - appending a span and taking its index is one step.
+    def add_span(self, clock_id, parent, depth, nanos):
+        with self.lock:
+            if (len(self.spans) >= TRACE_MAX_SPANS):
+                self.dropped += 1
+                return None
+            self.spans.append([clock_id, parent, depth, nanos, None])
+            return len(self.spans) - 1
+
+    def finish(self, nanos):
+        self.elapsed_nanos = nanos - self.start
+        with self.lock:
+            for span in self.spans:
+                if (span[4] is None):
+                    span[4] = nanos
+
+    def get_summary(self):
+        out = self.name + " " + str(to_unit(self.elapsed_nanos)) + " " + UNIT
+        for clock_id, parent, depth, start, stop in self.spans:
+            out += " | " + "  " * depth + clock_id + " +" + str(to_unit(start - self.start)) + " " + str(to_unit(stop - start))
+        return out
+
+def trace_open_span(clock_id, nanos):
+    trace, parent, depth = TRACE.get()
+    index = trace.add_span(clock_id, parent, depth, nanos)
+    if (index is not None):
+        TRACE.set((trace, index, depth + 1))
+
+# Close the innermost open span of clock_id - spans opened inside it and never
+# stopped are closed with it.
+def trace_close_span(clock_id, nanos):
+    trace, index, depth = TRACE.get()
+    found = index
+    while (found is not None and trace.spans[found][0] != clock_id):
+        found = trace.spans[found][1]
+    if (found is None):
+        return
+    while (True):
+        span = trace.spans[index]
+        span[4] = nanos
+        if (index == found):
+            break
+        index = span[1]
+    TRACE.set((trace, span[1], span[2]))
+
+def record_trace(trace):
+    slow = trace.elapsed_nanos >= TRACE_SLOW_NANOS
+    with TRACES_LOCK:
+        RECENT_TRACES.append(trace)
+        if (slow):
+            entry = (trace.elapsed_nanos, next(TRACE_SEQ), trace)
+            if (len(SLOW_TRACES) < TRACE_SLOW_MAX):
+                heapq.heappush(SLOW_TRACES, entry)
+            else:
+                heapq.heappushpop(SLOW_TRACES, entry)
+    if (slow):
+        print("Slow request: " + trace.get_summary(), flush=True)
+
+# Signed byte counts as KB / MB for the text report.
+def format_bytes(nbytes):
+    if (abs(nbytes) >= 1024 * 1024):
+        return "{:.1f} MB".format(nbytes / (1024.0 * 1024.0))
+    return "{:.1f} KB".format(nbytes / 1024.0)
 
 def get_clock(profile_id, clock_id):
-    clock = None
     profile = get_profile(profile_id)
-    if (clock_id in profile.clocks):
-        clock = profile.clocks[clock_id]
-    else:
-        clock = Clock(profile_id, clock_id)
-        profile.clocks[clock_id] = clock
+    clock = profile.clocks.get(clock_id)
+    if (clock is None):
+        with PROFILES_LOCK:
+            clock = profile.clocks.get(clock_id)
+            if (clock is None):
+                clock = Clock(profile_id, clock_id)
+                profile.clocks[clock_id] = clock
     return clock
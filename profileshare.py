@@ -0,0 +1,335 @@
+"""
+profileshare.py
+Host-wide profile aggregation for apps served by several worker processes.
+
+Description:
+   Every worker process has its own profile.PROFILES, so without sharing a report only
+   shows the worker that happened to answer, and enable / disable / clear only reach
+   that one worker.
+
+   Sharing is on when PROFILE_SHARED_DIR names a directory (created if needed):
+      profile-<pid>.json    each process dumps its clocks and counters there every
+                            PROFILE_SHARE_INTERVAL seconds (default 2) and at exit
+      control.json          the host-wide profile state:  enabled and a clear generation
+
+   enable() / disable() / clear() update control.json (under an flock) and apply to the
+   local process at once; the other workers apply it on their next interval.  Clears are
+   counted by generation, so dumps written before the latest clear are ignored.
+
+   get_profiles() / get_clocks() / get_counters() merge the dumps of all processes with
+   the live data of the current one:  clock totals, span counts and histogram buckets are
+   added (so percentiles are host-wide percentiles), counters are summed.  Dumps of
+   processes that have exited are kept until the next clear, so their requests still count.
+   The merge is cached and redone at most once per PROFILE_SHARE_INTERVAL (the dumps do
+   not change faster) or after a clear - /metrics scrapes and reports in between reuse it.
+
+   Chains and traces stay per process - they are request samples, not totals.
+   Without PROFILE_SHARED_DIR every function falls through to the local profile module.
+
+   Example:
+      PROFILE_SHARED_DIR=/tmp/profile gunicorn -w 4 wsgi:app
+
+"""
+import os
+import json
+import time
+import atexit
+import threading
+import profile
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SHARED_DIR = os.environ.get("PROFILE_SHARED_DIR")
+SHARE_INTERVAL = float(os.environ.get("PROFILE_SHARE_INTERVAL", "2"))
+CONTROL_FILE = "control.json"
+CONTROL_LOCK_FILE = "control.lock"
+DUMP_PREFIX = "profile-"
+DUMP_SUFFIX = ".json"
+
+SHARER = None
+SHARER_LOCK = threading.Lock()
+CLEAR_GEN = 0               # last clear generation applied in this process
+CONTROL_STAMP = None        # (mtime_ns, size) of the control file last applied
+MERGED = None               # (monotonic time, clear gen, {profile_id: Profile}) of the last merge
+MERGED_LOCK = threading.Lock()
+
+def is_shared():
+    return SHARED_DIR is not None
+
+def get_dump_filename(pid):
+    return os.path.join(SHARED_DIR, DUMP_PREFIX + str(pid) + DUMP_SUFFIX)
+
+# Atomic write - readers never see a partial file.
+def write_json(filename, data):
+    tmpname = filename + ".tmp." + str(os.getpid())
+    with open(tmpname, mode='wt') as tmpfile:
+        json.dump(data, tmpfile)
+    os.replace(tmpname, filename)
+
+def read_json(filename):
+    try:
+        with open(filename, mode='rt') as jsonfile:
+            return json.load(jsonfile)
+    except (OSError, ValueError):
+        return None
+
+#
+# Host-wide Control
+#
+def read_control():
+    control = read_json(os.path.join(SHARED_DIR, CONTROL_FILE))
+    if (control is None):
+        control = {"enabled": profile.ENABLED, "clear_gen": 0}
+    return control
+
+# Read-modify-write of the control file under an exclusive flock.
+def update_control(update):
+    with open(os.path.join(SHARED_DIR, CONTROL_LOCK_FILE), mode='a') as lockfile:
+        if (fcntl is not None):
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            control = read_control()
+            update(control)
+            write_json(os.path.join(SHARED_DIR, CONTROL_FILE), control)
+        finally:
+            if (fcntl is not None):
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+    apply_control(control)
+
+def apply_control(control):
+    global CLEAR_GEN
+    if (control["enabled"]):
+        profile.enable()
+    else:
+        profile.disable()
+    if (control["clear_gen"] > CLEAR_GEN):
+        CLEAR_GEN = control["clear_gen"]
+        for profile_id in list(profile.PROFILES):
+            profile.get_profile(profile_id).clear()
+
+# Apply the control file only when it changed since the last check.
+def poll_control():
+    global CONTROL_STAMP
+    try:
+        stat = os.stat(os.path.join(SHARED_DIR, CONTROL_FILE))
+    except OSError:
+        return
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    if (stamp != CONTROL_STAMP):
+        CONTROL_STAMP = stamp
+        apply_control(read_control())
+
+def enable():
+    if (not is_shared()):
+        return profile.enable()
+    update_control(lambda control: control.update(enabled=True))
+
+def disable():
+    if (not is_shared()):
+        return profile.disable()
+    update_control(lambda control: control.update(enabled=False))
+
+def clear():
+    if (not is_shared()):
+        return profile.clear()
+    def next_gen(control):
+        control["clear_gen"] = max(control["clear_gen"], CLEAR_GEN) + 1
+    update_control(next_gen)
+    remove_exited_dumps()
+
+#
+# Process Dumps
+#
+def dump_clock(clock):
+    with clock.lock:
+        histogram = clock.histogram
+        return {
+            "elapsed_nanos": clock.elapsed_nanos,
+            "start_num": clock.start_num,
+            "stop_num": clock.stop_num,
+            "count": histogram.count,
+            "total": histogram.total,
+            "min": histogram.min,
+            "max": histogram.max,
+            "buckets": list(histogram.buckets.items())
+        }
+
+def dump_local():
+    profiles = {}
+    for prof in list(profile.PROFILES.values()):
+        profiles[prof.profile_id] = {
+            "clocks": dict((clock.clock_id, dump_clock(clock)) for clock in prof.get_clocks()),
+            "counters": dict((counter.counter_id, counter.value) for counter in prof.get_counters())
+        }
+    return {"pid": os.getpid(), "time": time.time(), "clear_gen": CLEAR_GEN, "profiles": profiles}
+
+def write_dump():
+    write_json(get_dump_filename(os.getpid()), dump_local())
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+def list_dump_pids():
+    pids = []
+    for name in os.listdir(SHARED_DIR):
+        if (name.startswith(DUMP_PREFIX) and name.endswith(DUMP_SUFFIX)):
+            try:
+                pids.append(int(name[len(DUMP_PREFIX):-len(DUMP_SUFFIX)]))
+            except ValueError:
+                pass
+    return pids
+
+def remove_exited_dumps():
+    for pid in list_dump_pids():
+        if (not is_running(pid)):
+            try:
+                os.remove(get_dump_filename(pid))
+            except OSError:
+                pass
+
+# The current dump of every process - the live state for this one.
+def read_dumps():
+    poll_control()
+    clear_gen = read_control()["clear_gen"]
+    dumps = [dump_local()]
+    for pid in list_dump_pids():
+        if (pid == os.getpid()):
+            continue
+        dump = read_json(get_dump_filename(pid))
+        if (dump is not None and dump["clear_gen"] >= clear_gen):
+            dumps.append(dump)
+    return dumps
+
+#
+# Merged Profiles
+#
+def merge_clock(clock, data):
+    histogram = clock.histogram
+    if (data["count"] > 0):
+        if (histogram.count == 0 or data["min"] < histogram.min):
+            histogram.min = data["min"]
+        histogram.max = max(histogram.max, data["max"])
+    histogram.count += data["count"]
+    histogram.total += data["total"]
+    for index, count in data["buckets"]:
+        histogram.buckets[index] = histogram.buckets.get(index, 0) + count
+    clock.elapsed_nanos += data["elapsed_nanos"]
+    clock.start_num += data["start_num"]
+    clock.stop_num += data["stop_num"]
+
+def merge_dumps():
+    merged = {}
+    for dump in read_dumps():
+        for profile_id, data in dump["profiles"].items():
+            prof = merged.get(profile_id)
+            if (prof is None):
+                prof = profile.Profile(profile_id)
+                merged[profile_id] = prof
+            for clock_id, clock_data in data["clocks"].items():
+                clock = prof.clocks.get(clock_id)
+                if (clock is None):
+                    clock = profile.Clock(profile_id, clock_id)
+                    prof.clocks[clock_id] = clock
+                merge_clock(clock, clock_data)
+            for counter_id, value in data["counters"].items():
+                counter = prof.counters.get(counter_id)
+                if (counter is None):
+                    counter = profile.Counter(profile_id, counter_id)
+                    prof.counters[counter_id] = counter
+                counter.value += value
+    return merged
+
+# Host-wide Profile objects (not registered in profile.PROFILES), keyed by profile_id.
+# Concurrent callers wait for one merge instead of each doing their own.
+def get_profiles():
+    global MERGED
+    if (not is_shared()):
+        return dict(profile.PROFILES)
+    with MERGED_LOCK:
+        merged = MERGED
+        if (merged is None or merged[1] != CLEAR_GEN or time.monotonic() - merged[0] >= SHARE_INTERVAL):
+            start = time.monotonic()
+            clear_gen = CLEAR_GEN
+            merged = (start, clear_gen, merge_dumps())
+            MERGED = merged
+        return dict(merged[2])
+
+def get_profile(profile_id):
+    if (profile_id is None):
+        profile_id = profile.DEFAULT_PROFILE_ID
+    prof = get_profiles().get(profile_id)
+    if (prof is None):
+        prof = profile.Profile(profile_id)
+    return prof
+
+def get_clocks(profile_id=None):
+    if (not profile.ENABLED):
+        return []
+    if (not is_shared()):
+        return profile.get_clocks(profile_id)
+    return get_profile(profile_id).get_clocks()
+
+def get_counters(profile_id=None):
+    if (not profile.ENABLED):
+        return []
+    if (not is_shared()):
+        return profile.get_counters(profile_id)
+    return get_profile(profile_id).get_counters()
+
+#
+# Share Thread
+#
+class Sharer(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self, name="profile-share", daemon=True)
+        self.pid = os.getpid()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while (not self.stopped.wait(SHARE_INTERVAL)):
+            try:
+                poll_control()
+                write_dump()
+            except OSError as e:
+                print("Profile dump not written: " + str(e))
+
+# Start dumping from this process - safe to call again, and forked children
+# (e.g. gunicorn workers of a preloaded app) start their own thread.
+def start():
+    global SHARER
+    if (not is_shared()):
+        return
+    with SHARER_LOCK:
+        if (SHARER is not None and SHARER.pid == os.getpid()):
+            return
+        os.makedirs(SHARED_DIR, exist_ok=True)
+        poll_control()
+        SHARER = Sharer()
+        SHARER.start()
+
+def restart_in_child():
+    global SHARER_LOCK, SHARER
+    SHARER_LOCK = threading.Lock()
+    if (SHARER is not None):
+        SHARER = None
+        start()
+
+def write_final_dump():
+    if (SHARER is not None and SHARER.pid == os.getpid()):
+        try:
+            write_dump()
+        except OSError:
+            pass
+
+if (is_shared()):
+    atexit.register(write_final_dump)
+    if (hasattr(os, "register_at_fork")):
+        os.register_at_fork(after_in_child=restart_in_child)
@@ -0,0 +1,183 @@
+"""
+replay.py
+Replays recorded request logs against task-api.py, ftask-api.py or main.py.
+
+Description:
+   Reads a JSON lines file written by the request recorder (RECORD_FILE, see
+   instrument.py) - one request per line with time, name, method, path, content_type,
+   body, status and elapsed_ms - and sends the requests to --url:
+      --speed 1     original pace (the recorded gaps between requests)
+      --speed 10    10 times faster
+      --speed 0     as fast as --concurrency allows
+
+   The report compares, per endpoint (<METHOD>_<endpoint>), the recorded server latency
+   with the latency seen on replay (p50 / p99 and the change in percent), and counts
+   errors and responses whose status differs from the recording.  --output writes it as
+   JSON.  Lines without method and path are skipped (and counted).
+
+   Example:
+      RECORD_FILE=traffic.jsonl python ftask-api.py          # record
+      python replay.py traffic.jsonl --speed 5 --output replay.json
+
+"""
+import sys
+import json
+import math
+import time
+import argparse
+import threading
+import concurrent.futures
+import requests
+
+HOST_URL = "http://127.0.0.1:5000"
+
+def read_records(filename, limit):
+    records = []
+    skipped = 0
+    with open(filename, mode='rt') as recordfile:
+        for line in recordfile:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            if (not isinstance(record, dict) or "method" not in record or "path" not in record):
+                skipped += 1
+                continue
+            records.append(record)
+            if (limit is not None and len(records) >= limit):
+                break
+    records.sort(key=lambda record: record.get("time", 0))
+    return records, skipped
+
+#
+# Replay
+#
+class Results(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def add(self, record, elapsed_ms, status):
+        name = record.get("name") or (record["method"] + " " + record["path"].split("?")[0])
+        with self.lock:
+            endpoint = self.endpoints.get(name)
+            if (endpoint is None):
+                endpoint = {"recorded": [], "replayed": [], "errors": 0, "status_changed": 0}
+                self.endpoints[name] = endpoint
+            if (record.get("elapsed_ms") is not None):
+                endpoint["recorded"].append(record["elapsed_ms"])
+            if (status is None):
+                endpoint["errors"] += 1
+                return
+            endpoint["replayed"].append(elapsed_ms)
+            if (record.get("status") is not None and status != record["status"]):
+                endpoint["status_changed"] += 1
+
+def send(session_local, base, record, results):
+    session = getattr(session_local, "session", None)
+    if (session is None):
+        session = requests.Session()
+        session_local.session = session
+    headers = {}
+    if (record.get("content_type")):
+        headers["Content-Type"] = record["content_type"]
+    body = record.get("body")
+    start = time.perf_counter()
+    try:
+        response = session.request(record["method"], base + record["path"], data=body.encode('utf8') if body else None, headers=headers)
+        status = response.status_code
+    except requests.RequestException:
+        status = None
+    results.add(record, (time.perf_counter() - start) * 1000.0, status)
+
+def replay(records, base, speed, concurrency):
+    results = Results()
+    session_local = threading.local()
+    first = records[0].get("time", 0) if records else 0
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # keep at most 2 * concurrency requests queued, so the pace follows the schedule
+        pending = threading.BoundedSemaphore(2 * concurrency)
+        for record in records:
+            if (speed > 0):
+                due = (record.get("time", first) - first) / speed
+                delay = due - (time.perf_counter() - start)
+                if (delay > 0):
+                    time.sleep(delay)
+            pending.acquire()
+            future = executor.submit(send, session_local, base, record, results)
+            future.add_done_callback(lambda future: pending.release())
+    return results, time.perf_counter() - start
+
+#
+# Report
+#
+def percentile(values, percent):
+    if (not values):
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(percent / 100.0 * len(ordered))) - 1)]
+
+def change_percent(before, after):
+    if (not before or after is None):
+        return None
+    return round((after - before) / before * 100.0, 1)
+
+def get_report(results):
+    report = {}
+    for name in sorted(results.endpoints):
+        endpoint = results.endpoints[name]
+        stats = {
+            "count": len(endpoint["replayed"]) + endpoint["errors"],
+            "errors": endpoint["errors"],
+            "status_changed": endpoint["status_changed"]
+        }
+        for metric, percent in (("p50", 50), ("p99", 99)):
+            recorded = percentile(endpoint["recorded"], percent)
+            replayed = percentile(endpoint["replayed"], percent)
+            stats["recorded_" + metric + "_ms"] = None if recorded is None else round(recorded, 3)
+            stats["replayed_" + metric + "_ms"] = None if replayed is None else round(replayed, 3)
+            stats[metric + "_change"] = change_percent(recorded, replayed)
+        report[name] = stats
+    return report
+
+def format_value(value):
+    return "-" if value is None else str(value)
+
+def print_report(report):
+    print("{:<28} {:>6} {:>6} {:>7} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}".format("endpoint", "count", "errors", "status", "rec p50", "rep p50", "change", "rec p99", "rep p99", "change"))
+    for name, stats in report.items():
+        print("{:<28} {:>6} {:>6} {:>7} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}".format(
+            name, stats["count"], stats["errors"], stats["status_changed"],
+            format_value(stats["recorded_p50_ms"]), format_value(stats["replayed_p50_ms"]), format_value(stats["p50_change"]),
+            format_value(stats["recorded_p99_ms"]), format_value(stats["replayed_p99_ms"]), format_value(stats["p99_change"])))
+
+def main():
+    argparser = argparse.ArgumentParser(description="Replay a recorded request log against a task app")
+    argparser.add_argument("file", help="JSON lines request log (RECORD_FILE)")
+    argparser.add_argument("--url", default=HOST_URL, help="server to replay against")
+    argparser.add_argument("--speed", type=float, default=1.0, help="pace multiplier - 0 replays as fast as possible")
+    argparser.add_argument("--concurrency", type=int, default=16, help="maximum requests in flight")
+    argparser.add_argument("--limit", type=int, help="replay only the first N requests")
+    argparser.add_argument("--output", help="write the report to this JSON file")
+    args = argparser.parse_args()
+
+    records, skipped = read_records(args.file, args.limit)
+    if (skipped):
+        print("Skipped " + str(skipped) + " lines that are not recorded requests")
+    if (not records):
+        print("No requests to replay in " + args.file)
+        return 1
+    results, elapsed = replay(records, args.url, args.speed, args.concurrency)
+    report = get_report(results)
+    print("Replayed " + str(len(records)) + " requests in " + str(round(elapsed, 3)) + "s")
+    print_report(report)
+    if (args.output):
+        output = {"file": args.file, "url": args.url, "speed": args.speed, "elapsed": round(elapsed, 3), "endpoints": report}
+        with open(args.output, mode='wt') as outfile:
+            json.dump(output, outfile, indent=4)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
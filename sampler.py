@@ -0,0 +1,145 @@
+"""
+sampler.py
+Opt-in sampling profiler - collapsed stacks per endpoint for live hot-path analysis.
+
+Description:
+   profile.py only measures what is explicitly instrumented.  The sampler finds the hot
+   python frames of a slow endpoint without touching its code:  a background thread
+   wakes up hz times per second, reads the current frame of every thread that is serving
+   a request (sys._current_frames) and counts the stack under the request's name
+   (<METHOD>_<endpoint>, tagged by instrument.py).
+
+   A timer thread is used instead of a SIGPROF timer because signals are only delivered
+   to the main thread, while the Flask / WSGI servers run requests in worker threads.
+
+   The output is the collapsed-stack format read by flamegraph.pl and speedscope:
+      GET_dataset_ep;main.py:get;main.py:get_tasks;query.py:fetch 42
+
+   Overhead:  each tick only walks the stacks of in-flight requests (at most MAX_DEPTH
+   frames each) and keys them by code objects - names are formatted at report time.
+   At the default 100 Hz this is well below 1% of a core.  The number of distinct stacks
+   is bounded by MAX_STACKS; further new stacks are counted as <name>;[other].
+   The sampler thread needs the GIL to wake up, so while requests are CPU bound the
+   effective rate is capped near 1 / sys.getswitchinterval() (200 Hz by default).
+
+   Example:
+      sampler.start(hz=200)
+      ... run traffic
+      sampler.stop()
+      print(sampler.get_collapsed())
+
+"""
+import sys
+import os
+import threading
+
+DEFAULT_HZ = 100
+MAX_HZ = 1000
+MAX_DEPTH = 64
+MAX_STACKS = 10000
+OTHER_STACK = ()
+
+RUNNING = False
+SAMPLER = None
+SAMPLER_LOCK = threading.Lock()
+
+# Threads serving a request:  {thread ident: request name}
+THREAD_TAGS = {}
+
+# Sample counts:  {(request name, stack): count} where stack is a tuple of code objects,
+# outermost frame first.
+SAMPLES = {}
+TICKS = 0
+
+# Request threads tag themselves while the sampler runs - dict set / pop are atomic.
+def tag_thread(name):
+    THREAD_TAGS[threading.get_ident()] = name
+
+def untag_thread():
+    THREAD_TAGS.pop(threading.get_ident(), None)
+
+def start(hz=DEFAULT_HZ):
+    global SAMPLER, RUNNING
+    if (hz is None or hz < 1 or hz > MAX_HZ):
+        raise ValueError("hz must be between 1 and " + str(MAX_HZ))
+    with SAMPLER_LOCK:
+        if (SAMPLER is not None):
+            SAMPLER.stop()
+        SAMPLER = Sampler(1.0 / hz)
+        RUNNING = True
+        SAMPLER.start()
+
+def stop():
+    global SAMPLER, RUNNING
+    with SAMPLER_LOCK:
+        RUNNING = False
+        if (SAMPLER is not None):
+            SAMPLER.stop()
+            SAMPLER = None
+        THREAD_TAGS.clear()
+
+def clear():
+    global SAMPLES, TICKS
+    SAMPLES = {}
+    TICKS = 0
+
+def is_running():
+    return RUNNING
+
+def get_ticks():
+    return TICKS
+
+def frame_name(code):
+    return os.path.basename(code.co_filename) + ":" + code.co_name
+
+# Collapsed stacks, most sampled first:  "<request name>;<frame>;<frame> <count>" lines.
+def get_collapsed():
+    lines = []
+    for (name, stack), count in sorted(SAMPLES.items(), key=lambda item: item[1], reverse=True):
+        if (stack is OTHER_STACK):
+            frames = "[other]"
+        else:
+            frames = ";".join(frame_name(code) for code in stack)
+        lines.append(name + ";" + frames + " " + str(count))
+    return "\n".join(lines) + "\n"
+
+#
+# Sampler Thread
+#
+class Sampler(threading.Thread):
+    def __init__(self, interval):
+        threading.Thread.__init__(self, name="profile-sampler", daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+        if (self.is_alive() and threading.current_thread() is not self):
+            self.join()
+
+    def run(self):
+        while (not self.stopped.wait(self.interval)):
+            self.sample()
+
+    def sample(self):
+        global TICKS
+        TICKS += 1
+        if (not THREAD_TAGS):
+            return
+        frames = sys._current_frames()
+        samples = SAMPLES
+        for ident, name in list(THREAD_TAGS.items()):
+            frame = frames.get(ident)
+            if (frame is None):
+                continue
+            stack = []
+            while (frame is not None and len(stack) < MAX_DEPTH):
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.reverse()
+            key = (name, tuple(stack))
+            count = samples.get(key)
+            if (count is None and len(samples) >= MAX_STACKS):
+                key = (name, OTHER_STACK)
+                count = samples.get(key)
+            samples[key] = (count or 0) + 1
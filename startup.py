@@ -0,0 +1,104 @@
+"""
+startup.py
+Cold start report for main.py - import times per module and the first request.
+
+Description:
+   New App Engine instances serve their first request only after main.py is imported,
+   so import time is on the scale-out critical path.  This module records:
+
+      mark(name)            time since the previous mark - main.py marks after each
+                            group of imports, so each mark is the import time of that group
+      timed_import(name)    imports a module on first use (e.g. the google.cloud client
+                            libraries, see backend.py) and records how long it took
+      first request         when it started (since startup) and how long it took
+
+   report() prints the import times as one log line at the end of the main.py import,
+   and get_report() returns them for GET /profile/startup, so cold start regressions
+   show up in the logs and can be compared between deploys.
+
+   Example:
+      import startup
+      from flask import Flask
+      startup.mark("flask")
+      datastore = startup.timed_import("google.cloud.datastore")
+      startup.report()
+
+"""
+import sys
+import time
+import threading
+import importlib
+
+START_NANOS = time.perf_counter_ns()
+LOCK = threading.Lock()
+IMPORTS = []                # (name, nanos, lazy) in the order they were recorded
+LAST_MARK_NANOS = START_NANOS
+READY_NANOS = None
+FIRST_REQUEST = None        # (start nanos, elapsed nanos)
+
+def to_millis(nanos):
+    return round(nanos / 1e6, 3)
+
+def mark(name):
+    global LAST_MARK_NANOS
+    nanos = time.perf_counter_ns()
+    with LOCK:
+        IMPORTS.append((name, nanos - LAST_MARK_NANOS, False))
+        LAST_MARK_NANOS = nanos
+
+def timed_import(name):
+    module = sys.modules.get(name)
+    if (module is not None):
+        return module
+    start = time.perf_counter_ns()
+    module = importlib.import_module(name)
+    with LOCK:
+        IMPORTS.append((name, time.perf_counter_ns() - start, True))
+    return module
+
+#
+# First Request - hooks for app.before_request / app.teardown_request
+#
+FIRST_REQUEST_START = threading.local()
+
+def before_request():
+    if (FIRST_REQUEST is None):
+        FIRST_REQUEST_START.nanos = time.perf_counter_ns()
+
+def teardown_request(exc):
+    global FIRST_REQUEST
+    start = getattr(FIRST_REQUEST_START, "nanos", None)
+    if (start is None):
+        return
+    FIRST_REQUEST_START.nanos = None
+    with LOCK:
+        if (FIRST_REQUEST is None):
+            FIRST_REQUEST = (start - START_NANOS, time.perf_counter_ns() - start)
+
+def register(app):
+    app.before_request(before_request)
+    app.teardown_request(teardown_request)
+
+#
+# Report
+#
+def report():
+    global READY_NANOS
+    READY_NANOS = time.perf_counter_ns() - START_NANOS
+    parts = [name + " " + str(to_millis(nanos)) for name, nanos, lazy in IMPORTS]
+    print("Startup: ready in " + str(to_millis(READY_NANOS)) + " ms (" + ", ".join(parts) + ")")
+
+def get_report():
+    with LOCK:
+        imports = list(IMPORTS)
+        first_request = FIRST_REQUEST
+    output = {
+        "ready_ms": None if READY_NANOS is None else to_millis(READY_NANOS),
+        "imports": [{"name": name, "elapsed_ms": to_millis(nanos), "lazy": lazy} for name, nanos, lazy in imports],
+        "first_request_at_ms": None,
+        "first_request_ms": None
+    }
+    if (first_request is not None):
+        output["first_request_at_ms"] = to_millis(first_request[0])
+        output["first_request_ms"] = to_millis(first_request[1])
+    return output
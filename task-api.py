@@ -1,9 +1,17 @@
 """
-Simple REST Example using Flask-Restful Library.  Works on python 2.7 and 3.7.
+Simple REST Example using Flask-Restful Library.  Tested with Python 3.7.
 
 Full Example from  https://flask-restful.readthedocs.io/en/0.3.5/quickstart.html
 Must activate the virtualenv for python 3:  source env/bin/activate
 
+The task store is safe to use from a multi-threaded WSGI server.
+TASK_STORE_MAX (environment) limits the number of stored tasks - 0 is unlimited.
+
+Snapshots:  when TASK_SNAPSHOT_FILE is set, the store is written to that file every
+TASK_SNAPSHOT_INTERVAL seconds (default 60) and on shutdown.  On startup the snapshot
+is loaded in a background thread - the server accepts connections immediately and
+requests wait only until the load completes.
+
 // GET the list
 curl http://127.0.0.1:5000/tasks -X GET
 
@@ -23,38 +31,400 @@ curl http://127.0.0.1:5000/tasks/task3 -d "desc=Do Something Different" -X PUT -
 // POST (Add) a new task
 curl http://127.0.0.1:5000/tasks -H "Content-type: application/json" -d "{\"taskid\": \"task1\", \"desc\": \"The 1st Task.\"}" -X POST -v
 
+// Tasks with a duration between 10 and 60 (ascending) / the 5 longest tasks
+curl "http://127.0.0.1:5000/taskdur?min=10&max=60" -X GET
+curl "http://127.0.0.1:5000/tasktop?n=5" -X GET
+
+// Profile clocks / counters of all profiles in Prometheus text format
+curl http://127.0.0.1:5000/metrics -X GET
+
 // PUT (Replace All) Tasks
 curl http://127.0.0.1:5000/tasks -H "Content-type: application/json" -d "{\"tasklist\": [{\"taskid\": \"task4\", \"desc\": \"The Fourth Task\"}, {\"taskid\": \"task5\", \"desc\": \"The Fifth Task\"}]}" -X PUT -v
 
 """
 from flask import Flask
 from flask_restful import reqparse, abort, Api, Resource, fields, marshal_with
+from werkzeug.exceptions import HTTPException
 import json
+import ast
+import os
+import threading
+import itertools
+import heapq
+import bisect
+import marshal
+import atexit
+import signal
+import sys
+import instrument
 
 app = Flask(__name__)
 api = Api(app)
+instrument.instrument_app(app)
 
 parser = reqparse.RequestParser()
 parser.add_argument('taskid')
 parser.add_argument('desc')
+parser.add_argument('dur', type=int)
 parser.add_argument('tasklist', action='append')
 
-# Task Dictionary
-TASKS = {}
-
-# python2 / python3
-def get_dict_values_as_list(dict):
-    olist = []
-    for v in dict.values():
-        olist.append(v)
-    return olist
-
-# python2 / python3
-def get_dict_keys_as_list(dict):
-    olist = []
-    for k in dict.keys():
-        olist.append(k)
-    return olist
+# Duration Index
+# Sorted parallel lists (durs, ids) ordered by duration.  Range and top-N queries are
+# bisects plus a slice, O(log n + k).  Inserts and removes shift the lists (a memmove).
+class DurationIndex(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durs = []
+        self.ids = []
+
+    def insert(self, dur, id):
+        with self.lock:
+            pos = bisect.bisect_right(self.durs, dur)
+            self.durs.insert(pos, dur)
+            self.ids.insert(pos, id)
+
+    def remove(self, dur, id):
+        with self.lock:
+            pos = bisect.bisect_left(self.durs, dur)
+            end = bisect.bisect_right(self.durs, dur)
+            while (pos < end):
+                if (self.ids[pos] == id):
+                    del self.durs[pos]
+                    del self.ids[pos]
+                    return
+                pos += 1
+
+    # Replaces the index contents with (dur, id) pairs - one sort instead of n inserts.
+    def rebuild(self, pairs):
+        pairs = sorted(pairs, key=lambda pair: pair[0])
+        with self.lock:
+            self.durs = [pair[0] for pair in pairs]
+            self.ids = [pair[1] for pair in pairs]
+
+    # ids with mindur <= dur <= maxdur in ascending duration order.  None means unbounded.
+    def range(self, mindur, maxdur):
+        with self.lock:
+            lo = 0 if mindur is None else bisect.bisect_left(self.durs, mindur)
+            hi = len(self.durs) if maxdur is None else bisect.bisect_right(self.durs, maxdur)
+            return self.ids[lo:hi]
+
+    # ids of the n longest tasks, longest first.
+    def top(self, n):
+        with self.lock:
+            if (n <= 0):
+                return []
+            return self.ids[:-n - 1:-1]
+
+# Task Store
+# TASKS is shared by all request threads.  Keys are striped over STORE_SHARDS dicts,
+# each guarded by its own lock, so concurrent requests rarely contend.
+STORE_SHARDS = 16
+STORE_MAX_TASKS = int(os.environ.get("TASK_STORE_MAX", "0"))    # 0 = unlimited
+
+class StoreFullError(Exception):
+    pass
+
+# werkzeug has no exception for 507, so abort(507) would fail with a LookupError (500).
+class InsufficientStorage(HTTPException):
+    code = 507
+    description = "Insufficient Storage"
+
+def abort_store_full(e):
+    error = InsufficientStorage()
+    error.data = {"message": str(e)}
+    raise error
+
+class TaskStore(object):
+    def __init__(self, num_shards=STORE_SHARDS, max_tasks=0):
+        self.num_shards = num_shards
+        self.max_tasks = max_tasks
+        self.locks = [threading.Lock() for i in range(num_shards)]
+        self.shards = [{} for i in range(num_shards)]
+        self.size_lock = threading.Lock()
+        self.size = 0
+        self.seq = itertools.count()
+        self.dur_index = DurationIndex()
+        self.loaded = True
+        self.ready = threading.Event()
+        self.ready.set()
+
+    def __len__(self):
+        return self.size
+
+    # While a snapshot is loading, callers wait for it.  The plain flag check keeps
+    # the loaded case free of any locking.
+    def wait_ready(self):
+        if (not self.loaded):
+            self.ready.wait()
+
+    def begin_load(self):
+        self.loaded = False
+        self.ready.clear()
+
+    def end_load(self):
+        self.loaded = True
+        self.ready.set()
+
+    # Bulk insert for snapshot loading - takes every stripe lock once, not once per task.
+    # Tasks beyond max_tasks are not loaded.  Returns the number of tasks left out.
+    def load(self, tasks):
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            shards = self.shards
+            num_shards = self.num_shards
+            seqno = next(self.seq)
+            added = 0
+            skipped = 0
+            room = None
+            if (self.max_tasks > 0):
+                room = max(self.max_tasks - self.size, 0)
+            for task in tasks:
+                shard = shards[hash(task.id) % num_shards]
+                if (task.id not in shard):
+                    if (room is not None and added >= room):
+                        skipped += 1
+                        continue
+                    shard[task.id] = (seqno, task)
+                    seqno += 1
+                    added += 1
+            self.seq = itertools.count(seqno)
+            with self.size_lock:
+                self.size += added
+            pairs = []
+            for shard in shards:
+                for entry in shard.values():
+                    if (entry[1].dur is not None):
+                        pairs.append((entry[1].dur, entry[1].id))
+            self.dur_index.rebuild(pairs)
+        finally:
+            for lock in self.locks:
+                lock.release()
+        return skipped
+
+    def shard_index(self, id):
+        return hash(id) % self.num_shards
+
+    def get(self, id):
+        self.wait_ready()
+        # a single dict lookup is atomic - no lock needed for readers
+        entry = self.shards[self.shard_index(id)].get(id)
+        if (entry is None):
+            return None
+        return entry[1]
+
+    def contains(self, id):
+        self.wait_ready()
+        return id in self.shards[self.shard_index(id)]
+
+    # Adds a task unless the id exists.  Returns False if the task already exists.
+    def add(self, task):
+        self.wait_ready()
+        index = self.shard_index(task.id)
+        with self.locks[index]:
+            shard = self.shards[index]
+            if (task.id in shard):
+                return False
+            if (self.max_tasks > 0):
+                with self.size_lock:
+                    if (self.size >= self.max_tasks):
+                        raise StoreFullError("Task store is full ({} tasks)".format(self.max_tasks))
+                    self.size += 1
+            else:
+                with self.size_lock:
+                    self.size += 1
+            shard[task.id] = (next(self.seq), task)
+            if (task.dur is not None):
+                self.dur_index.insert(task.dur, task.id)
+        return True
+
+    # Removes a task.  Returns the removed task or None.
+    def remove(self, id):
+        self.wait_ready()
+        index = self.shard_index(id)
+        with self.locks[index]:
+            entry = self.shards[index].pop(id, None)
+            if (entry is None):
+                return None
+            with self.size_lock:
+                self.size -= 1
+            if (entry[1].dur is not None):
+                self.dur_index.remove(entry[1].dur, id)
+        return entry[1]
+
+    # Changes a task duration and keeps the duration index in step.  Returns the task or None.
+    def set_dur(self, id, dur):
+        self.wait_ready()
+        index = self.shard_index(id)
+        with self.locks[index]:
+            entry = self.shards[index].get(id)
+            if (entry is None):
+                return None
+            task = entry[1]
+            if (task.dur is not None):
+                self.dur_index.remove(task.dur, id)
+            task.dur = dur
+            if (dur is not None):
+                self.dur_index.insert(dur, id)
+        return task
+
+    # Replaces all tasks in one step - the new shards and duration index are built
+    # first, then swapped in under every stripe lock.  Task ids must be unique.
+    def replace(self, tasks):
+        self.wait_ready()
+        if (self.max_tasks > 0 and len(tasks) > self.max_tasks):
+            raise StoreFullError("Task store is full ({} tasks)".format(self.max_tasks))
+        shards = [{} for i in range(self.num_shards)]
+        seq = itertools.count()
+        pairs = []
+        for task in tasks:
+            shards[self.shard_index(task.id)][task.id] = (next(seq), task)
+            if (task.dur is not None):
+                pairs.append((task.dur, task.id))
+        dur_index = DurationIndex()
+        dur_index.rebuild(pairs)
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            self.shards = shards
+            self.dur_index = dur_index
+            self.seq = seq
+            with self.size_lock:
+                self.size = len(tasks)
+        finally:
+            for lock in self.locks:
+                lock.release()
+
+    # Swaps in empty shards - independent of the number of tasks.
+    def clear(self):
+        self.wait_ready()
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            self.shards = [{} for i in range(self.num_shards)]
+            self.dur_index = DurationIndex()
+            with self.size_lock:
+                self.size = 0
+        finally:
+            for lock in self.locks:
+                lock.release()
+
+    # Snapshot of all tasks in insertion order.  Each shard is copied under its own
+    # lock only, so writers to other shards are never blocked.
+    def values(self):
+        self.wait_ready()
+        shardlists = []
+        for index in range(self.num_shards):
+            with self.locks[index]:
+                shardlists.append(list(self.shards[index].values()))
+        # seq numbers are unique, so the (seq, task) tuples never compare tasks
+        return [entry[1] for entry in heapq.merge(*shardlists)]
+
+    # Tasks for a list of ids, skipping ids removed since the index was read.
+    def get_many(self, ids):
+        tasks = []
+        for id in ids:
+            task = self.get(id)
+            if (task is not None):
+                tasks.append(task)
+        return tasks
+
+    def dur_range(self, mindur, maxdur):
+        self.wait_ready()
+        return self.get_many(self.dur_index.range(mindur, maxdur))
+
+    def dur_top(self, n):
+        self.wait_ready()
+        return self.get_many(self.dur_index.top(n))
+
+TASKS = TaskStore(max_tasks=STORE_MAX_TASKS)
+
+#
+# Snapshots
+#
+# File format:  SNAPSHOT_MAGIC followed by marshal.dumps((count, ids, descs, durs, nodescs))
+# where ids, descs and durs are NUL-separated strings in insertion order (an empty dur is
+# None) and nodescs has one flag per task - "1" where the desc is None (stored as "").
+# A few large strings (de)serialize at memory speed, unlike millions of small marshal
+# objects.
+SNAPSHOT_FILE = os.environ.get("TASK_SNAPSHOT_FILE", "")
+SNAPSHOT_INTERVAL = int(os.environ.get("TASK_SNAPSHOT_INTERVAL", "60"))
+SNAPSHOT_MAGIC = b"TASKSNAP\n"
+SNAPSHOT_SEPARATOR = "\x00"
+
+SNAPSHOT_LOCK = threading.Lock()
+SNAPSHOT_STOP = threading.Event()
+
+# Writes to a temp file and renames it, so a crash never leaves a partial snapshot.
+# The store is read under SNAPSHOT_LOCK so the last writer always has the newest tasks.
+def write_snapshot(store, filename):
+    tmpname = filename + ".tmp"
+    with SNAPSHOT_LOCK:
+        tasks = store.values()
+        count = len(tasks)
+        ids = SNAPSHOT_SEPARATOR.join([ta.id for ta in tasks])
+        descs = SNAPSHOT_SEPARATOR.join(["" if ta.desc is None else str(ta.desc) for ta in tasks])
+        durs = SNAPSHOT_SEPARATOR.join(["" if ta.dur is None else str(ta.dur) for ta in tasks])
+        nodescs = "".join(["1" if ta.desc is None else "0" for ta in tasks])
+        if (count > 0 and (ids.count(SNAPSHOT_SEPARATOR) != count - 1 or descs.count(SNAPSHOT_SEPARATOR) != count - 1)):
+            raise ValueError("Task ids and descriptions must not contain NUL characters")
+        with open(tmpname, mode='wb') as filestream:
+            filestream.write(SNAPSHOT_MAGIC)
+            marshal.dump((count, ids, descs, durs, nodescs), filestream)
+        os.replace(tmpname, filename)
+    return count
+
+def read_snapshot(filename):
+    with open(filename, mode='rb') as filestream:
+        if (filestream.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC):
+            raise ValueError("{} is not a task snapshot".format(filename))
+        count, ids, descs, durs, nodescs = marshal.load(filestream)
+    if (count == 0):
+        return []
+    ids = ids.split(SNAPSHOT_SEPARATOR)
+    descs = descs.split(SNAPSHOT_SEPARATOR)
+    if ("1" in nodescs):
+        descs = [None if nodesc == "1" else desc for desc, nodesc in zip(descs, nodescs)]
+    durs = [int(dur) if dur else None for dur in durs.split(SNAPSHOT_SEPARATOR)]
+    return list(map(Task, ids, descs, durs))
+
+def load_snapshot(store, filename):
+    try:
+        if (os.path.isfile(filename)):
+            skipped = store.load(read_snapshot(filename))
+            if (skipped):
+                print("Snapshot: " + str(skipped) + " tasks over TASK_STORE_MAX not loaded")
+    except (ValueError, EOFError, TypeError) as e:
+        print("Snapshot not loaded: " + str(e))
+    finally:
+        store.end_load()
+
+def snapshot_loop(store, filename, interval):
+    while (not SNAPSHOT_STOP.wait(interval)):
+        try:
+            write_snapshot(store, filename)
+        except (OSError, ValueError) as e:
+            print("Snapshot not written: " + str(e))
+
+def shutdown_snapshot(store, filename):
+    SNAPSHOT_STOP.set()
+    if (store.loaded):
+        write_snapshot(store, filename)
+
+def handle_sigterm(signum, frame):
+    sys.exit(0)
+
+# Starts the background load, the periodic writer and the shutdown hook.
+def start_snapshots(store, filename, interval=SNAPSHOT_INTERVAL):
+    if (not filename):
+        return
+    store.begin_load()
+    threading.Thread(target=load_snapshot, args=(store, filename), name="snapshot-load", daemon=True).start()
+    if (interval > 0):
+        threading.Thread(target=snapshot_loop, args=(store, filename, interval), name="snapshot-write", daemon=True).start()
+    atexit.register(shutdown_snapshot, store, filename)
+    if (threading.current_thread() is threading.main_thread()):
+        signal.signal(signal.SIGTERM, handle_sigterm)
 
 task_fields = {
     'id':   fields.String,
@@ -62,40 +432,81 @@ task_fields = {
     'uri':  fields.Url('task_ep', absolute=True, scheme="http")
 }
 
+# Duration queries also return the duration.
+task_dur_fields = {
+    'id':   fields.String,
+    'desc': fields.String,
+    'dur':  fields.Integer,
+    'uri':  fields.Url('task_ep', absolute=True, scheme="http")
+}
+
+durparser = reqparse.RequestParser()
+durparser.add_argument('min', type=int, location='args')
+durparser.add_argument('max', type=int, location='args')
+durparser.add_argument('n', type=int, location='args', default=10)
+
 class Task(object):
-    def __init__(self, id, desc):
+    def __init__(self, id, desc, dur=None):
         self.id = id
         self.desc = desc
+        self.dur = dur
 
 def get_task(id):
-    return TASKS[id]
+    ta = TASKS.get(id)
+    if (ta is None):
+        abort(404, message="Task {} doesn't exist".format(id))
+    return ta
 
 def add_task(task):
-    TASKS[task.id] = task
+    try:
+        added = TASKS.add(task)
+    except StoreFullError as e:
+        abort_store_full(e)
+    if (not added):
+        abort(400, message="Task {} already exists".format(task.id))
 
 def remove_task(task):
-    del TASKS[task.id]
+    if (TASKS.remove(task.id) is None):
+        abort(404, message="Task {} doesn't exist".format(task.id))
 
-# python2 / python3
 def remove_all_tasks():
-    tkeys = get_dict_keys_as_list(TASKS)
-    for k in tkeys:
-        del TASKS[k]
-
-def abort_if_task_doesnt_exist(id):
-    if id not in TASKS:
-        abort(404, message="Task {} doesn't exist".format(id))
+    TASKS.clear()
 
-def create_new_task(tid, tdesc):
-    if tid in TASKS:
-        abort(400, message="Task {} already exists".format(tid))
-    ta = Task(id=tid, desc=tdesc)
+def create_new_task(tid, tdesc, tdur=None):
+    ta = Task(id=tid, desc=tdesc, dur=tdur)
     add_task(ta)
     return ta
 
-# python2 / python3
 def get_task_list():
-    return get_dict_values_as_list(TASKS)
+    return TASKS.values()
+
+# reqparse hands each tasklist element over as the repr of its dict.
+def parse_tasklist(tlist):
+    if (tlist is None):
+        abort(400, message="tasklist is required")
+    tasks = []
+    ids = set()
+    for tstr in tlist:
+        try:
+            tdict = ast.literal_eval(tstr)
+        except (ValueError, SyntaxError):
+            tdict = None
+        if (not isinstance(tdict, dict) or not isinstance(tdict.get('taskid'), str)):
+            abort(400, message="Task {} is not a task with a taskid".format(tstr))
+        if (tdict['taskid'] in ids):
+            abort(400, message="Task {} already exists".format(tdict['taskid']))
+        ids.add(tdict['taskid'])
+        tasks.append(Task(id=tdict['taskid'], desc=tdict.get('desc'), dur=get_dur(tdict)))
+    return tasks
+
+def get_dur(tdict):
+    dur = tdict.get('dur')
+    if (dur is None):
+        return None
+    try:
+        return int(dur)
+    except (TypeError, ValueError):
+        abort(400, message="Task duration {} is not an integer".format(dur))
 
 # TaskApi
 # GET       - Retrieve a representation of the addressed member of the collection.
@@ -107,13 +518,11 @@ class TaskApi(Resource):
     @marshal_with(task_fields)
     def get(self, **kwargs):
         tid = kwargs["id"]
-        abort_if_task_doesnt_exist(tid)
         ta = get_task(tid)
         return ta
 
     def delete(self, **kwargs):
         tid = kwargs["id"]
-        abort_if_task_doesnt_exist(tid)
         ta = get_task(tid)
         remove_task(ta)
         return '', 204
@@ -122,9 +531,10 @@ class TaskApi(Resource):
     def put(self, **kwargs):
         args = parser.parse_args()
         tid = kwargs["id"]
-        abort_if_task_doesnt_exist(tid)
         ta = get_task(tid)
         ta.desc = args['desc']
+        if (args['dur'] is not None):
+            TASKS.set_dur(tid, args['dur'])
         return ta, 201
 
 # TaskListApi
@@ -140,26 +550,42 @@ class TaskListApi(Resource):
 
     def put(self, **kwargs):
         args = parser.parse_args()
-        tlist = args['tasklist']
-        remove_all_tasks()
-        for tstr in tlist:
-            dict = eval(tstr)
-            create_new_task(dict['taskid'], dict['desc'])
+        tasks = parse_tasklist(args['tasklist'])
+        try:
+            TASKS.replace(tasks)
+        except StoreFullError as e:
+            abort_store_full(e)
         return '', 204
 
     @marshal_with(task_fields)
     def post(self, **kwargs):
         args = parser.parse_args()
-        ta = create_new_task(args['taskid'], args['desc'])
+        ta = create_new_task(args['taskid'], args['desc'], args['dur'])
         return ta, 201
 
     def delete(self, **kwargs):
         remove_all_tasks()
         return '', 204
 
+# GET - Tasks with min <= dur <= max, shortest first (either bound may be omitted)
+class TaskDurationApi(Resource):
+    @marshal_with(task_dur_fields)
+    def get(self, **kwargs):
+        args = durparser.parse_args()
+        return TASKS.dur_range(args['min'], args['max'])
+
+# GET - The n longest tasks, longest first
+class TaskTopApi(Resource):
+    @marshal_with(task_dur_fields)
+    def get(self, **kwargs):
+        args = durparser.parse_args()
+        return TASKS.dur_top(args['n'])
+
 ## Api resource routing
 api.add_resource(TaskListApi, '/tasks', endpoint='tasklist_ep')
 api.add_resource(TaskApi, '/tasks/<id>', endpoint='task_ep')
+api.add_resource(TaskDurationApi, '/taskdur', endpoint='taskdur_ep')
+api.add_resource(TaskTopApi, '/tasktop', endpoint='tasktop_ep')
 
 ## Intialize some Tasks
 #add_task(Task(id='task1', desc='The First Task'))
@@ -167,4 +593,7 @@ api.add_resource(TaskApi, '/tasks/<id>', endpoint='task_ep')
 #add_task(Task(id='task3', desc='The Third Task'))
 
 if __name__ == '__main__':
+    # With the reloader only the serving child process owns the snapshot.
+    if (os.environ.get("WERKZEUG_RUN_MAIN") == "true"):
+        start_snapshots(TASKS, SNAPSHOT_FILE)
     app.run(debug=True)
@@ -1,24 +1,28 @@
 import unittest
 import requests
 import json
+import os
 import profile
 
+# Server under test - e.g. DSTASK_HOST_URL=http://127.0.0.1:5000 for main.py with TASK_BACKEND=local
+HOST_URL = os.environ.get("DSTASK_HOST_URL", "https://tidal-nectar-222020.appspot.com")
 TEST_PROFILE_ID = "TestProfile"
-PROFILE_REPORT_URL = "https://tidal-nectar-222020.appspot.com/profile/report"
+PROFILE_REPORT_URL = HOST_URL + "/profile/report"
 
-BASE_URL = "https://tidal-nectar-222020.appspot.com/taskdata"
+BASE_URL = HOST_URL + "/taskdata"
 DATASETID = "Test20190101"
 DATASET_URL = BASE_URL + "/" + DATASETID
 MESSAGE_SUCCESS =  {"message": "success"}
-test_get1 = [{'datasetid': 'Test20190101', 'taskid': 'task1', 'desc': 'The 1st Task', 'dur': 11, 'uri': 'https://tidal-nectar-222020.appspot.com/taskdata/Test20190101/task1'}, {'datasetid': 'Test20190101', 'taskid': 'task2', 'desc': 'The 2nd Task', 'dur': 22, 'uri': 'https://tidal-nectar-222020.appspot.com/taskdata/Test20190101/task2'}, {'datasetid': 'Test20190101', 'taskid': 'task3', 'desc': 'The 3rd Task', 'dur': 33, 'uri': 'https://tidal-nectar-222020.appspot.com/taskdata/Test20190101/task3'}]
-test_get2 = [{'datasetid': 'Test20190101', 'taskid': 'task97', 'desc': 'The 97th Task', 'dur': 97, 'uri': 'https://tidal-nectar-222020.appspot.com/taskdata/Test20190101/task97'}, {'datasetid': 'Test20190101', 'taskid': 'task98', 'desc': 'The 98th Task', 'dur': 98, 'uri': 'https://tidal-nectar-222020.appspot.com/taskdata/Test20190101/task98'}, {'datasetid': 'Test20190101', 'taskid': 'task99', 'desc': 'The 99th Task', 'dur': 99, 'uri': 'https://tidal-nectar-222020.appspot.com/taskdata/Test20190101/task99'}]
-test_get3 = [{'datasetid': 'NewTestDataset2019', 'taskid': 'task1000', 'desc': 'The 1000th Task', 'dur': 1000, 'uri': 'https://tidal-nectar-222020.appspot.com/taskdata/NewTestDataset2019/task1000'}]
-test_get4 = {'datasetid': 'Test20190101', 'taskid': 'task1', 'desc': 'The 1st Task', 'dur': 11, 'uri': 'https://tidal-nectar-222020.appspot.com/taskdata/Test20190101/task1'}
-test_get5 = {'datasetid': 'Test20190101', 'taskid': 'task1', 'desc': 'Task Number 1', 'dur': 111, 'uri': 'https://tidal-nectar-222020.appspot.com/taskdata/Test20190101/task1'}
-test_get6 = {'datasetid': 'Test20190101', 'taskid': 'task19', 'desc': 'Task 19', 'dur': 19, 'uri': 'https://tidal-nectar-222020.appspot.com/taskdata/Test20190101/task19'}
-test_get7 = {'datasetid': 'Test20190101', 'taskid': 'task19', 'desc': 'The 19th Task', 'dur': 119, 'uri': 'https://tidal-nectar-222020.appspot.com/taskdata/Test20190101/task19'}
-test_get8 = {'datasetid': 'Test20190101', 'taskid': 'task50', 'desc': 'Task 50', 'dur': 50, 'uri': 'https://tidal-nectar-222020.appspot.com/taskdata/Test20190101/task50'}
+test_get1 = [{'datasetid': 'Test20190101', 'taskid': 'task1', 'desc': 'The 1st Task', 'dur': 11, 'uri': HOST_URL + '/taskdata/Test20190101/task1'}, {'datasetid': 'Test20190101', 'taskid': 'task2', 'desc': 'The 2nd Task', 'dur': 22, 'uri': HOST_URL + '/taskdata/Test20190101/task2'}, {'datasetid': 'Test20190101', 'taskid': 'task3', 'desc': 'The 3rd Task', 'dur': 33, 'uri': HOST_URL + '/taskdata/Test20190101/task3'}]
+test_get2 = [{'datasetid': 'Test20190101', 'taskid': 'task97', 'desc': 'The 97th Task', 'dur': 97, 'uri': HOST_URL + '/taskdata/Test20190101/task97'}, {'datasetid': 'Test20190101', 'taskid': 'task98', 'desc': 'The 98th Task', 'dur': 98, 'uri': HOST_URL + '/taskdata/Test20190101/task98'}, {'datasetid': 'Test20190101', 'taskid': 'task99', 'desc': 'The 99th Task', 'dur': 99, 'uri': HOST_URL + '/taskdata/Test20190101/task99'}]
+test_get3 = [{'datasetid': 'NewTestDataset2019', 'taskid': 'task1000', 'desc': 'The 1000th Task', 'dur': 1000, 'uri': HOST_URL + '/taskdata/NewTestDataset2019/task1000'}]
+test_get4 = {'datasetid': 'Test20190101', 'taskid': 'task1', 'desc': 'The 1st Task', 'dur': 11, 'uri': HOST_URL + '/taskdata/Test20190101/task1'}
+test_get5 = {'datasetid': 'Test20190101', 'taskid': 'task1', 'desc': 'Task Number 1', 'dur': 111, 'uri': HOST_URL + '/taskdata/Test20190101/task1'}
+test_get6 = {'datasetid': 'Test20190101', 'taskid': 'task19', 'desc': 'Task 19', 'dur': 19, 'uri': HOST_URL + '/taskdata/Test20190101/task19'}
+test_get7 = {'datasetid': 'Test20190101', 'taskid': 'task19', 'desc': 'The 19th Task', 'dur': 119, 'uri': HOST_URL + '/taskdata/Test20190101/task19'}
+test_get8 = {'datasetid': 'Test20190101', 'taskid': 'task50', 'desc': 'Task 50', 'dur': 50, 'uri': HOST_URL + '/taskdata/Test20190101/task50'}
 http_status_not_found = 404
+http_status_bad_request = 400
 
 
 def get_row_key(row):
@@ -136,6 +140,48 @@ class TestTaskApi(unittest.TestCase):
         response = requests.get(url)
         self.assertEqual(response.status_code, http_status_not_found)
 
+    def test_get_task_batch(self):
+        url = HOST_URL + "/taskbatch?datasetids=" + DATASETID + ",NonExistentDataset," + DATASETID
+        response = requests.get(url)
+        batch = response.json()
+        self.assertEqual(sorted(batch.keys()), ["NonExistentDataset", DATASETID])
+        self.assertEqual(batch["NonExistentDataset"], None)
+        self.assertEqual(get_sorted_tasks(batch[DATASETID]), test_get1)
+        #
+        response = requests.get(HOST_URL + "/taskbatch")
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_tasks_by_dur(self):
+        url = HOST_URL + "/taskdur/" + DATASETID + "?min=20&max=33"
+        response = requests.get(url)
+        self.assertEqual(response.json(), test_get1[1:])
+        #
+        response = requests.get(HOST_URL + "/taskdur/" + DATASETID + "?max=11")
+        self.assertEqual(response.json(), test_get1[:1])
+        response = requests.get(HOST_URL + "/taskdur/NonExistentDataset")
+        self.assertEqual(response.status_code, http_status_not_found)
+
+    def test_get_top_tasks(self):
+        url = HOST_URL + "/tasktop/" + DATASETID + "?n=2"
+        response = requests.get(url)
+        self.assertEqual(response.json(), [test_get1[2], test_get1[1]])
+        #
+        response = requests.get(HOST_URL + "/tasktop/NonExistentDataset")
+        self.assertEqual(response.status_code, http_status_not_found)
+
+    def test_invalid_task_dur(self):
+        # A dur that is not an integer - Should return Http Status 400 and change nothing
+        response = requests.put(DATASET_URL + "/task1", json={"desc": "Task Number 1", "dur": "abc"})
+        self.assertEqual(response.status_code, http_status_bad_request)
+        payload = {"desc": "Bad Tasks", "tasklist": [{"taskid": "task4", "desc": "The 4th Task", "dur": "44"}, {"taskid": "task5", "desc": "The 5th Task", "dur": "abc"}]}
+        response = requests.put(DATASET_URL, json=payload)
+        self.assertEqual(response.status_code, http_status_bad_request)
+        #
+        response = requests.get(DATASET_URL)
+        self.assertEqual(get_sorted_tasks(response.json()), test_get1)
+        response = requests.get(HOST_URL + "/tasktop/" + DATASETID + "?n=1")
+        self.assertEqual(response.json(), [test_get1[2]])
+
     def test_get_dataset_task_existence(self):
         url = DATASET_URL + "/taskthatdoesnotexist1"
         response = requests.get(url)
@@ -13,6 +13,10 @@ tasks_get1 = [{'datasetid': 'tasktest', 'taskid': 'task1', 'desc': 'The First Ta
 task_get1 = {'datasetid': 'tasktest', 'taskid': 'task3', 'desc': 'The Third Task', 'dur': 30, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task3'}
 tasks_get2 = [{'datasetid': 'tasktest', 'taskid': 'task1', 'desc': 'The First Task', 'dur': 60, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task1'}, {'datasetid': 'tasktest', 'taskid': 'task2', 'desc': 'The Second Task', 'dur': 120, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task2'}]
 tasks_get3 = [{'datasetid': 'tasktest', 'taskid': 'task1', 'desc': 'The First Task', 'dur': 60, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task1'}, {'datasetid': 'tasktest', 'taskid': 'task2', 'desc': 'The Second Task', 'dur': 120, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task2'}, {'datasetid': 'tasktest', 'taskid': 'task3', 'desc': 'The Third Task', 'dur': 30, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task3'}, {'datasetid': 'tasktest', 'taskid': 'task4', 'desc': 'The Fourth Task', 'dur': 45, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task4'}]
+tasks_get5 = [{'datasetid': 'tasktest', 'taskid': 'task1', 'desc': 'The First Task', 'dur': 60, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task1'}, {'datasetid': 'tasktest', 'taskid': 'task3', 'desc': 'The Third Task Again', 'dur': 33, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task3'}, {'datasetid': 'tasktest', 'taskid': 'task5', 'desc': 'The Fifth Task', 'dur': 5, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task5'}]
+tasks_dur1 = [{'datasetid': 'tasktest', 'taskid': 'task1', 'desc': 'The First Task', 'dur': 60, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task1'}, {'datasetid': 'tasktest', 'taskid': 'task2', 'desc': 'The Second Task', 'dur': 120, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task2'}]
+tasks_top1 = [{'datasetid': 'tasktest', 'taskid': 'task2', 'desc': 'The Second Task', 'dur': 120, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task2'}, {'datasetid': 'tasktest', 'taskid': 'task1', 'desc': 'The First Task', 'dur': 60, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task1'}]
+tasks_top2 = [{'datasetid': 'tasktest', 'taskid': 'task3', 'desc': 'The Third Task Again', 'dur': 330, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task3'}]
 tasks_get4 = [{'datasetid': 'tasktest', 'taskid': 'task1', 'desc': 'The First Task', 'dur': 60, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task1'}, {'datasetid': 'tasktest', 'taskid': 'task2', 'desc': 'The Second Task', 'dur': 120, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task2'}, {'datasetid': 'tasktest', 'taskid': 'task3', 'desc': 'The Third Task Again', 'dur': 33, 'uri': 'http://127.0.0.1:5000/tasks/tasktest/task3'}]
 
 class TestTaskApi(unittest.TestCase):
@@ -91,5 +95,65 @@ class TestTaskApi(unittest.TestCase):
         response = requests.get(url)
         self.assertEqual(response.json(), tasks_get4)
 
+    def test_dur_tasks(self):
+        url = BASE_TASKS_URL.replace("/tasks", "/taskdur") + "/tasktest?min=31&max=120"
+        response = requests.get(url)
+        self.assertEqual(response.json(), tasks_dur1)
+        url = BASE_TASKS_URL.replace("/tasks", "/tasktop") + "/tasktest?n=2"
+        response = requests.get(url)
+        self.assertEqual(response.json(), tasks_top1)
+        # the index follows updates to the dataset
+        url = BASE_TASKS_URL + "/tasktest/task3"
+        payload = {"desc": "The Third Task Again", "dur": 330}
+        response = requests.post(url, json=payload)
+        url = BASE_TASKS_URL.replace("/tasks", "/tasktop") + "/tasktest?n=1"
+        response = requests.get(url)
+        self.assertEqual(response.json(), tasks_top2)
+
+    def test_bulk_tasks(self):
+        # bulk update task3, add task5, delete task2 (JSON body)
+        url = BASE_TASKS_URL + "/tasktest"
+        payload = {"upserts": [{"taskid": "task3", "desc": "The Third Task Again", "dur": 33}, {"taskid": "task5", "desc": "The Fifth Task", "dur": 5}], "deletes": ["task2"]}
+        response = requests.post(url, json=payload)
+        self.assertEqual(response.json(), {"message": "success", "upserted": 2, "deleted": 1})
+        response = requests.get(url)
+        self.assertEqual(response.json(), tasks_get5)
+
+    def test_bulk_tasks_ndjson(self):
+        # same operations as an NDJSON body
+        url = BASE_TASKS_URL + "/tasktest"
+        body = '{"taskid": "task3", "desc": "The Third Task Again", "dur": 33}\n{"taskid": "task5", "desc": "The Fifth Task", "dur": 5}\n{"taskid": "task2", "delete": true}\n'
+        response = requests.post(url, data=body, headers={"Content-type": "application/x-ndjson"})
+        self.assertEqual(response.json(), {"message": "success", "upserted": 2, "deleted": 1})
+        response = requests.get(url)
+        self.assertEqual(response.json(), tasks_get5)
+
+    def test_bulk_tasks_invalid(self):
+        # an invalid upsert is rejected before anything is written - the dataset is unchanged
+        url = BASE_TASKS_URL + "/tasktest"
+        for upsert in [{"taskid": 5, "desc": "X", "dur": "1"}, {"taskid": "", "desc": "X", "dur": "1"}, {"taskid": "task6", "desc": "X,Y", "dur": "1"}, {"taskid": "task6", "desc": "X", "dur": "1\n2"}, {"taskid": "task6", "desc": "X", "dur": "x"}, {"taskid": "task6", "desc": "X", "dur": 1.5}]:
+            payload = {"upserts": [{"taskid": "task5", "desc": "The Fifth Task", "dur": 5}, upsert], "deletes": ["task2"]}
+            response = requests.post(url, json=payload)
+            self.assertEqual(response.status_code, 400)
+        response = requests.get(url)
+        self.assertEqual(response.json(), tasks_get1)
+
+    def test_task_invalid_dur(self):
+        # a task whose dur is not an integer is rejected - it could not be listed or indexed
+        url = BASE_TASKS_URL + "/tasktest"
+        for dur in ["abc", 1.5]:
+            response = requests.post(url + "/task3", json={"desc": "The Third Task Again", "dur": dur})
+            self.assertEqual(response.status_code, 400)
+        response = requests.get(url)
+        self.assertEqual(response.json(), tasks_get1)
+
+    def test_metrics(self):
+        # the requests made in setUp show up in the exposition, the scrape itself does not
+        url = BASE_TASKS_URL.replace("/tasks", "/metrics")
+        response = requests.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('profile_clock_seconds_count{profile="Profile1",clock="POST_task_ep"}', response.text)
+        self.assertNotIn('clock="GET_metrics"', response.text)
+
 if __name__ == "__main__":
     unittest.main()
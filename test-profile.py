@@ -0,0 +1,76 @@
+import unittest
+import time
+import threading
+import contextvars
+import profile
+
+# In-process tests of profile.py:  python test-profile.py -v
+
+TEST_PROFILE_ID = "TestProfile"
+THREADS = 8
+ROUNDS = 30
+
+# Gives the other threads a chance to run right after each span is appended.
+class YieldingList(list):
+    def append(self, item):
+        list.append(self, item)
+        time.sleep(0.0001)
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        profile.clear(TEST_PROFILE_ID)
+        profile.clear_traces()
+
+    #####################################
+
+    # Executor threads of one request share its trace - each span must stay under the
+    # span that was open in its own thread.
+    def test_concurrent_spans(self):
+        def run_spans(number):
+            for i in range(ROUNDS):
+                profile.clock_start("outer" + str(number), TEST_PROFILE_ID)
+                profile.clock_start("inner" + str(number), TEST_PROFILE_ID)
+                profile.clock_stop("inner" + str(number), TEST_PROFILE_ID)
+                profile.clock_stop("outer" + str(number), TEST_PROFILE_ID)
+
+        profile.trace_begin("request", TEST_PROFILE_ID)
+        profile.TRACE.get()[0].spans = YieldingList()
+        profile.clock_start("request", TEST_PROFILE_ID)
+        threads = []
+        for number in range(THREADS):
+            context = contextvars.copy_context()
+            threads.append(threading.Thread(target=context.run, args=(run_spans, number)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        profile.clock_stop("request", TEST_PROFILE_ID)
+        profile.trace_end()
+
+        trace = profile.get_traces(1)[0]
+        self.assertEqual(trace.dropped, 0)
+        self.assertEqual(len(trace.spans), 1 + THREADS * ROUNDS * 2)
+        for clock_id, parent, depth, start, stop in trace.spans[1:]:
+            parent_id = trace.spans[parent][0]
+            if (clock_id.startswith("inner")):
+                self.assertEqual(parent_id, "outer" + clock_id[len("inner"):])
+                self.assertEqual(depth, 2)
+            else:
+                self.assertEqual(parent_id, "request")
+                self.assertEqual(depth, 1)
+            self.assertIsNotNone(stop)
+
+    def test_span_limit(self):
+        profile.trace_begin("request", TEST_PROFILE_ID)
+        for i in range(profile.TRACE_MAX_SPANS + 5):
+            profile.clock_start("span", TEST_PROFILE_ID)
+            profile.clock_stop("span", TEST_PROFILE_ID)
+        profile.trace_end()
+        trace = profile.get_traces(1)[0]
+        self.assertEqual(len(trace.spans), profile.TRACE_MAX_SPANS)
+        self.assertEqual(trace.dropped, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
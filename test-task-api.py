@@ -14,6 +14,8 @@ json_task3_after_put = {"uri": "http://127.0.0.1:5000/tasks/task3", "id": "task3
 json_task4 = {"uri": "http://127.0.0.1:5000/tasks/task4", "id": "task4", "desc": "The Fourth Task"}
 json_tasks_1234 = [{"uri": "http://127.0.0.1:5000/tasks/task1", "id": "task1", "desc": "The First Task"}, {"uri": "http://127.0.0.1:5000/tasks/task2", "id": "task2", "desc": "The Second Task"}, {"uri": "http://127.0.0.1:5000/tasks/task3", "id": "task3", "desc": "The Third Task"}, {"uri": "http://127.0.0.1:5000/tasks/task4", "id": "task4", "desc": "The Fourth Task"}]
 json_tasks_45 = [{"uri": "http://127.0.0.1:5000/tasks/task4", "id": "task4", "desc": "The Fourth Task"}, {"uri": "http://127.0.0.1:5000/tasks/task5", "id": "task5", "desc": "The Fifth Task"}]
+json_dur_tasks_4020 = [{"uri": "http://127.0.0.1:5000/tasks/task4", "id": "task4", "desc": "The Fourth Task", "dur": 40}, {"uri": "http://127.0.0.1:5000/tasks/task6", "id": "task6", "desc": "The Sixth Task", "dur": 20}]
+json_dur_tasks_2040 = [{"uri": "http://127.0.0.1:5000/tasks/task6", "id": "task6", "desc": "The Sixth Task", "dur": 20}, {"uri": "http://127.0.0.1:5000/tasks/task4", "id": "task4", "desc": "The Fourth Task", "dur": 40}]
 json_no_tasks = []
 http_status_bad_request = 400
 
@@ -76,5 +78,34 @@ class TestTaskApi(unittest.TestCase):
         response = requests.get('http://127.0.0.1:5000/tasks')
         self.assertEqual(remove_unicode(response.json()), json_tasks_45)
 
+    def test_tasks_put_invalid(self):
+        # An invalid element - Should return Http Status 400 and leave the tasks unchanged
+        payloads = [{'tasklist': [{'taskid': 'task4', 'desc': 'The Fourth Task'}, {'desc': 'No Taskid'}]},
+                    {'tasklist': [{'taskid': 'task4', 'desc': 'The Fourth Task'}, {'taskid': 'task4', 'desc': 'The Fourth Task Again'}]},
+                    {'tasklist': [{'taskid': 'task4', 'desc': 'The Fourth Task'}, '__import__("os").getpid()']},
+                    {'desc': 'No Tasklist'}]
+        for payload in payloads:
+            response = requests.put('http://127.0.0.1:5000/tasks', json=payload)
+            self.assertEqual(response.status_code, http_status_bad_request)
+        response = requests.get('http://127.0.0.1:5000/tasks')
+        self.assertEqual(remove_unicode(response.json()), json_tasks_123)
+
+    def test_tasks_dur(self):
+        requests.post('http://127.0.0.1:5000/tasks', json={'taskid': 'task4', 'desc': 'The Fourth Task', 'dur': 40})
+        requests.post('http://127.0.0.1:5000/tasks', json={'taskid': 'task5', 'desc': 'The Fifth Task', 'dur': 5})
+        requests.post('http://127.0.0.1:5000/tasks', json={'taskid': 'task6', 'desc': 'The Sixth Task', 'dur': 20})
+        response = requests.get('http://127.0.0.1:5000/taskdur?min=10&max=40')
+        self.assertEqual(remove_unicode(response.json()), json_dur_tasks_2040)
+        response = requests.get('http://127.0.0.1:5000/tasktop?n=2')
+        self.assertEqual(remove_unicode(response.json()), json_dur_tasks_4020)
+        requests.delete('http://127.0.0.1:5000/tasks/task4')
+        response = requests.get('http://127.0.0.1:5000/taskdur?min=40')
+        self.assertEqual(remove_unicode(response.json()), json_no_tasks)
+        # A dur that is not an integer - Should return Http Status 400
+        response = requests.put('http://127.0.0.1:5000/tasks', json={'tasklist': [{'taskid': 'task7', 'desc': 'The Seventh Task', 'dur': [1]}]})
+        self.assertEqual(response.status_code, http_status_bad_request)
+        response = requests.put('http://127.0.0.1:5000/tasks', json={'tasklist': [{'taskid': 'task7', 'desc': 'The Seventh Task', 'dur': 'x'}]})
+        self.assertEqual(response.status_code, http_status_bad_request)
+
 if __name__ == "__main__":
     unittest.main()
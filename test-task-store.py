@@ -0,0 +1,137 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import importlib.util
+
+# In-process tests of the task-api.py TaskStore and snapshots:  python test-task-store.py -v
+
+spec = importlib.util.spec_from_file_location("task_api", os.path.join(os.path.dirname(os.path.abspath(__file__)), "task-api.py"))
+task_api = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(task_api)
+
+THREADS = 8
+TASKS_PER_THREAD = 500
+
+def new_store(tasks=(), max_tasks=0):
+    store = task_api.TaskStore(max_tasks=max_tasks)
+    for task in tasks:
+        store.add(task)
+    return store
+
+def get_rows(tasks):
+    return [(task.id, task.desc, task.dur) for task in tasks]
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "tasks.snap")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    #####################################
+
+    def test_round_trip(self):
+        tasks = [task_api.Task("task1", "The First Task", 60), task_api.Task("task2", None, 120), task_api.Task("task3", "", None), task_api.Task("täsk4", "None", 0)]
+        count = task_api.write_snapshot(new_store(tasks), self.filename)
+        self.assertEqual(count, 4)
+        self.assertEqual(get_rows(task_api.read_snapshot(self.filename)), get_rows(tasks))
+        #
+        store = task_api.TaskStore()
+        store.begin_load()
+        task_api.load_snapshot(store, self.filename)
+        self.assertTrue(store.loaded)
+        self.assertEqual(get_rows(store.values()), get_rows(tasks))
+        self.assertEqual([task.id for task in store.dur_top(2)], ["task2", "task1"])
+        self.assertEqual(store.get("task2").desc, None)
+
+    def test_empty_round_trip(self):
+        self.assertEqual(task_api.write_snapshot(new_store(), self.filename), 0)
+        self.assertEqual(task_api.read_snapshot(self.filename), [])
+
+    def test_load_max_tasks(self):
+        tasks = [task_api.Task("task" + str(i), "Task " + str(i), i) for i in range(10)]
+        task_api.write_snapshot(new_store(tasks), self.filename)
+        store = new_store([task_api.Task("task0", "Existing Task", 100)], max_tasks=4)
+        self.assertEqual(store.load(task_api.read_snapshot(self.filename)), 6)
+        self.assertEqual(len(store), 4)
+        self.assertEqual(store.get("task0").desc, "Existing Task")
+        self.assertEqual([task.id for task in store.values()], ["task0", "task1", "task2", "task3"])
+
+    def test_not_a_snapshot(self):
+        with open(self.filename, mode='wb') as snapfile:
+            snapfile.write(b"not a snapshot")
+        self.assertRaises(ValueError, task_api.read_snapshot, self.filename)
+        store = task_api.TaskStore()
+        store.begin_load()
+        task_api.load_snapshot(store, self.filename)
+        self.assertTrue(store.loaded)
+        self.assertEqual(len(store), 0)
+
+    def test_nul_in_id(self):
+        store = new_store([task_api.Task("task\x001", "The First Task"), task_api.Task("task2", "The Second Task")])
+        self.assertRaises(ValueError, task_api.write_snapshot, store, self.filename)
+        self.assertFalse(os.path.exists(self.filename))
+
+class TestTaskStore(unittest.TestCase):
+
+    def run_threads(self, target):
+        threads = [threading.Thread(target=target, args=(number,)) for number in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    #####################################
+
+    # Concurrent adds, duration changes and removes keep the size and the duration index
+    # in step with the tasks.
+    def test_concurrent_updates(self):
+        store = task_api.TaskStore()
+        def update(number):
+            for i in range(TASKS_PER_THREAD):
+                tid = "task" + str(number) + "-" + str(i)
+                self.assertTrue(store.add(task_api.Task(tid, "Task", i)))
+                self.assertFalse(store.add(task_api.Task(tid, "Task", i)))
+                store.set_dur(tid, i + number)
+                if (i % 2 == 0):
+                    self.assertIsNotNone(store.remove(tid))
+        self.run_threads(update)
+
+        tasks = store.values()
+        self.assertEqual(len(store), THREADS * TASKS_PER_THREAD // 2)
+        self.assertEqual(len(tasks), len(store))
+        durs = [task.dur for task in store.dur_range(None, None)]
+        self.assertEqual(durs, sorted(task.dur for task in tasks))
+
+    def test_concurrent_adds_max_tasks(self):
+        store = task_api.TaskStore(max_tasks=THREADS * 10)
+        full = []
+        def add(number):
+            for i in range(TASKS_PER_THREAD):
+                try:
+                    store.add(task_api.Task("task" + str(number) + "-" + str(i), "Task"))
+                except task_api.StoreFullError:
+                    full.append(i)
+        self.run_threads(add)
+        self.assertEqual(len(store), THREADS * 10)
+        self.assertEqual(len(store.values()), THREADS * 10)
+        self.assertEqual(len(full), THREADS * TASKS_PER_THREAD - THREADS * 10)
+
+    def test_replace(self):
+        store = new_store([task_api.Task("task1", "The First Task", 60)], max_tasks=2)
+        store.replace([task_api.Task("task2", "The Second Task", 20), task_api.Task("task3", "The Third Task", 30)])
+        self.assertEqual([task.id for task in store.values()], ["task2", "task3"])
+        self.assertEqual([task.id for task in store.dur_top(1)], ["task3"])
+        self.assertIsNone(store.get("task1"))
+        #
+        tasks = [task_api.Task("task" + str(i), "Task") for i in range(3)]
+        self.assertRaises(task_api.StoreFullError, store.replace, tasks)
+        self.assertEqual([task.id for task in store.values()], ["task2", "task3"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+"""
+wsgi.py
+WSGI entry point for production servers - loads the app named by APP_MODULE.
+
+Description:
+   The app files have hyphens in their names (task-api.py, ftask-api.py), so they
+   cannot be imported by name.  APP_MODULE names the file to load (default main.py)
+   and its Flask object is exposed as wsgi.app, e.g. for gunicorn (see gunicorn.conf.py):
+
+      APP_MODULE=main.py         Datastore / Storage backed - any number of workers
+      APP_MODULE=ftask-api.py    file backed
+      APP_MODULE=task-api.py     in memory - every worker process has its own tasks
+
+   The app is imported once when this module is imported, so with preload_app the
+   gunicorn master imports it before forking the workers.  Background work that belongs
+   to the serving process is started by start_worker() in each worker after the fork
+   (gunicorn.conf.py post_fork) - for task-api.py the TASK_SNAPSHOT_FILE load and writer,
+   which its __main__ block starts when it runs under app.run.
+
+   Example:
+      gunicorn -c gunicorn.conf.py wsgi:app
+      APP_MODULE=task-api.py gunicorn -c gunicorn.conf.py wsgi:app
+
+"""
+import os
+import sys
+import importlib.util
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_MODULE = os.environ.get("APP_MODULE", "main.py")
+
+def load_module(filename):
+    name = os.path.splitext(os.path.basename(filename))[0].replace("-", "_")
+    module = sys.modules.get(name)
+    if (module is None):
+        spec = importlib.util.spec_from_file_location(name, os.path.join(BASE_DIR, filename))
+        if (spec is None):
+            raise ValueError("APP_MODULE {} is not a python file".format(filename))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return module
+
+# Starts the per-process background work of the app - call once in the serving process.
+def start_worker():
+    if (hasattr(module, "start_snapshots")):
+        module.start_snapshots(module.TASKS, module.SNAPSHOT_FILE)
+
+module = load_module(APP_MODULE)
+app = module.app